@@ -1,140 +1,31 @@
 #
+# Run the whole pipeline with macvin-run. The stages of every cruise are run
+# in dependency order, and independent stages and cruises run in parallel
+# (--jobs). A failing stage only stops the stages that depend on it.
+#
+# Stages: ek500, idx, pre, pre2zarr, atc, atc2zarr, align, reports, luf
 
-# S2000012_PGOSARS_1024
-#export CRUISE=S2000012_PGOSARS_1024
-#uv run macvin-ek500conversion --cruise "$CRUISE"
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-#uv run macvin-preprocess2zarr --cruise "$CRUISE"
-#uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S2001013_PGOSARS_1024
-#export CRUISE=S2001013_PGOSARS_1024
-#uv run macvin-ek500conversion --cruise "$CRUISE"
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-#uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S2002015_PGOSARS_1024
-#export CRUISE=S2002015_PGOSARS_1024
-#uv run macvin-ek500conversion --cruise "$CRUISE"
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-#uv run macvin-preprocess2zarr --cruise "$CRUISE"
-#uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S2003112_PGOSARS_4174
-#export CRUISE=S2003112_PGOSARS_4174
-#uv run macvin-ek500conversion --cruise "$CRUISE"
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S2004113_PGOSARS_4174
-#export CRUISE=S2004113_PGOSARS_4174
-#uv run macvin-ek500conversion --cruise "$CRUISE"
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
+# Cruises that also need the zarr stores
+#uv run macvin-run --stages ek500,idx,pre,pre2zarr,atc,atc2zarr,reports,luf --jobs 4 \
+#    --cruise S2000012_PGOSARS_1024,S2002015_PGOSARS_1024,S1412S_PSCOTIA_MXHR6
 
+# No atc2zarr for S2001013_PGOSARS_1024
+#uv run macvin-run --stages ek500,idx,pre,pre2zarr,atc,reports,luf --cruise S2001013_PGOSARS_1024
 
-# S2006212_PJOHANHJORT_1019
-#export CRUISE=S2006212_PJOHANHJORT_1019
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
+# No zarr stores
+#uv run macvin-run --stages ek500,idx,pre,atc,reports,luf --jobs 4 \
+#    --cruise S2003112_PGOSARS_4174,S2004113_PGOSARS_4174,S2006212_PJOHANHJORT_1019,S1504S_PSCOTIA_MXHR6
 
 # 'ping_time' not strictly increasing in /PREPROCESSING/2012843-D20121002-T202452.nc
-#export CRUISE=S2012842_PCHRISTINAE_2704
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
+#uv run macvin-run --stages idx,pre,atc,reports,luf --cruise S2012842_PCHRISTINAE_2704
 
+# ValueError: conflicting sizes for dimension 'ping_time': length 1333071 on 'ping_time' and length 1332990 on {'category': 'annotation', 'ping_time': 'annotation', 'range': 'annotation'}
+#uv run macvin-run --stages idx,pre,atc,align,reports,luf --cruise S2012843_PBRENNHOLM_4405
 
-# S2012843_PBRENNHOLM_4405
-#export CRUISE=S2012843_PBRENNHOLM_4405 # ValueError: conflicting sizes for dimension 'ping_time': length 1333071 on 'ping_time' and length 1332990 on {'category': 'annotation', 'ping_time': 'annotation', 'range': 'annotation'}
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S1504S_PSCOTIA_MXHR6
-#export CRUISE=S1504S_PSCOTIA_MXHR6
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S1412S_PSCOTIA_MXHR6
-#export CRUISE=S1412S_PSCOTIA_MXHR6
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-#uv run macvin-preprocess2zarr --cruise "$CRUISE"
-#uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
-
-# S2005114_PGOSARS_4174  'ping_time' not strictly increasing in /PREPROCESSING/tokt2005114-D20051109-T021146.nc
-#export CRUISE=S2005114_PGOSARS_4174
-#uv run macvin-idxprocessing --cruise "$CRUISE"
-#uv run macvin-preprocessing --cruise "$CRUISE"
-#uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-#uv run macvin-reports --cruise "$CRUISE"
-#uv run macvin-lufreports --cruise "$CRUISE"
-#uv run macvin-status --cruise "$CRUISE"
+# 'ping_time' not strictly increasing in /PREPROCESSING/tokt2005114-D20051109-T021146.nc
+#uv run macvin-run --stages idx,pre,atc,reports,luf --cruise S2005114_PGOSARS_4174
 
 # 'ping_time' not strictly increasing in /PREPROCESSING/tokt2005114-D20051109-T021146.nc
 export CRUISE=S2007211_PJOHANHJORT_1019
-uv run macvin-idxprocessing --cruise "$CRUISE"
-uv run macvin-preprocessing --cruise "$CRUISE"
-uv run macvin-atcprocessing --cruise "$CRUISE"
-##uv run macvin-preprocess2zarr --cruise "$CRUISE"
-##uv run macvin-atc2zarr --cruise "$CRUISE"
-uv run macvin-reports --cruise "$CRUISE"
-uv run macvin-lufreports --cruise "$CRUISE"
+uv run macvin-run --stages idx,pre,atc,reports,luf --cruise "$CRUISE"
 uv run macvin-status --cruise "$CRUISE"
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+from pathlib import Path
+from dataclasses import dataclass
+import logging
+import os
+
+import numpy as np
+
+from macvin.coverage import ping_index, ping_times
+from macvin.trace import traced
+
+logger = logging.getLogger(__name__)
+
+TOLERANCE_ENV = "MACVIN_ALIGN_TOLERANCE_S"
+DEFAULT_TOLERANCE_S = 0.05
+# Pings per chunk that are read and written at a time
+DEFAULT_CHUNK_PINGS = 5000
+
+
+@dataclass
+class AlignStats:
+    files: int = 0
+    skipped: int = 0
+    pings: int = 0
+    matched: int = 0
+    # Bytes of the sv files that were aligned, not the skipped ones
+    bytes: int = 0
+
+    @property
+    def filled(self) -> int:
+        """Sv pings without labels within the tolerance, filled with NaN."""
+        return self.pings - self.matched
+
+
+def default_tolerance() -> np.timedelta64:
+    seconds = float(os.getenv(TOLERANCE_ENV, DEFAULT_TOLERANCE_S))
+    return np.timedelta64(int(seconds * 1e9), "ns")
+
+
+def match_pings(times: np.ndarray, other: np.ndarray, tolerance: np.timedelta64) -> np.ndarray:
+    """For every time, the index of the nearest time in `other` within the tolerance, or -1."""
+    if len(other) == 0:
+        return np.full(len(times), -1, dtype=np.int64)
+    order = np.argsort(other, kind="stable")
+    ref = other[order].view(np.int64)
+    t = times.view(np.int64)
+    i = np.searchsorted(ref, t)
+    right = np.minimum(i, len(ref) - 1)
+    left = np.maximum(i - 1, 0)
+    nearest = np.where(np.abs(ref[left] - t) <= np.abs(ref[right] - t), left, right)
+    ok = np.abs(ref[nearest] - t) <= tolerance.astype("timedelta64[ns]").astype(np.int64)
+    return np.where(ok, order[nearest], -1)
+
+
+def _is_current(output: Path, sv_file: Path, newest_labels: float) -> bool:
+    if not output.exists():
+        return False
+    mtime = output.stat().st_mtime
+    return mtime >= sv_file.stat().st_mtime and mtime >= newest_labels
+
+
+def align_file(
+    sv_file: Path,
+    labels_files: list[Path],
+    labels_times: np.ndarray,
+    labels_ids: np.ndarray,
+    labels_pos: np.ndarray,
+    output: Path,
+    tolerance: np.timedelta64,
+    chunk_pings: int = DEFAULT_CHUNK_PINGS,
+) -> int:
+    """
+    Write the labels reindexed onto the ping_time grid of `sv_file` to
+    `output`. Pings are taken from the nearest labels ping within the
+    tolerance, pings without one are NaN. The data is read and written in
+    chunks of `chunk_pings`. Returns the number of matched pings.
+    """
+    import xarray as xr
+
+    sv_times = ping_times(sv_file)
+    match = match_pings(sv_times, labels_times, tolerance)
+    matched = match >= 0
+    file_of = np.where(matched, labels_ids[np.maximum(match, 0)], -1)
+
+    involved = sorted(set(file_of[matched].tolist())) or [0]
+    sources = {
+        i: xr.open_dataset(labels_files[i], chunks={"ping_time": chunk_pings}) for i in involved
+    }
+    try:
+        template = sources[involved[0]]
+        timed = [v for v in template.data_vars if "ping_time" in template[v].dims]
+
+        # Runs of consecutive sv pings that come from the same labels file (or none)
+        breaks = np.flatnonzero(np.diff(file_of) != 0) + 1
+        pieces = []
+        for run in np.split(np.arange(len(sv_times)), breaks):
+            if len(run) == 0:
+                continue
+            i = file_of[run[0]]
+            if i < 0:
+                gap = template[timed].isel(ping_time=np.zeros(len(run), dtype=np.int64))
+                pieces.append(gap.where(False))
+            else:
+                pieces.append(sources[i][timed].isel(ping_time=labels_pos[match[run]]))
+
+        aligned = xr.concat(pieces, dim="ping_time", join="outer", coords="minimal", compat="override")
+        aligned = aligned.assign_coords(ping_time=sv_times).chunk({"ping_time": chunk_pings})
+        for v in template.data_vars:
+            if v not in timed:
+                aligned[v] = template[v]
+        aligned.attrs = dict(template.attrs)
+        aligned.attrs["aligned_to"] = sv_file.name
+
+        for var in aligned.variables.values():
+            var.encoding = {}
+        encoding = {v: {"zlib": True, "complevel": 1} for v in timed}
+
+        output.parent.mkdir(parents=True, exist_ok=True)
+        tmp = output.with_name(f".{output.name}.partial")
+        aligned.to_netcdf(tmp, encoding=encoding)
+        os.replace(tmp, output)
+    finally:
+        for ds in sources.values():
+            ds.close()
+    return int(matched.sum())
+
+
+@traced(cat="analysis")
+def align_labels(
+    sv_dir: Path,
+    labels_dir: Path,
+    output_dir: Path,
+    existing_dir: Path | None = None,
+    tolerance: np.timedelta64 | None = None,
+    chunk_pings: int = DEFAULT_CHUNK_PINGS,
+    dry_run: bool = False,
+) -> AlignStats:
+    """
+    Reindex the labels in `labels_dir` onto the ping_time grid of every sv
+    file in `sv_dir`, and write one aligned labels file per sv file to
+    `output_dir`. Labels are matched by ping time, not by file, so pings
+    that were moved between files or dropped by the ATC do not break the
+    integration. Files in `existing_dir` that are newer than their sv file
+    and all labels files are kept.
+    """
+    tolerance = default_tolerance() if tolerance is None else tolerance
+    sv_files = sorted(Path(sv_dir).glob("*.nc"))
+    labels_files = sorted(Path(labels_dir).glob("*.nc"))
+    stats = AlignStats()
+    if not sv_files or not labels_files:
+        logger.warning(f"Nothing to align: {len(sv_files)} sv files, {len(labels_files)} labels files")
+        return stats
+    if dry_run:
+        logger.info(f"Dry run: would align {len(labels_files)} labels files onto {len(sv_files)} sv files")
+        return stats
+
+    labels_times, labels_ids = ping_index(labels_files)
+    starts = np.concatenate([[0], np.cumsum(np.bincount(labels_ids, minlength=len(labels_files)))[:-1]])
+    labels_pos = np.arange(len(labels_ids)) - starts[labels_ids]
+    newest_labels = max(f.stat().st_mtime for f in labels_files)
+
+    for sv_file in sv_files:
+        if existing_dir is not None and _is_current(Path(existing_dir) / sv_file.name, sv_file, newest_labels):
+            stats.skipped += 1
+            continue
+        matched = align_file(
+            sv_file,
+            labels_files,
+            labels_times,
+            labels_ids,
+            labels_pos,
+            Path(output_dir) / sv_file.name,
+            tolerance,
+            chunk_pings,
+        )
+        n = len(ping_times(sv_file))
+        stats.files += 1
+        stats.bytes += sv_file.stat().st_size
+        stats.pings += n
+        stats.matched += matched
+        if matched < n:
+            logger.warning(f"{sv_file.name}: {n - matched} of {n} pings have no labels, filled with NaN")
+
+    logger.info(
+        f"Aligned {stats.files} files ({stats.skipped} up to date): {stats.pings} pings, "
+        f"{stats.filled} without labels"
+    )
+    return stats
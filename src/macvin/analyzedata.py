@@ -1,18 +1,22 @@
+from __future__ import annotations
+
 from pathlib import Path
+from typing import TYPE_CHECKING
 import logging
-import xarray as xr
-import matplotlib.pyplot as plt
-import numpy as np
-from macvin.flows import (
-    get_survey, get_paths
-)
-import dask.array as da
+from macvin.catalog import load_catalog
+from macvin.flows import report_labels
+from macvin.references import open_collection
+from macvin.trace import traced
 import os
 
+if TYPE_CHECKING:
+    import xarray as xr
+
 logger = logging.getLogger(__name__)
 
 
 def macvin_consistency_flow(
+    silver_dir: Path,
     dry_run: bool = False,
     cruise: str | None = None,
     quick_run: bool = True
@@ -20,13 +24,9 @@ def macvin_consistency_flow(
 
     logger.info("#### Running consistency plot ####")
 
-    _silver_dir = silver_dir / cruise / Path("ACOUSTIC", "EK")
-    path_data = get_paths(_silver_dir)
-    df, exclude_files = get_survey(cruise=cruise)
+    path_data = load_catalog(silver_root=silver_dir)[cruise].paths
 
-    path_data = get_paths(_silver_dir)
-
-    labels_f = path_data["target_classification"]
+    labels_f = report_labels(path_data)
     sv_noise_f = path_data["preprocessing"]["noisefiltering"]
     sv_pre_f = path_data["preprocessing"]["preprocessing"]
     dataqc_f = path_data["sv_histograms"]
@@ -48,27 +48,20 @@ def macvin_consistency_flow(
         logger.info("Dry run")
 
 
+@traced(cat="analysis")
 def calculate_dist(sv_pre_f, sv_noise_f, labels_f, dataqc_f, quick_run=True):
+    import xarray as xr
+    import matplotlib.pyplot as plt
 
-    sv_pre = (xr.open_mfdataset(str(sv_pre_f)+"/*.nc",
-                                chunks="auto",
-                                combine="by_coords")
-                .sortby("frequency")
-              )
+    sv_pre = open_collection(sv_pre_f, chunks="auto").sortby("frequency")
     sv_pre = depthtorange(sv_pre)
     logger.debug(f"Chunk size for sv_pre: {sv_pre['sv'].encoding.get('chunksizes')}")
     
-    sv_noise = (xr.open_mfdataset(str(sv_noise_f)+"/*.nc",
-                                  chunks = "auto",
-                                  combine="by_coords")
-                .sortby("frequency")
-                )
+    sv_noise = open_collection(sv_noise_f, chunks="auto").sortby("frequency")
     sv_noise = depthtorange(sv_noise)
     logger.debug(f"Chunk size for sv_noise: {sv_noise['sv'].encoding.get('chunksizes')}")
     
-    labels = xr.open_mfdataset(str(labels_f)+"/*.nc",
-                               chunks="auto",
-                               combine="by_coords")
+    labels = open_collection(labels_f, chunks="auto")
     with xr.set_options(display_max_rows=100):
         logger.debug(f"sv_pre \n{sv_pre}")
         logger.debug(f"sv_noise \n{sv_noise}")
@@ -163,6 +156,7 @@ def calculate_dist(sv_pre_f, sv_noise_f, labels_f, dataqc_f, quick_run=True):
 # Processing functions
 #
 
+@traced(cat="analysis")
 def compute_sv_histogram_dask(
     ds_sv: xr.Dataset,
     ds_annotation: xr.Dataset = None,
@@ -188,6 +182,10 @@ def compute_sv_histogram_dask(
         - combined_mask: xr.DataArray (lazy)
     """
 
+    import xarray as xr
+    import numpy as np
+    import dask.array as da
+
     # Convert to Sv
     ds_sv = ds_sv.copy()
     ds_sv["sv"] = 10 * np.log10(ds_sv["sv"].clip(min=1e-10))
@@ -273,6 +271,7 @@ def compute_sv_histogram_dask(
     }
 
 
+@traced(cat="analysis")
 def bottom_mask_single_freq(
     ds_sv: xr.Dataset,
     ds_bottom: xr.Dataset,
@@ -296,9 +295,8 @@ def bottom_mask_single_freq(
     xr.Dataset
         Dataset containing boolean mask `bottom_noise` with dims (ping_time, range)
     """
-    import pdb
-    pdb.set_trace()
-    
+    import xarray as xr
+
     # Select frequency
     sv = ds_sv["sv"].sel(frequency=frequency)
     bottom = ds_bottom["bottom_depth"]
@@ -321,6 +319,7 @@ def bottom_mask_single_freq(
     return bottom_range_ds
 
 
+@traced(cat="analysis")
 def depthtorange(sv):
     """
     Adjust bottom depth to range reference.
@@ -337,6 +336,7 @@ def depthtorange(sv):
 # Plotting functions
 #
 
+@traced(cat="analysis")
 def plot_sv_with_bottoms(
     sv_ds,
     bottom_ds_1,
@@ -356,6 +356,9 @@ def plot_sv_with_bottoms(
     linewidth=1,
     robust=False,
 ):
+    import numpy as np
+    import matplotlib.pyplot as plt
+
     sv_ds = sv_ds.sortby("frequency")
 
     sv = sv_ds[sv_var].sel(frequency=frequency, method="nearest")
@@ -417,6 +420,7 @@ def plot_sv_with_bottoms(
     return fig, ax
 
 
+@traced(cat="analysis")
 def plot_sv_histogram_comparison(
     ds1: xr.Dataset,
     ds2: xr.Dataset,
@@ -442,6 +446,8 @@ def plot_sv_histogram_comparison(
       - ds[bounds_var] with dims (bin_dim, bounds_dim), where size(bounds_dim) == 2
     """
 
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(8, 5))
 
     def _extract_plot_data(ds: xr.Dataset):
@@ -0,0 +1,201 @@
+from pathlib import Path
+from abc import ABC, abstractmethod
+from collections.abc import Mapping, Sequence
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from macvin.ledger import Run
+from macvin.resume import file_key
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ENV = "MACVIN_BACKEND"
+MOCK_CONFIG_ENV = "MACVIN_MOCK_CONFIG"
+MOCK_TIME_SCALE_ENV = "MACVIN_MOCK_TIME_SCALE"
+
+
+class Backend(ABC):
+    """Runs the container of a task. `run` raises CalledProcessError on failure."""
+
+    name = "base"
+    # Whether the resource profiles are applied and checked by admission
+    uses_resources = True
+
+    @abstractmethod
+    def run(
+        self,
+        command: list[str],
+        image: str,
+        name: str,
+        volumes: Mapping[str, str],
+        env: Mapping[str, str] | None,
+        outputs: Sequence[str],
+        run: Run,
+    ):
+        ...
+
+
+class DockerBackend(Backend):
+    """Run the image with `docker run` and record its peak cpu and memory usage."""
+
+    name = "docker"
+
+    def run(self, command, image, name, volumes, env, outputs, run):
+        from macvin.resources import ContainerMonitor
+        from macvin.tasks import _run_command
+
+        with ContainerMonitor(name) as monitor:
+            try:
+                _run_command(command, image, run)
+            finally:
+                run.peak_cpus = monitor.peak_cpus
+                run.peak_memory_bytes = monitor.peak_memory_bytes
+
+
+@dataclass
+class MockImage:
+    """
+    How the mock backend emulates an image.
+
+    The emulated container sleeps `duration_s` plus `duration_per_file_s` per
+    input file, prints `stdout_lines` lines, and fails with exit code 1 with
+    probability `failure_rate`. For every input file matching `input_glob` in
+    the `input` volume it writes `per_input` (formatted with the file key)
+    into every output volume, and it writes the `files` (formatted with the
+    container environment) once. Times are multiplied by MACVIN_MOCK_TIME_SCALE.
+    """
+
+    duration_s: float = 1.0
+    duration_per_file_s: float = 0.0
+    stdout_lines: int = 100
+    failure_rate: float = 0.0
+    input: str | None = None
+    input_glob: str = "*"
+    per_input: str | None = None
+    files: list[str] = field(default_factory=list)
+    output_bytes: int = 1024
+
+
+DEFAULT_MOCK_IMAGES = {
+    "acoustic-ek_processing_korona-fixidx:local": MockImage(
+        duration_s=2, duration_per_file_s=0.2, input="/IDX", input_glob="*.raw", per_input="{key}-korona.idx"
+    ),
+    "acoustic-ek_processing_korona-noisefiltering:local": MockImage(
+        duration_s=5, duration_per_file_s=2, stdout_lines=2000,
+        input="/RAWDATA", input_glob="*.raw", per_input="{key}.nc", output_bytes=1024**2,
+    ),
+    "acoustic-ek_processing_korona-preprocessing:local": MockImage(
+        duration_s=5, duration_per_file_s=2, stdout_lines=2000,
+        input="/RAWDATA", input_glob="*.raw", per_input="{key}.nc", output_bytes=1024**2,
+    ),
+    "acoustic-ek_target-classification_mackerel-korneliussen2016:local": MockImage(
+        duration_s=5, duration_per_file_s=4, stdout_lines=500,
+        input="/PREPROCESSING", input_glob="*.nc", per_input="{key}.nc", output_bytes=256 * 1024,
+    ),
+    "acoustic-ek_processing_nc-zarr:local": MockImage(
+        duration_s=10, duration_per_file_s=0.5, input="/NC_MOUNT", input_glob="*.nc",
+        files=["{ZARR_STORE}/.zgroup", "{ZARR_STORE}/.zmetadata"],
+    ),
+    "acoustic-ek_reports_sv-echo-integrator:local": MockImage(
+        duration_s=10, duration_per_file_s=0.5, input="/PREPROCESSING", input_glob="*.nc",
+        files=["sA.zarr/.zgroup", "sA.zarr/.zmetadata"],
+    ),
+}
+
+
+def load_mock_images(path: Path | None = None) -> dict[str, MockImage]:
+    """The default mock images, updated from the JSON file in MACVIN_MOCK_CONFIG (image -> fields)."""
+    images = dict(DEFAULT_MOCK_IMAGES)
+    path = path or os.getenv(MOCK_CONFIG_ENV)
+    if path:
+        for image, values in json.loads(Path(path).read_text()).items():
+            base = asdict(images.get(image, MockImage()))
+            images[image] = MockImage(**{**base, **values})
+    return images
+
+
+class MockBackend(Backend):
+    """
+    Emulate the images in a local python process instead of running docker.
+
+    The emulated container is a subprocess whose output goes through the
+    same pipe handling and logging as a docker run, so flows, scheduling,
+    staging and logging can be benchmarked without images or data.
+    """
+
+    name = "mock"
+    uses_resources = False
+
+    def __init__(self, images: dict[str, MockImage] | None = None, time_scale: float | None = None):
+        self.images = images if images is not None else load_mock_images()
+        if time_scale is None:
+            time_scale = float(os.getenv(MOCK_TIME_SCALE_ENV, 1.0))
+        self.time_scale = time_scale
+
+    def run(self, command, image, name, volumes, env, outputs, run):
+        from macvin.tasks import _run_command
+
+        spec = {
+            "image": asdict(self.images.get(image, MockImage())),
+            "volumes": dict(volumes),
+            "env": {k: str(v) for k, v in (env or {}).items()},
+            "outputs": list(outputs),
+            "time_scale": self.time_scale,
+        }
+        _run_command([sys.executable, "-m", "macvin.backends", json.dumps(spec)], image, run)
+
+
+def emulate(spec: dict) -> int:
+    """Body of an emulated container, returns the exit code."""
+    image = MockImage(**spec["image"])
+    volumes = spec["volumes"]
+    scale = spec["time_scale"]
+
+    inputs = []
+    if image.input and image.input in volumes:
+        inputs = sorted(Path(volumes[image.input]).glob(image.input_glob))
+
+    duration = (image.duration_s + image.duration_per_file_s * len(inputs)) * scale
+    lines = max(image.stdout_lines, 1)
+    for i in range(lines):
+        print(f"[mock] step {i + 1}/{lines} processing {len(inputs)} files", flush=False)
+        time.sleep(duration / lines)
+    sys.stdout.flush()
+
+    if random.random() < image.failure_rate:
+        print("[mock] simulated failure", file=sys.stderr)
+        return 1
+
+    payload = b"\0" * image.output_bytes
+    for container_path in spec["outputs"]:
+        out = Path(volumes[container_path])
+        names = [image.per_input.format(key=file_key(f)) for f in inputs] if image.per_input else []
+        names += [f.format(**spec["env"]) for f in image.files]
+        for n in names:
+            (out / n).parent.mkdir(parents=True, exist_ok=True)
+            (out / n).write_bytes(payload)
+    return 0
+
+
+_backends = {"docker": DockerBackend, "mock": MockBackend}
+_backend: Backend | None = None
+
+
+def get_backend() -> Backend:
+    """The backend selected with MACVIN_BACKEND (docker or mock, default docker)."""
+    global _backend
+    name = os.getenv(BACKEND_ENV, "docker")
+    if _backend is None or _backend.name != name:
+        if name not in _backends:
+            raise ValueError(f"Unknown backend '{name}', expected one of {', '.join(_backends)}")
+        _backend = _backends[name]()
+    return _backend
+
+
+if __name__ == "__main__":
+    sys.exit(emulate(json.loads(sys.argv[1])))
@@ -0,0 +1,614 @@
+from pathlib import Path
+from collections.abc import Callable
+from dataclasses import asdict, replace
+from datetime import datetime, timedelta, timezone
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from macvin.logging import setup_logging
+from macvin.synthetic import SIZES, SyntheticSpec, make_cruise, write_raw
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = Path("benchmark_results")
+
+# Data sets generated for every size: name -> changes to the size spec
+DATASETS = {
+    "clean": {},
+    "overlap": {"overlap_files": 1},
+    "missing_frequency": {"missing_frequency_files": 1},
+}
+
+# Modules of the console scripts, checked by the startup benchmark
+STARTUP_MODULES = ("macvin.pipeline", "macvin.status", "macvin.test", "macvin.ledger")
+# Modules that must only be imported by the functions that need them
+HEAVY_MODULES = ("pandas", "xarray", "dask", "matplotlib", "zarr", "zarr2lufxml", "netCDF4")
+DEFAULT_STARTUP_LIMIT_S = 1.0
+
+_STARTUP_CODE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+print(json.dumps({{"import_s": time.perf_counter() - t0, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _versions() -> dict[str, str]:
+    versions = {}
+    for name in ("numpy", "pandas", "xarray", "dask", "netCDF4"):
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return versions
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+            timeout=10,
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def timed(func: Callable[[], object], repeat: int) -> dict:
+    """Run `func` `repeat` times, return the timings, or the error if it raised."""
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            return {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        seconds.append(time.perf_counter() - t0)
+    return {
+        "status": "ok",
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+    }
+
+
+def get_dataset(data_dir: Path, spec: SyntheticSpec) -> tuple[Path, float]:
+    """Generate a synthetic cruise in `data_dir`, or reuse it if it was made with the same spec."""
+    manifest = data_dir / "manifest.json"
+    if manifest.exists() and json.loads(manifest.read_text())["spec"] == json.loads(
+        json.dumps(asdict(spec))
+    ):
+        logger.info(f"Reusing synthetic data in {data_dir}")
+        return data_dir, 0.0
+    t0 = time.perf_counter()
+    make_cruise(data_dir, spec)
+    return data_dir, time.perf_counter() - t0
+
+
+def benchmark_dataset(root: Path, repeat: int) -> dict[str, dict]:
+    """Time the hot paths of status.py and analyzedata.py on one synthetic cruise."""
+    import xarray as xr
+    from macvin import analyzedata, status
+
+    sv_files = sorted((root / "sv_nc").glob("*.nc"))
+    results = {}
+
+    results["status.get_freq_and_time_bounds"] = timed(
+        lambda: [status.get_freq_and_time_bounds(f) for f in sv_files], repeat
+    )
+    results["status.check_monotonic"] = timed(
+        lambda: status.check_monotonic(sv_files, "benchmark"), repeat
+    )
+
+    def open_sv():
+        ds = xr.open_mfdataset(
+            str(root / "sv_nc") + "/*.nc", chunks="auto", combine="by_coords"
+        ).sortby("frequency")
+        return analyzedata.depthtorange(ds)
+
+    def open_labels():
+        return xr.open_mfdataset(
+            str(root / "labels_nc") + "/*.nc", chunks="auto", combine="by_coords"
+        )
+
+    results["analyzedata.open_sv"] = timed(open_sv, repeat)
+    results["analyzedata.open_labels"] = timed(open_labels, repeat)
+
+    if results["analyzedata.open_sv"]["status"] != "ok" or results["analyzedata.open_labels"]["status"] != "ok":
+        for case in (
+            "analyzedata.bottom_mask_single_freq",
+            "analyzedata.compute_sv_histogram_dask",
+            "analyzedata.compute_sv_histogram_dask_no_bottom",
+        ):
+            results[case] = {"status": "skipped", "error": "could not open the data set"}
+        return results
+
+    sv = open_sv()
+    labels = open_labels()
+    results["analyzedata.bottom_mask_single_freq"] = timed(
+        lambda: analyzedata.bottom_mask_single_freq(sv, sv)["bottom_range"].load(), repeat
+    )
+    bottom = analyzedata.bottom_mask_single_freq(sv, sv)
+    results["analyzedata.compute_sv_histogram_dask"] = timed(
+        lambda: analyzedata.compute_sv_histogram_dask(
+            ds_sv=sv, ds_annotation=labels, ds_bottom=bottom, frequency=38000, bins=100
+        ),
+        repeat,
+    )
+    results["analyzedata.compute_sv_histogram_dask_no_bottom"] = timed(
+        lambda: analyzedata.compute_sv_histogram_dask(
+            ds_sv=sv, ds_annotation=labels, ds_bottom=None, frequency=38000, bins=100
+        ),
+        repeat,
+    )
+    return results
+
+
+def run_benchmarks(
+    sizes: list[str],
+    datasets: list[str],
+    data_dir: Path,
+    repeat: int = 3,
+) -> dict:
+    """Run the benchmark suite and return the report."""
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "versions": _versions(),
+        "git_commit": _git_commit(),
+        "repeat": repeat,
+        "results": [],
+    }
+
+    for size in sizes:
+        for dataset in datasets:
+            spec = replace(SIZES[size], **DATASETS[dataset])
+            root, generate_s = get_dataset(data_dir / size / dataset, spec)
+            logger.info(f"Benchmarking {size}/{dataset}")
+            for case, result in benchmark_dataset(root, repeat).items():
+                report["results"].append(
+                    {
+                        "size": size,
+                        "dataset": dataset,
+                        "case": case,
+                        "n_files": spec.n_files,
+                        "n_pings": spec.n_pings,
+                        "n_range": spec.n_range,
+                        "generate_s": generate_s,
+                        **result,
+                    }
+                )
+                if result["status"] == "ok":
+                    logger.info(f"{size:6s} {dataset:18s} {case:50s} {result['median']:8.3f} s")
+                else:
+                    logger.info(f"{size:6s} {dataset:18s} {case:50s} {result['status']}: {result['error']}")
+    return report
+
+
+def simulate_cruises(workdir: Path, n_cruises: int, files_per_cruise: int) -> list[str]:
+    """
+    Write a cruises.csv, an empty excludefiles.csv and raw directories with
+    minimal raw files for `n_cruises` simulated cruises to `workdir`.
+    """
+    cruises = [f"S{9000000 + i}_PSIMULATED_{i:04d}" for i in range(n_cruises)]
+    lines = ["cruise,status,RAW_files,Original_RAW_files"]
+    for cruise in cruises:
+        raw = workdir / "bronze" / cruise / "EK60_RAWDATA"
+        raw.mkdir(parents=True, exist_ok=True)
+        code = cruise.split("_")[0]
+        for i in range(files_per_cruise):
+            start = datetime(2020, 1, 1) + timedelta(seconds=10 * i)
+            write_raw(raw / f"{code}-D{start:%Y%m%d-T%H%M%S}.raw", start=start.isoformat(), n_pings=10)
+        lines.append(f"{cruise},,{raw},{workdir / 'original' / cruise}")
+    (workdir / "cruises.csv").write_text("\n".join(lines) + "\n")
+    (workdir / "excludefiles.csv").write_text("excluded_files\n")
+    return cruises
+
+
+def _mock_env(workdir: Path, time_scale: float, failure_rate: float = 0.0, stdout_lines: int | None = None) -> dict:
+    """Write the mock backend config to `workdir` and return the environment that selects it."""
+    from macvin import backends
+
+    mock_config = {}
+    for image in backends.DEFAULT_MOCK_IMAGES:
+        mock_config[image] = {"failure_rate": failure_rate}
+        if stdout_lines is not None:
+            mock_config[image]["stdout_lines"] = stdout_lines
+    (workdir / "mock.json").write_text(json.dumps(mock_config))
+    return {
+        backends.BACKEND_ENV: "mock",
+        backends.MOCK_CONFIG_ENV: str(workdir / "mock.json"),
+        backends.MOCK_TIME_SCALE_ENV: str(time_scale),
+        "MACVIN_LEDGER": str(workdir / "macvin_runs.sqlite"),
+    }
+
+
+def benchmark_flows(
+    workdir: Path,
+    n_cruises: int,
+    files_per_cruise: int,
+    stages: str,
+    jobs: int,
+    stage_jobs: str,
+    time_scale: float,
+    failure_rate: float = 0.0,
+    stdout_lines: int | None = None,
+) -> dict:
+    """
+    Run `macvin_run_flow` with the mock backend over simulated cruises and
+    report the wall time, the time spent in emulated containers and the
+    orchestration overhead.
+    """
+    from macvin.ledger import connect
+
+    cruises = simulate_cruises(workdir, n_cruises, files_per_cruise)
+    os.environ.update(_mock_env(workdir, time_scale, failure_rate, stdout_lines))
+
+    # The flows read cruises.csv and excludefiles.csv from the working directory
+    cwd = Path.cwd()
+    os.chdir(workdir)
+    try:
+        from macvin.flows import macvin_run_flow
+        from macvin.trace import tracing
+
+        t0 = time.time()
+        with tracing("benchmark_flows", path=workdir / "flows.trace.json"):
+            status = macvin_run_flow(
+                silver_dir=workdir / "silver",
+                stages=stages,
+                jobs=jobs,
+                stage_jobs=stage_jobs,
+            )
+        wall = time.time() - t0
+    finally:
+        os.chdir(cwd)
+
+    with connect(workdir / "macvin_runs.sqlite") as con:
+        containers = con.execute(
+            "SELECT stage, status, end_time - start_time AS duration FROM runs "
+            "WHERE kind = 'container' AND start_time >= ?",
+            (t0,),
+        ).fetchall()
+        stage_runs = con.execute(
+            "SELECT stage, end_time - start_time AS duration FROM runs "
+            "WHERE kind = 'stage' AND start_time >= ?",
+            (t0,),
+        ).fetchall()
+
+    container_s = sum(r["duration"] or 0 for r in containers)
+    stage_s = sum(r["duration"] or 0 for r in stage_runs)
+    counts = {}
+    for s in status.values():
+        counts[s] = counts.get(s, 0) + 1
+
+    return {
+        "cruises": len(cruises),
+        "files_per_cruise": files_per_cruise,
+        "stages": stages,
+        "jobs": jobs,
+        "stage_jobs": stage_jobs,
+        "time_scale": time_scale,
+        "failure_rate": failure_rate,
+        "tasks": counts,
+        "containers": len(containers),
+        "containers_failed": sum(r["status"] == "failed" for r in containers),
+        "wall_s": wall,
+        "container_s": container_s,
+        "stage_s": stage_s,
+        # Time in stages outside the containers: views, staging, publishing, ledger
+        "stage_overhead_s": stage_s - container_s,
+        # Share of the job slots that was busy running containers
+        "utilization": container_s / (wall * jobs) if wall else None,
+    }
+
+
+# Runs macvin-run in a worker process, with the arguments after -c
+_WORKER_CODE = "import sys; sys.argv[0] = 'macvin-run'; from macvin.pipeline import run; run()"
+
+
+def benchmark_queue(
+    workdir: Path,
+    n_cruises: int,
+    files_per_cruise: int,
+    stages: str,
+    workers: int,
+    jobs: int,
+    time_scale: float,
+    lease_ttl_s: float = 10.0,
+    kill_after_s: float | None = None,
+) -> dict:
+    """
+    Run `workers` macvin-run processes on one queue with the mock backend
+    over simulated cruises, optionally killing the first worker after
+    `kill_after_s` seconds, and check in the ledger that every stage of
+    every cruise succeeded exactly once.
+    """
+    from macvin.costs import STAGE_RECORDS
+    from macvin.flows import STAGES
+    from macvin.ledger import connect
+    from macvin.scheduler import build_graph
+    from macvin.workqueue import LEASE_TTL_ENV, POLL_ENV, WorkQueue, queue_dir
+
+    cruises = simulate_cruises(workdir, n_cruises, files_per_cruise)
+    env = {**os.environ, **_mock_env(workdir, time_scale), LEASE_TTL_ENV: str(lease_ttl_s), POLL_ENV: "1"}
+    args = ["--silver-dir", str(workdir / "silver"), "--stages", stages, "--jobs", str(jobs), "--queue", "benchmark"]
+
+    t0 = time.time()
+    procs = []
+    for i in range(workers):
+        with open(workdir / f"worker-{i}.log", "w") as out:
+            procs.append(
+                subprocess.Popen(
+                    [sys.executable, "-c", _WORKER_CODE, *args],
+                    cwd=workdir,
+                    env=env,
+                    stdout=out,
+                    stderr=subprocess.STDOUT,
+                )
+            )
+    killed = False
+    if kill_after_s is not None:
+        try:
+            procs[0].wait(timeout=kill_after_s)
+        except subprocess.TimeoutExpired:
+            logger.info(f"Killing worker 0 (pid {procs[0].pid}) after {kill_after_s} s")
+            procs[0].kill()
+            killed = True
+    exit_codes = [p.wait() for p in procs]
+    wall = time.time() - t0
+
+    selected = [s.strip() for s in stages.split(",") if s.strip()]
+    graph = build_graph(cruises, selected, STAGES)
+    queue = WorkQueue(queue_dir(workdir / "silver", "benchmark"))
+    with connect(workdir / "macvin_runs.sqlite") as con:
+        rows = con.execute(
+            "SELECT cruise, stage, COUNT(*) AS n FROM runs "
+            "WHERE kind = 'stage' AND status = 'ok' AND start_time >= ? GROUP BY cruise, stage",
+            (t0,),
+        ).fetchall()
+    runs = {(r["cruise"], r["stage"]): r["n"] for r in rows}
+    # A stage taken over from a killed worker may repeat its first records,
+    # it is complete once its last record succeeded
+    duplicates = [f"{task}" for task in graph if runs.get((task.cruise, STAGE_RECORDS[task.stage][-1]), 0) > 1]
+    for task in duplicates:
+        logger.error(f"{task} succeeded more than once")
+
+    return {
+        "cruises": len(cruises),
+        "files_per_cruise": files_per_cruise,
+        "stages": stages,
+        "workers": workers,
+        "jobs": jobs,
+        "time_scale": time_scale,
+        "lease_ttl_s": lease_ttl_s,
+        "killed_worker": killed,
+        "exit_codes": exit_codes,
+        "wall_s": wall,
+        "tasks": len(graph),
+        "done": sum(queue.is_done(task) for task in graph),
+        "failed": sum(queue.is_failed(task) for task in graph),
+        "duplicates": duplicates,
+    }
+
+
+def benchmark_startup(repeat: int = 5, limit_s: float = DEFAULT_STARTUP_LIMIT_S) -> list[dict]:
+    """
+    Start a fresh interpreter that imports each console script module, which
+    is everything a dry run does before its own work, and time it. A module
+    fails when the median start time is over `limit_s` or when it imports
+    any of the HEAVY_MODULES.
+    """
+    results = []
+    with tempfile.TemporaryDirectory(prefix="macvin_startup_") as tmp:
+        for module in STARTUP_MODULES:
+            code = _STARTUP_CODE.format(module=module, heavy=HEAVY_MODULES)
+            wall, imports, heavy, error = [], [], set(), None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                # The console scripts write macvin.log to the working directory
+                out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=tmp)
+                wall.append(time.perf_counter() - t0)
+                if out.returncode != 0:
+                    error = out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit {out.returncode}"
+                    break
+                data = json.loads(out.stdout.strip().splitlines()[-1])
+                imports.append(data["import_s"])
+                heavy.update(data["heavy"])
+
+            median = statistics.median(wall)
+            results.append(
+                {
+                    "module": module,
+                    "median_s": median,
+                    "import_s": statistics.median(imports) if imports else None,
+                    "heavy": ",".join(sorted(heavy)),
+                    "ok": error is None and not heavy and median <= limit_s,
+                    "error": error,
+                }
+            )
+    return results
+
+
+def compare(old: dict, new: dict) -> list[dict]:
+    """Median times of two reports side by side, for the cases in both."""
+    def key(r):
+        return r["size"], r["dataset"], r["case"]
+
+    before = {key(r): r for r in old["results"]}
+    rows = []
+    for r in new["results"]:
+        b = before.get(key(r))
+        if b is None:
+            continue
+        old_s = b.get("median")
+        new_s = r.get("median")
+        rows.append(
+            {
+                "size": r["size"],
+                "dataset": r["dataset"],
+                "case": r["case"],
+                "old_s": old_s,
+                "new_s": new_s,
+                "ratio": new_s / old_s if old_s and new_s else None,
+            }
+        )
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MACVIN performance benchmarks on synthetic data")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="Run the benchmark suite and write a JSON report")
+    p.add_argument("--sizes", type=str, default="small,medium", help=f"Any of {', '.join(SIZES)}")
+    p.add_argument("--datasets", type=str, default=",".join(DATASETS), help=f"Any of {', '.join(DATASETS)}")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--data-dir", type=Path, default=None, help="Keep and reuse the synthetic data here")
+    p.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
+
+    p = sub.add_parser("generate", help="Write a synthetic cruise")
+    p.add_argument("output", type=Path)
+    p.add_argument("--size", type=str, default="small", help=f"Any of {', '.join(SIZES)}")
+    p.add_argument("--overlap-files", type=int, default=0)
+    p.add_argument("--missing-frequency-files", type=int, default=0)
+    p.add_argument("--seed", type=int, default=0)
+
+    p = sub.add_parser("flows", help="Benchmark macvin-run over simulated cruises with the mock backend")
+    p.add_argument("--cruises", type=int, default=200)
+    p.add_argument("--files", type=int, default=20, help="Raw files per cruise")
+    p.add_argument("--stages", type=str, default="idx,pre,atc,reports")
+    p.add_argument("--jobs", type=int, default=8)
+    p.add_argument("--stage-jobs", type=str, default="pre=4,atc=2")
+    p.add_argument("--time-scale", type=float, default=0.01, help="Scale of the emulated container run times")
+    p.add_argument("--failure-rate", type=float, default=0.0)
+    p.add_argument("--stdout-lines", type=int, default=None, help="Lines printed per container")
+    p.add_argument("--workdir", type=Path, default=None, help="Keep the simulated cruises here")
+    p.add_argument("--output-dir", type=Path, default=DEFAULT_OUTPUT_DIR)
+
+    p = sub.add_parser("queue", help="Run several macvin-run workers on one queue and check each stage ran once")
+    p.add_argument("--cruises", type=int, default=20)
+    p.add_argument("--files", type=int, default=5, help="Raw files per cruise")
+    p.add_argument("--stages", type=str, default="idx,pre,atc,reports")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--jobs", type=int, default=2, help="Parallel stages per worker")
+    p.add_argument("--time-scale", type=float, default=0.01, help="Scale of the emulated container run times")
+    p.add_argument("--lease-ttl", type=float, default=10.0, help="Seconds before the lease of a dead worker expires")
+    p.add_argument("--kill-after", type=float, default=None, help="Kill the first worker after this many seconds")
+    p.add_argument("--workdir", type=Path, default=None, help="Keep the simulated cruises here")
+
+    p = sub.add_parser("startup", help="Check that the console scripts start without heavy imports")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--limit", type=float, default=DEFAULT_STARTUP_LIMIT_S, help="Max median start time in seconds")
+
+    p = sub.add_parser("compare", help="Compare two benchmark reports")
+    p.add_argument("old", type=Path)
+    p.add_argument("new", type=Path)
+
+    args = parser.parse_args()
+    setup_logging(log_file="macvin.log")
+
+    if args.command == "run":
+        sizes = [s for s in args.sizes.split(",") if s]
+        datasets = [d for d in args.datasets.split(",") if d]
+        if args.data_dir is not None:
+            report = run_benchmarks(sizes, datasets, args.data_dir, args.repeat)
+        else:
+            with tempfile.TemporaryDirectory(prefix="macvin_benchmark_") as tmp:
+                report = run_benchmarks(sizes, datasets, Path(tmp), args.repeat)
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = args.output_dir / f"benchmark-{stamp}-{platform.node()}.json"
+        out.write_text(json.dumps(report, indent=2))
+        logger.info(f"Wrote benchmark report to {out}")
+
+    elif args.command == "flows":
+        kwargs = dict(
+            n_cruises=args.cruises,
+            files_per_cruise=args.files,
+            stages=args.stages,
+            jobs=args.jobs,
+            stage_jobs=args.stage_jobs,
+            time_scale=args.time_scale,
+            failure_rate=args.failure_rate,
+            stdout_lines=args.stdout_lines,
+        )
+        if args.workdir is not None:
+            args.workdir.mkdir(parents=True, exist_ok=True)
+            result = benchmark_flows(args.workdir.absolute(), **kwargs)
+        else:
+            with tempfile.TemporaryDirectory(prefix="macvin_flows_") as tmp:
+                result = benchmark_flows(Path(tmp), **kwargs)
+        report = {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "host": platform.node(),
+            "python": sys.version.split()[0],
+            "cpu_count": os.cpu_count(),
+            "git_commit": _git_commit(),
+            "flows": result,
+        }
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = args.output_dir / f"flows-{stamp}-{platform.node()}.json"
+        out.write_text(json.dumps(report, indent=2))
+        logger.info(json.dumps(result, indent=2))
+        logger.info(f"Wrote flow benchmark report to {out}")
+
+    elif args.command == "queue":
+        kwargs = dict(
+            n_cruises=args.cruises,
+            files_per_cruise=args.files,
+            stages=args.stages,
+            workers=args.workers,
+            jobs=args.jobs,
+            time_scale=args.time_scale,
+            lease_ttl_s=args.lease_ttl,
+            kill_after_s=args.kill_after,
+        )
+        if args.workdir is not None:
+            args.workdir.mkdir(parents=True, exist_ok=True)
+            result = benchmark_queue(args.workdir.absolute(), **kwargs)
+        else:
+            with tempfile.TemporaryDirectory(prefix="macvin_queue_") as tmp:
+                result = benchmark_queue(Path(tmp), **kwargs)
+        logger.info(json.dumps(result, indent=2))
+        if result["duplicates"] or result["done"] + result["failed"] < result["tasks"]:
+            logger.error("Stages ran more than once or were left unfinished")
+            sys.exit(1)
+
+    elif args.command == "generate":
+        spec = replace(
+            SIZES[args.size],
+            overlap_files=args.overlap_files,
+            missing_frequency_files=args.missing_frequency_files,
+            seed=args.seed,
+        )
+        make_cruise(args.output, spec)
+
+    elif args.command == "startup":
+        from macvin.ledger import _print_table
+
+        rows = benchmark_startup(args.repeat, args.limit)
+        _print_table(rows)
+        if not all(r["ok"] for r in rows):
+            logger.error(f"Console script startup over {args.limit}s or with heavy imports")
+            sys.exit(1)
+
+    elif args.command == "compare":
+        from macvin.ledger import _print_table
+
+        rows = compare(json.loads(args.old.read_text()), json.loads(args.new.read_text()))
+        _print_table(rows)
@@ -0,0 +1,352 @@
+from pathlib import Path
+from collections.abc import Iterable
+from collections import Counter
+from dataclasses import dataclass
+import logging
+import os
+import shutil
+import threading
+import time
+
+from macvin.trace import traced
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = "MACVIN_CACHE_DIR"
+CACHE_SIZE_ENV = "MACVIN_CACHE_SIZE_GB"
+DEFAULT_CACHE_SIZE_GB = 200.0
+
+_cache: "ReadCache | None" = None
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+    hit_bytes: int = 0
+    copied_bytes: int = 0
+    evicted_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        n = self.hits + self.misses + self.bypassed
+        return self.hits / n if n else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.hits} hits, {self.misses} misses, {self.bypassed} bypassed "
+            f"(hit rate {self.hit_rate:.0%}), {self.copied_bytes / 1e9:.2f} GB copied, "
+            f"{self.evicted_bytes / 1e9:.2f} GB evicted"
+        )
+
+
+class ReadCache:
+    """
+    Local disk cache for input files on the S3 mount.
+
+    Files are stored under the cache root with their full source path, e.g.
+    ``/data/s3/MACWIN-scratch/x.raw`` is cached as ``<root>/data/s3/MACWIN-scratch/x.raw``.
+    A cached file is valid as long as its size and mtime match the source.
+    The size and last use of every cached file are kept in an in-memory
+    index, read from the disk once on first use, and are used for least
+    recently used eviction when the size cap is reached. The last use is not
+    written to the files, since a cached file hardlinked to its source
+    shares its times with the source.
+    Files pinned by a live view (see `stage(pin=True)` and `unpin`) are
+    never evicted.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self.stats = CacheStats()
+        self._lock = threading.RLock()
+        self._inflight: dict[Path, threading.Event] = {}
+        self._reserved = 0
+        self._pins: Counter[Path] = Counter()
+        # Cached file -> (size, last use), None until loaded from the disk
+        self._index: dict[Path, tuple[int, float]] | None = None
+        self._used = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def cache_path(self, src: Path) -> Path:
+        return self.root / Path(src).absolute().relative_to("/")
+
+    def is_cached(self, src: Path, st: os.stat_result | None = None) -> bool:
+        st = st or os.stat(src)
+        try:
+            cst = os.stat(self.cache_path(src))
+        except FileNotFoundError:
+            return False
+        return cst.st_size == st.st_size and int(cst.st_mtime) == int(st.st_mtime)
+
+    def size(self) -> int:
+        with self._lock:
+            self._entries()
+            return self._used
+
+    def _entries(self) -> dict[Path, tuple[int, float]]:
+        """The cache index, loaded from the files left by earlier runs on first use."""
+        if self._index is None:
+            self._index = {}
+            for dirpath, _, filenames in os.walk(self.root):
+                for name in filenames:
+                    if name.startswith(".partial-"):
+                        continue
+                    p = Path(dirpath) / name
+                    try:
+                        st = p.stat()
+                    except FileNotFoundError:
+                        continue
+                    self._index[p] = (st.st_size, st.st_atime)
+            self._used = sum(size for size, _ in self._index.values())
+        return self._index
+
+    def _add(self, path: Path, size: int):
+        entries = self._entries()
+        old = entries.get(path)
+        self._used += size - (old[0] if old else 0)
+        entries[path] = (size, time.time())
+
+    def _remove(self, path: Path):
+        size, _ = self._entries().pop(path)
+        self._used -= size
+
+    def _pin(self, path: Path):
+        self._pins[path] += 1
+
+    def unpin(self, paths: Iterable[Path]):
+        """Release the pins of `stage(pin=True)` on the cached files among `paths`."""
+        with self._lock:
+            for p in paths:
+                if p in self._pins:
+                    self._pins[p] -= 1
+                    if self._pins[p] <= 0:
+                        del self._pins[p]
+
+    def _evict(self, needed: int, keep: set[Path]) -> int:
+        """Evict least recently used files until `needed` bytes fit. Returns free bytes."""
+        entries = self._entries()
+        free = self.max_bytes - self._used
+        if free >= needed:
+            return free
+        for p, (size, _) in sorted(entries.items(), key=lambda e: e[1][1]):
+            if p in keep or p in self._pins:
+                continue
+            self._remove(p)
+            free += size
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                # Removed by someone else, the space is free anyway
+                continue
+            self.stats.evicted_bytes += size
+            logger.debug(f"Evicted {p} from read cache")
+            if free >= needed:
+                break
+        return free
+
+    def _touch(self, path: Path):
+        entry = self._entries().get(path)
+        if entry is None:
+            # Cached by another process sharing the cache directory
+            try:
+                entry = (path.stat().st_size, 0.0)
+            except FileNotFoundError:
+                return
+        self._add(path, entry[0])
+
+    def _copy(
+        self,
+        src: Path,
+        dst: Path,
+        bytes_per_second: float | None = None,
+        stop: threading.Event | None = None,
+    ) -> bool:
+        """Copy src to dst atomically. Returns False if interrupted by `stop`."""
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dst.parent / f".partial-{dst.name}"
+        if bytes_per_second is None:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                # Different filesystem (the usual case for the S3 mount)
+                shutil.copy2(src, tmp)
+        elif not _throttled_copy(src, tmp, bytes_per_second, stop):
+            tmp.unlink(missing_ok=True)
+            return False
+        os.replace(tmp, dst)
+        return True
+
+    @traced(cat="io", name="cache.stage")
+    def stage(
+        self,
+        files: Iterable[Path],
+        dry_run: bool = False,
+        bytes_per_second: float | None = None,
+        stop: threading.Event | None = None,
+        pin: bool = False,
+    ) -> list[Path]:
+        """
+        Make sure the files are in the cache and return the paths to read from.
+        With `pin` the returned cached files are not evicted until they are
+        released with `unpin`, which views do while a container reads them.
+
+        Files that do not fit within the size cap, and anything that is not a
+        regular file, are returned unchanged and read from the source.
+        Copies are done outside the cache lock, so a background prefetch
+        (optionally limited to `bytes_per_second`) does not block a running
+        stage; a file that is already being copied by another thread is
+        waited for instead of being copied twice.
+        """
+        files = list(files)
+        stats = CacheStats()
+        result: list[Path] = []
+        mine: list[tuple[int, Path, int]] = []
+        others: list[tuple[int, Path, threading.Event]] = []
+
+        with self._lock:
+            todo = []
+            for src in files:
+                if not src.is_file():
+                    stats.bypassed += 1
+                    result.append(src)
+                    continue
+                st = src.stat()
+                if self.is_cached(src, st):
+                    stats.hits += 1
+                    stats.hit_bytes += st.st_size
+                    result.append(self.cache_path(src))
+                    if pin:
+                        self._pin(result[-1])
+                elif src in self._inflight:
+                    others.append((len(result), src, self._inflight[src]))
+                    result.append(src)
+                else:
+                    todo.append((len(result), src, st.st_size))
+                    result.append(src)
+
+            if todo and not dry_run:
+                keep = {p for p in result if p.is_relative_to(self.root)}
+                needed = sum(size for _, _, size in todo)
+                free = self._evict(needed + self._reserved, keep) - self._reserved
+                for i, src, size in todo:
+                    if size > free:
+                        stats.bypassed += 1
+                        continue
+                    free -= size
+                    self._reserved += size
+                    mine.append((i, src, size))
+            else:
+                stats.misses += len(todo)
+
+        for i, src, size in mine:
+            dst = self.cache_path(src)
+            # Claim the file just before copying it, so another thread that
+            # needs it earlier copies it itself instead of waiting for us
+            with self._lock:
+                event = self._inflight.get(src)
+                claimed = event is None and not self.is_cached(src)
+                if claimed:
+                    self._inflight[src] = threading.Event()
+                else:
+                    self._reserved -= size
+            if not claimed:
+                if event is not None:
+                    others.append((i, src, event))
+                else:
+                    with self._lock:
+                        if self.is_cached(src):
+                            stats.hits += 1
+                            result[i] = dst
+                            if pin:
+                                self._pin(dst)
+                continue
+            done = False
+            try:
+                done = stop is None or not stop.is_set()
+                done = done and self._copy(src, dst, bytes_per_second, stop)
+            finally:
+                with self._lock:
+                    self._reserved -= size
+                    self._inflight.pop(src).set()
+                    if done:
+                        self._add(dst, size)
+                    if done and pin:
+                        self._pin(dst)
+            if done:
+                stats.misses += 1
+                stats.copied_bytes += size
+                result[i] = dst
+            else:
+                stats.bypassed += 1
+
+        for i, src, event in others:
+            event.wait()
+            with self._lock:
+                if self.is_cached(src):
+                    stats.hits += 1
+                    result[i] = self.cache_path(src)
+                    if pin:
+                        self._pin(result[i])
+                else:
+                    stats.bypassed += 1
+
+        with self._lock:
+            if not dry_run:
+                for p in result:
+                    if p.is_relative_to(self.root):
+                        self._touch(p)
+
+            self.stats.hits += stats.hits
+            self.stats.misses += stats.misses
+            self.stats.bypassed += stats.bypassed
+            self.stats.hit_bytes += stats.hit_bytes
+            self.stats.copied_bytes += stats.copied_bytes
+
+        logger.info(f"Read cache {self.root}: {stats} (session: {self.stats})")
+        return result
+
+
+def _throttled_copy(
+    src: Path,
+    dst: Path,
+    bytes_per_second: float,
+    stop: threading.Event | None = None,
+    chunk_size: int = 4 * 1024 * 1024,
+) -> bool:
+    """Copy a file in chunks without exceeding `bytes_per_second` on average."""
+    t0 = time.monotonic()
+    copied = 0
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        while chunk := fin.read(chunk_size):
+            if stop is not None and stop.is_set():
+                return False
+            fout.write(chunk)
+            copied += len(chunk)
+            ahead = copied / bytes_per_second - (time.monotonic() - t0)
+            if ahead > 0:
+                time.sleep(ahead)
+    shutil.copystat(src, dst)
+    return True
+
+
+def get_cache() -> ReadCache | None:
+    """
+    Return the read cache configured by the environment, or None if disabled.
+
+    MACVIN_CACHE_DIR      Local directory for the cache (enables the cache)
+    MACVIN_CACHE_SIZE_GB  Size cap in GB (default 200)
+    """
+    global _cache
+    root = os.getenv(CACHE_DIR_ENV)
+    if not root:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.root != Path(root):
+            size_gb = float(os.getenv(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE_GB))
+            _cache = ReadCache(Path(root), int(size_gb * 1e9))
+            logger.info(f"Read cache enabled at {root} with {size_gb} GB size cap")
+    return _cache
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+from pathlib import Path
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass, field, replace
+from typing import TYPE_CHECKING
+import csv
+import logging
+import os
+import threading
+
+from macvin.exclusions import ExclusionIndex, ExclusionMatcher, cruise_code, load_exclusions
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CRUISES = Path("cruises.csv")
+SILVER_ROOT = Path("/data/s3/MACWIN-scratch/silver")
+
+# Values of the status column of cruises that are not processed again
+DONE_STATUSES = ("OK", "FAIL")
+
+_cache: dict[tuple[Path, Path], tuple[int, Catalog]] = {}
+_ledger_cache: dict[str, tuple[tuple, dict]] = {}
+
+
+def silver_path(silver_root: Path, cruise: str) -> Path:
+    """The silver directory of a cruise, e.g. <silver_root>/S2005114_PGOSARS_4174/ACOUSTIC/EK."""
+    return Path(silver_root) / cruise / Path("ACOUSTIC", "EK")
+
+
+@dataclass(frozen=True)
+class Cruise:
+    """One row of cruises.csv."""
+
+    name: str
+    status: str | None
+    raw_dir: Path
+    original_dir: Path
+    silver_root: Path = SILVER_ROOT
+    extra: dict[str, str] = field(default_factory=dict, compare=False, hash=False)
+
+    @property
+    def code(self) -> str:
+        return cruise_code(self.name)
+
+    @property
+    def rerun(self) -> bool:
+        """Whether the cruise is processed, i.e. not marked OK or FAIL."""
+        return self.status not in DONE_STATUSES
+
+    @property
+    def silver_dir(self) -> Path:
+        return silver_path(self.silver_root, self.name)
+
+    @property
+    def paths(self) -> dict:
+        """The silver paths of the cruise, see `macvin.flows.get_paths`."""
+        from macvin.flows import get_paths
+
+        return get_paths(self.silver_dir)
+
+    def row(self) -> dict[str, str]:
+        """The cruise as the row of cruises.csv it was read from."""
+        return {
+            "cruise": self.name,
+            "status": self.status or "",
+            "RAW_files": str(self.raw_dir),
+            "Original_RAW_files": str(self.original_dir),
+            **self.extra,
+        }
+
+
+@dataclass
+class CruiseInfo:
+    """Metadata derived from the files of a cruise, see `Catalog.info`."""
+
+    raw_files: int = 0
+    raw_bytes: int = 0
+    start: str | None = None
+    end: str | None = None
+    pings: int = 0
+    broken_files: int = 0
+    last_stage: str | None = None
+    last_stage_time: float | None = None
+
+
+class Catalog:
+    """
+    The cruises of cruises.csv by name, in file order.
+
+    Metadata derived from the files of a cruise (`info`) is computed on first
+    use and kept until the raw directory or the raw index changes. The last
+    stage comes from the run ledger and is read on every call.
+    """
+
+    def __init__(self, cruises: Iterable[Cruise], path: Path = CRUISES):
+        self.path = path
+        self.cruises = {c.name: c for c in cruises}
+        self._info: dict[str, tuple[tuple, CruiseInfo]] = {}
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[Cruise]:
+        return iter(self.cruises.values())
+
+    def __len__(self) -> int:
+        return len(self.cruises)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.cruises
+
+    def __getitem__(self, name: str) -> Cruise:
+        try:
+            return self.cruises[name]
+        except KeyError:
+            raise ValueError(f"cruise '{name}' not found in {self.path}") from None
+
+    @property
+    def exclusions(self) -> ExclusionIndex:
+        return load_exclusions()
+
+    def exclusions_for(self, name: str) -> ExclusionMatcher:
+        return self.exclusions.for_cruise(name)
+
+    def select(self, cruise: str | None = None) -> list[Cruise]:
+        """
+        The cruises in a comma separated list, in catalog order, or all
+        cruises for None. Raises ValueError for names not in the catalog.
+        """
+        if not cruise:
+            return list(self)
+        names = [c.strip() for c in cruise.split(",") if c.strip()]
+        missing = sorted(set(names) - set(self.cruises))
+        if missing:
+            raise ValueError(f"cruise(s) {missing} not found in {self.path}")
+        return [c for c in self if c.name in names]
+
+    def frame(self, cruise: str | None = None) -> pd.DataFrame:
+        """The selected cruises as a DataFrame with the columns of cruises.csv."""
+        import pandas as pd
+
+        return pd.DataFrame([c.row() for c in self.select(cruise)])
+
+    def info(self, name: str) -> CruiseInfo:
+        """Raw file counts and bytes, time span from the raw index, and the last successful stage."""
+        cruise = self[name]
+        raw_index = cruise.paths["raw_index"]
+        state = (_mtime_ns(cruise.raw_dir), _mtime_ns(raw_index))
+        with self._lock:
+            cached = self._info.get(name)
+        if cached is not None and cached[0] == state:
+            return self._with_last_stage(name, cached[1])
+
+        info = CruiseInfo()
+        try:
+            with os.scandir(cruise.raw_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".raw") and entry.is_file():
+                        info.raw_files += 1
+                        info.raw_bytes += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+
+        from macvin.rawscan import load_raw_index
+
+        index = load_raw_index(raw_index)
+        scans = [s for s in index.values() if not s.broken and s.start]
+        if scans:
+            info.start = min(s.start for s in scans)
+            info.end = max(s.end for s in scans)
+            info.pings = sum(s.ping_count for s in scans)
+        info.broken_files = sum(s.broken for s in index.values())
+
+        with self._lock:
+            self._info[name] = (state, info)
+        return self._with_last_stage(name, info)
+
+    @staticmethod
+    def _with_last_stage(name: str, info: CruiseInfo) -> CruiseInfo:
+        last_stage, last_stage_time = _last_stages().get(name, (None, None))
+        return replace(info, last_stage=last_stage, last_stage_time=last_stage_time)
+
+
+def _mtime_ns(path: Path) -> int | None:
+    try:
+        return Path(path).stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _file_state(path: Path) -> tuple[int, int] | None:
+    try:
+        st = Path(path).stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _last_stages() -> dict[str, tuple[str, float]]:
+    """
+    The last successful stage and its end time per cruise from the run
+    ledger, if there is one. Read again when the ledger or its write-ahead
+    log changes.
+    """
+    from macvin.ledger import connect, last_stages, ledger_path
+
+    path = ledger_path()
+    # Every commit appends to the write-ahead log, so its size changes even
+    # when two commits fall in the same mtime tick
+    state = (path, _file_state(path), _file_state(path.with_name(path.name + "-wal")))
+    if state[1] is None:
+        return {}
+    cached = _ledger_cache.get("last_stages")
+    if cached is not None and cached[0] == state:
+        return cached[1]
+    con = connect()
+    try:
+        stages = last_stages(con)
+    finally:
+        con.close()
+    _ledger_cache["last_stages"] = (state, stages)
+    return stages
+
+
+def load_catalog(path: Path | str = CRUISES, silver_root: Path | str = SILVER_ROOT) -> Catalog:
+    """
+    Load cruises.csv as a Catalog with the silver directories under
+    `silver_root`. The catalog is cached and only read again when the file
+    changes.
+    """
+    path = Path(path).resolve()
+    silver_root = Path(silver_root)
+    mtime = path.stat().st_mtime_ns
+
+    key = (path, silver_root)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, newline="") as fid:
+        cruises = []
+        for row in csv.DictReader(fid):
+            row = {k: (v or "").strip() for k, v in row.items()}
+            name = row.pop("cruise")
+            cruises.append(
+                Cruise(
+                    name=name,
+                    status=row.pop("status", "") or None,
+                    raw_dir=Path(row.pop("RAW_files")),
+                    original_dir=Path(row.pop("Original_RAW_files", "")),
+                    silver_root=silver_root,
+                    extra=row,
+                )
+            )
+    catalog = Catalog(cruises, path)
+    logger.debug(f"Loaded {len(catalog)} cruises from {path}")
+    _cache[key] = (mtime, catalog)
+    return catalog
@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Mapping
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+import statistics
+
+from macvin.scheduler import Task, bottom_levels, simulate_graph
+
+logger = logging.getLogger(__name__)
+
+# Stage runs in the ledger that make up each stage of macvin-run
+STAGE_RECORDS = {
+    "ek500": ("ek500conversion",),
+    "idx": ("korona_fixidx",),
+    "pre": ("korona_noisefiltering", "korona_preprocessing"),
+    "pre2zarr": ("preprocess2zarr",),
+    "stats": ("sv_stats",),
+    "atc": ("mackerel_korneliussen2016",),
+    "atc2zarr": ("atc2zarr",),
+    "align": ("align_labels",),
+    "reports": ("sv_echo_integrator",),
+    "luf": ("lufreports",),
+}
+
+# Used for stages without history, so cruises are still ordered by size
+DEFAULT_S_PER_GB = 60.0
+# Runs needed to fit a per stage overhead as well as a rate
+MIN_FIT_RUNS = 3
+
+
+@dataclass
+class StageCost:
+    """
+    Duration of a stage as overhead plus seconds per GB of its input, and
+    the input bytes of the stage per byte of raw data of the cruise.
+    """
+
+    stage: str
+    s_per_gb: float = DEFAULT_S_PER_GB
+    overhead_s: float = 0.0
+    input_ratio: float = 1.0
+    runs: int = 0
+
+    def estimate(self, raw_bytes: int) -> float:
+        return self.overhead_s + self.s_per_gb * self.input_ratio * raw_bytes / 1e9
+
+
+@dataclass
+class RunPlan:
+    durations: dict[Task, float]
+    priority: dict[Task, float]
+    schedule: dict[Task, tuple[float, float]]
+    costs: dict[str, StageCost] = field(default_factory=dict)
+
+    @property
+    def makespan_s(self) -> float:
+        return max((end for _, end in self.schedule.values()), default=0.0)
+
+
+def stage_durations(con: sqlite3.Connection) -> dict[tuple[str, str], tuple[float, int]]:
+    """
+    Duration and input bytes of every stage of macvin-run per cruise, summed
+    over the latest successful ledger run of each of its records and output
+    directories (e.g. one per report). Runs without input files did no work,
+    e.g. a resumed stage with every file already done, and are left out.
+    """
+    rows = con.execute(
+        """
+        SELECT cruise, stage, end_time - start_time AS duration, input_bytes, MAX(start_time)
+        FROM runs
+        WHERE kind = 'stage' AND status = 'ok' AND dry_run = 0 AND end_time IS NOT NULL
+              AND input_files > 0
+        GROUP BY cruise, stage, output_dir
+        """
+    ).fetchall()
+    stage_of = {record: stage for stage, records in STAGE_RECORDS.items() for record in records}
+    durations: dict[tuple[str, str], tuple[float, int]] = {}
+    for row in rows:
+        stage = stage_of.get(row["stage"])
+        if stage is not None and row["cruise"]:
+            key = (row["cruise"], stage)
+            seconds, nbytes = durations.get(key, (0.0, 0))
+            durations[key] = (seconds + row["duration"], nbytes + (row["input_bytes"] or 0))
+    return durations
+
+
+def fit_costs(
+    durations: Mapping[tuple[str, str], tuple[float, int]], sizes: Mapping[str, int]
+) -> dict[str, StageCost]:
+    """
+    Fit a StageCost per stage to past durations and input bytes. With enough
+    runs of different sizes the overhead and rate are fitted by least
+    squares, otherwise the rate is the median seconds per GB. The input ratio
+    is the median input bytes per raw byte of the cruises in `sizes`.
+    """
+    points: dict[str, list[tuple[float, float]]] = {}
+    ratios: dict[str, list[float]] = {}
+    for (cruise, stage), (seconds, nbytes) in durations.items():
+        points.setdefault(stage, []).append((nbytes / 1e9, seconds))
+        if nbytes and sizes.get(cruise):
+            ratios.setdefault(stage, []).append(nbytes / sizes[cruise])
+
+    costs = {}
+    for stage, pts in points.items():
+        sized = [(gb, s) for gb, s in pts if gb > 0]
+        cost = StageCost(stage, runs=len(pts))
+        if stage in ratios:
+            cost.input_ratio = statistics.median(ratios[stage])
+        if not sized:
+            cost.s_per_gb = 0.0
+            cost.overhead_s = statistics.median(s for _, s in pts)
+        elif len(sized) >= MIN_FIT_RUNS and len({gb for gb, _ in sized}) > 1:
+            fit = statistics.linear_regression([gb for gb, _ in sized], [s for _, s in sized])
+            if fit.slope > 0 and fit.intercept >= 0:
+                cost.s_per_gb, cost.overhead_s = fit.slope, fit.intercept
+            else:
+                cost.s_per_gb = sum(s for _, s in sized) / sum(gb for gb, _ in sized)
+        else:
+            cost.s_per_gb = statistics.median(s / gb for gb, s in sized)
+        costs[stage] = cost
+    return costs
+
+
+def load_costs(size_of: Callable[[str], int], con: sqlite3.Connection | None = None) -> dict[str, StageCost]:
+    """Stage costs fitted to the run ledger, empty if there is no ledger yet."""
+    from macvin.ledger import connect, ledger_path
+
+    if con is not None:
+        durations = stage_durations(con)
+    elif ledger_path().exists():
+        con = connect()
+        try:
+            durations = stage_durations(con)
+        finally:
+            con.close()
+    else:
+        return {}
+    sizes = {cruise: size_of(cruise) for cruise, _ in durations}
+    return fit_costs(durations, sizes)
+
+
+def plan_run(
+    graph: Mapping[Task, set[Task]],
+    size_of: Callable[[str], int],
+    costs: Mapping[str, StageCost],
+    jobs: int = 1,
+    limits: Mapping[str, int] | None = None,
+) -> RunPlan:
+    """
+    Estimate the duration of every task from the raw bytes of its cruise,
+    order the tasks longest remaining path first, and simulate the run to
+    get the start and end time of every task.
+    """
+    sizes = {task.cruise: size_of(task.cruise) for task in graph}
+    durations = {
+        task: costs.get(task.stage, StageCost(task.stage)).estimate(sizes[task.cruise]) for task in graph
+    }
+    priority = bottom_levels(graph, durations)
+    schedule = simulate_graph(graph, durations, jobs=jobs, limits=limits, priority=priority)
+    return RunPlan(durations, priority, schedule, dict(costs))
+
+
+def log_plan(plan: RunPlan, tasks: bool = False):
+    """Log the stage costs and the ETA of a plan, and with `tasks` the schedule of every task."""
+    for stage in sorted({task.stage for task in plan.durations}):
+        cost = plan.costs.get(stage)
+        if cost is None:
+            logger.info(f"{stage:10s} no history, assuming {DEFAULT_S_PER_GB:.0f} s/GB")
+        else:
+            logger.info(
+                f"{stage:10s} {cost.runs} past runs, {cost.s_per_gb:.1f} s/GB + {cost.overhead_s:.0f} s, "
+                f"input {cost.input_ratio:.2f} x raw"
+            )
+    if tasks:
+        for task, (start, end) in sorted(plan.schedule.items(), key=lambda item: item[1]):
+            logger.info(f"{task.cruise:40s} {task.stage:10s} {_hm(start)} -> {_hm(end)}")
+    makespan = plan.makespan_s
+    eta = datetime.now() + timedelta(seconds=makespan)
+    logger.info(f"Estimated run time {_hm(makespan)} for {len(plan.durations)} stages, ETA {eta:%Y-%m-%d %H:%M}")
+
+
+def _hm(seconds: float) -> str:
+    minutes = round(seconds / 60)
+    return f"{minutes // 60:d}:{minutes % 60:02d}"
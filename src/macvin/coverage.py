@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+from pathlib import Path
+from dataclasses import dataclass, field
+from functools import lru_cache
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Files whose ping times are kept in memory, a few cruises of sv and labels files
+PING_CACHE_FILES = 1024
+
+
+@dataclass(frozen=True)
+class PingRange:
+    """A run of consecutive pings of one file that has no match in the other product."""
+
+    file: str
+    start: np.datetime64
+    end: np.datetime64
+    count: int
+
+    def __str__(self) -> str:
+        return f"{self.file}: {self.count} pings {self.start} .. {self.end}"
+
+
+@dataclass
+class CoverageDiff:
+    """Pings of the sv files without labels (missing) and labels without sv (extra)."""
+
+    sv_pings: int
+    labels_pings: int
+    missing: list[PingRange] = field(default_factory=list)
+    extra: list[PingRange] = field(default_factory=list)
+    sv_duplicates: int = 0
+    labels_duplicates: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not self.missing and not self.extra
+
+    @property
+    def n_missing(self) -> int:
+        return sum(r.count for r in self.missing)
+
+    @property
+    def n_extra(self) -> int:
+        return sum(r.count for r in self.extra)
+
+
+@lru_cache(maxsize=PING_CACHE_FILES)
+def _ping_times(path: str, size: int, mtime_ns: int, time_name: str) -> np.ndarray:
+    import xarray as xr
+
+    # Only the coordinate is read, the data variables stay lazy
+    with xr.open_dataset(path, decode_times=True, chunks={}) as ds:
+        return ds[time_name].values.astype("datetime64[ns]")
+
+
+def ping_times(nc_file: Path, time_name: str = "ping_time") -> np.ndarray:
+    """The ping times of a NetCDF file, cached for the last PING_CACHE_FILES files until the file changes."""
+    st = Path(nc_file).stat()
+    return _ping_times(str(nc_file), st.st_size, st.st_mtime_ns, time_name)
+
+
+def ping_index(files: list[Path], time_name: str = "ping_time") -> tuple[np.ndarray, np.ndarray]:
+    """The ping times of all files in file order, and the index of the file of every ping."""
+    times = [ping_times(f, time_name) for f in files]
+    if not times:
+        return np.array([], dtype="datetime64[ns]"), np.array([], dtype=np.int64)
+    file_ids = np.concatenate([np.full(len(t), i, dtype=np.int64) for i, t in enumerate(times)])
+    return np.concatenate(times), file_ids
+
+
+def _matched(times: np.ndarray, other: np.ndarray, tolerance: np.timedelta64) -> np.ndarray:
+    """For every time, whether `other` has a time within the tolerance."""
+    if len(other) == 0:
+        return np.zeros(len(times), dtype=bool)
+    ref = np.sort(other).view(np.int64)
+    t = times.view(np.int64)
+    i = np.searchsorted(ref, t)
+    right = ref[np.minimum(i, len(ref) - 1)]
+    left = ref[np.maximum(i - 1, 0)]
+    nearest = np.minimum(np.abs(right - t), np.abs(left - t))
+    return nearest <= tolerance.astype("timedelta64[ns]").astype(np.int64)
+
+
+def _runs(times: np.ndarray, file_ids: np.ndarray, unmatched: np.ndarray, files: list[Path]) -> list[PingRange]:
+    """Consecutive unmatched pings, split at file boundaries."""
+    idx = np.flatnonzero(unmatched)
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero((np.diff(idx) != 1) | (np.diff(file_ids[idx]) != 0)) + 1
+    ranges = []
+    for run in np.split(idx, breaks):
+        ranges.append(
+            PingRange(
+                file=files[file_ids[run[0]]].name,
+                start=times[run[0]],
+                end=times[run[-1]],
+                count=len(run),
+            )
+        )
+    return ranges
+
+
+def coverage_diff(
+    sv_files: list[Path],
+    labels_files: list[Path],
+    tolerance: np.timedelta64 = np.timedelta64(0, "ns"),
+) -> CoverageDiff:
+    """
+    Compare the ping_time coverage of sv and labels files. Only the ping
+    times are read, so the diff is found without loading any data.
+    """
+    sv_times, sv_ids = ping_index(sv_files)
+    labels_times, labels_ids = ping_index(labels_files)
+
+    missing = ~_matched(sv_times, labels_times, tolerance)
+    extra = ~_matched(labels_times, sv_times, tolerance)
+    return CoverageDiff(
+        sv_pings=len(sv_times),
+        labels_pings=len(labels_times),
+        missing=_runs(sv_times, sv_ids, missing, sv_files),
+        extra=_runs(labels_times, labels_ids, extra, labels_files),
+        sv_duplicates=len(sv_times) - len(np.unique(sv_times)),
+        labels_duplicates=len(labels_times) - len(np.unique(labels_times)),
+    )
@@ -0,0 +1,157 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections.abc import Sequence
+from contextvars import copy_context
+from dataclasses import dataclass
+import logging
+import math
+import os
+import subprocess
+import time
+
+from macvin.ledger import dir_usage
+from macvin.resources import available_memory
+from macvin.views import make_view, release_view
+from macvin.workqueue import lease_lost
+
+logger = logging.getLogger(__name__)
+
+MAX_PARALLEL_ENV = "MACVIN_EK500_MAX_PARALLEL"
+PROCESSES_ENV = "MACVIN_EK500_PROCESSES"
+
+# Korona workers per KoronaCli process. Each process is a JVM, so a few
+# processes with several workers each beat many single worker processes.
+MAX_WORKERS_PER_PROCESS = 8
+# Memory estimate per Korona worker: a fixed overhead plus a multiple of the
+# size of the largest file
+WORKER_BASE_MEMORY = 1024**3
+WORKER_FILE_MEMORY_FACTOR = 4
+# Batches per process, more batches give finer progress reports and balance
+# the processes better
+BATCHES_PER_PROCESS = 4
+
+
+@dataclass
+class ConversionPlan:
+    processes: int
+    max_parallel: int
+    batches: list[list[Path]]
+
+
+def _size(path: Path) -> int:
+    if path.is_dir():
+        return dir_usage(path)[1]
+    return path.stat().st_size
+
+
+def plan_conversion(
+    files: Sequence[Path],
+    cores: int | None = None,
+    memory_bytes: int | None = None,
+) -> ConversionPlan:
+    """
+    Pick the number of KoronaCli processes, the `--max-parallel` of each and
+    split `files` into batches of about equal size.
+
+    The number of workers is limited by the cores (one is left for the
+    system), by the memory per worker estimated from the largest file, and by
+    the number of files. MACVIN_EK500_MAX_PARALLEL and MACVIN_EK500_PROCESSES
+    override the choice.
+    """
+    cores = cores or os.cpu_count() or 1
+    if memory_bytes is None:
+        memory_bytes = available_memory()
+
+    sizes = {f: _size(f) for f in files}
+    largest = max(sizes.values(), default=0)
+
+    workers = max(cores - 1, 1)
+    if memory_bytes:
+        per_worker = WORKER_BASE_MEMORY + WORKER_FILE_MEMORY_FACTOR * largest
+        workers = min(workers, max(memory_bytes // per_worker, 1))
+    workers = max(min(workers, len(files)), 1)
+
+    processes = int(os.getenv(PROCESSES_ENV, 0)) or math.ceil(workers / MAX_WORKERS_PER_PROCESS)
+    max_parallel = int(os.getenv(MAX_PARALLEL_ENV, 0)) or math.ceil(workers / processes)
+
+    # A batch should keep its process busy
+    n_batches = min(processes * BATCHES_PER_PROCESS, math.ceil(len(files) / max_parallel))
+    n_batches = max(n_batches, 1)
+
+    # Largest files first into the batch with the least data
+    batches: list[list[Path]] = [[] for _ in range(n_batches)]
+    totals = [0] * n_batches
+    for f in sorted(files, key=lambda f: sizes[f], reverse=True):
+        i = totals.index(min(totals))
+        batches[i].append(f)
+        totals[i] += sizes[f]
+
+    return ConversionPlan(
+        processes=processes,
+        max_parallel=max_parallel,
+        batches=[sorted(b) for b in batches if b],
+    )
+
+
+def convert(
+    korona: Path,
+    files: Sequence[Path],
+    destination: Path,
+    dry_run: bool = False,
+) -> ConversionPlan:
+    """
+    Convert EK500 files with `KoronaCli.sh batch`, in batches run by several
+    concurrent KoronaCli processes. Raises CalledProcessError if a batch fails,
+    after the other batches have finished.
+    """
+    plan = plan_conversion(files)
+    total_bytes = sum(_size(f) for f in files)
+    logger.info(
+        f"Converting {len(files)} files ({total_bytes / 1e9:.2f} GB) in {len(plan.batches)} batches, "
+        f"{plan.processes} KoronaCli processes with --max-parallel {plan.max_parallel}"
+    )
+
+    def _run_batch(batch: list[Path]) -> int:
+        if lease_lost():
+            raise RuntimeError("Not converting the batch, the lease of the unit was lost")
+        view = make_view(batch, prefix="macvin_ek500_")
+        try:
+            cmd = [
+                str(korona),
+                "batch",
+                "--max-parallel", str(plan.max_parallel),
+                "--destination", str(destination),
+                "--source", view.name,
+            ]
+            logger.info("Running: %s", " ".join(cmd))
+            if not dry_run:
+                subprocess.run(cmd, check=True)
+        finally:
+            release_view(view)
+        return sum(_size(f) for f in batch)
+
+    t0 = time.time()
+    done_bytes = 0
+    failed = None
+    with ThreadPoolExecutor(max_workers=plan.processes) as pool:
+        # In the context of the stage, so the batches see a lost queue lease
+        futures = {pool.submit(copy_context().run, _run_batch, b): i for i, b in enumerate(plan.batches, 1)}
+        for n, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                done_bytes += future.result()
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Batch {i} failed with exit code {e.returncode}")
+                failed = failed or e
+                continue
+            elapsed = time.time() - t0
+            eta = elapsed / done_bytes * (total_bytes - done_bytes) if done_bytes else 0
+            logger.info(
+                f"Batch {i} done ({n}/{len(plan.batches)}, "
+                f"{done_bytes / 1e9:.2f}/{total_bytes / 1e9:.2f} GB, "
+                f"{elapsed / 60:.1f} min elapsed, ETA {eta / 60:.1f} min)"
+            )
+
+    if failed is not None:
+        raise failed
+    return plan
@@ -0,0 +1,124 @@
+from pathlib import Path
+import csv
+import logging
+import re
+from fnmatch import translate
+from collections.abc import Iterable
+
+logger = logging.getLogger(__name__)
+
+EXCLUDEFILES = Path("excludefiles.csv")
+
+# Cruise codes as they appear in file names, e.g. S2000012 or S1513S
+_CRUISE_TOKEN = re.compile(r"S\d{4}[0-9A-Z]*")
+
+_cache: dict[Path, tuple[float, "ExclusionIndex"]] = {}
+
+
+def cruise_code(cruise: str) -> str:
+    """Return the cruise code used in file names, e.g. S2000012 for S2000012_PGOSARS_1024."""
+    return cruise.split("_")[0]
+
+
+class ExclusionMatcher:
+    """
+    A set of fnmatch patterns compiled into a single regular expression.
+
+    Matching a file name costs one regex search instead of one fnmatch call
+    per pattern.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.patterns = tuple(sorted(set(patterns)))
+        if self.patterns:
+            self._regex = re.compile("|".join(translate(p) for p in self.patterns))
+        else:
+            self._regex = None
+
+    def __bool__(self) -> bool:
+        return self._regex is not None
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def excluded(self, name: str) -> bool:
+        return self._regex is not None and self._regex.match(name) is not None
+
+    def split(self, files: Iterable[Path]) -> tuple[list[Path], list[Path]]:
+        """Split files into (allowed, excluded) based on the file name."""
+        allowed, excluded = [], []
+        for f in files:
+            (excluded if self.excluded(f.name) else allowed).append(f)
+        return allowed, excluded
+
+
+class ExclusionIndex:
+    """
+    Exclusion patterns indexed per cruise.
+
+    Patterns that contain a cruise code (e.g. ``N058-S015-S2000012-*``) only
+    apply to that cruise, patterns without a cruise code apply to all cruises.
+    """
+
+    def __init__(self, patterns: Iterable[str] = ()):
+        self.patterns = tuple(sorted(set(patterns)))
+        self.by_code: dict[str, list[str]] = {}
+        self.common: list[str] = []
+        for pat in self.patterns:
+            codes = {
+                tok for tok in re.split(r"[-_./]", pat) if _CRUISE_TOKEN.fullmatch(tok)
+            }
+            if codes:
+                for code in codes:
+                    self.by_code.setdefault(code, []).append(pat)
+            else:
+                self.common.append(pat)
+        self._matchers: dict[str | None, ExclusionMatcher] = {}
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def for_cruise(self, cruise: str | None) -> ExclusionMatcher:
+        """Return the compiled matcher for a cruise (all patterns if cruise is None)."""
+        key = None if cruise is None else cruise_code(cruise)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            if key is None:
+                matcher = ExclusionMatcher(self.patterns)
+            else:
+                matcher = ExclusionMatcher(self.by_code.get(key, []) + self.common)
+            self._matchers[key] = matcher
+        return matcher
+
+    def excluded(self, name: str, cruise: str | None = None) -> bool:
+        return self.for_cruise(cruise).excluded(name)
+
+
+def load_exclusions(path: Path | str = EXCLUDEFILES) -> ExclusionIndex:
+    """
+    Load and compile excludefiles.csv.
+
+    The compiled index is cached and only rebuilt when the file changes.
+    A missing file gives an empty index.
+    """
+    path = Path(path).resolve()
+    try:
+        mtime = path.stat().st_mtime
+    except FileNotFoundError:
+        logger.warning(f"{path} not found, no files are excluded")
+        return ExclusionIndex()
+
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, newline="") as fid:
+        patterns = [
+            row["excluded_files"].strip()
+            for row in csv.DictReader(fid)
+            if row.get("excluded_files") and row["excluded_files"].strip()
+        ]
+    index = ExclusionIndex(patterns)
+    logger.debug(f"Compiled {len(index)} exclusion patterns from {path}")
+    _cache[path] = (mtime, index)
+    return index
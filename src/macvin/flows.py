@@ -1,4 +1,7 @@
+from __future__ import annotations
+
 from pathlib import Path
+from typing import TYPE_CHECKING
 from macvin.tasks import (
     korona_noisefiltering,
     korona_preprocessing,
@@ -9,25 +12,45 @@ from macvin.tasks import (
     atc2zarr,
     preprocess2zarr,
 )
-import pandas as pd
+from macvin.align import align_labels
+from macvin.catalog import Cruise, load_catalog, silver_path
+from macvin.costs import load_costs, log_plan, plan_run
+from macvin.exclusions import ExclusionIndex, load_exclusions
+from macvin.idx import FIXED_IDX_NAME, link_or_copy, plan_fixidx
+from macvin.ledger import dir_usage, record_stage
+from macvin.prefetch import Prefetcher
+from macvin.publish import marker_time, staged_output
+from macvin.rawscan import broken_keys, load_raw_index, update_raw_index
+from macvin.references import build_references, reference_path
+from macvin.resume import file_key, produced_keys
+from macvin.trace import span, traced
+from macvin.scheduler import Task, build_graph, parse_limits, run_graph
+from macvin.svstats import update_sv_stats
+from macvin.views import filtered_view, list_files
+from macvin.workqueue import WorkQueue, queue_dir, run_queue
+from macvin import ek500
 import logging
 import platform
 import os
-import subprocess
-import tempfile
-from fnmatch import fnmatch
+import time
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+BASEDIR = Path("/data/s3/MACWIN-scratch")
+
 # ------------------
 # Helper functions
 # ------------------
 
 
-
 def get_paths(silver_dir: Path) -> dict:
     dat = {}
     dat["idxdata"] = silver_dir / Path("EK_RAWDATA", "korona_fixidx")
+    # Datagram scan of the raw files, see macvin.rawscan
+    dat["raw_index"] = silver_dir / Path("EK_RAWDATA", "raw_index.json")
 
     dat["preprocessing"] = {
         "noisefiltering": silver_dir / Path("PREPROCESSING", "korona_noisefiltering", "sv_nc"),
@@ -46,6 +69,14 @@ def get_paths(silver_dir: Path) -> dict:
         "labels_nc",
     )
 
+    # Labels reindexed onto the ping_time grid of the noise filtered sv files
+    dat["target_classification_aligned"] = silver_dir / Path(
+        "TARGET_CLASSIFICATION",
+        "korona_noisefiltering",
+        "mackerel_korneliussen2016",
+        "labels_aligned_nc",
+    )
+
     dat["target_classification_zarr"] = silver_dir / Path(
         "TARGET_CLASSIFICATION",
         "korona_noisefiltering",
@@ -53,6 +84,10 @@ def get_paths(silver_dir: Path) -> dict:
         "labels_zarr",
     )
 
+    # Kerchunk reference indexes to open the nc directories lazily
+    dat["preprocessing_refs"] = {k: reference_path(v) for k, v in dat["preprocessing"].items()}
+    dat["target_classification_refs"] = reference_path(dat["target_classification"])
+
     dat["quality_control"] = silver_dir / Path(
         "QUALITY_CONTROL", "korona_datacompression"
     )
@@ -61,6 +96,11 @@ def get_paths(silver_dir: Path) -> dict:
         "QUALITY_CONTROL", "sv_histograms"
     )
 
+    # Per file and frequency Sv statistics, one Parquet table per preprocessing
+    dat["sv_stats"] = silver_dir / Path(
+        "QUALITY_CONTROL", "sv_stats"
+    )
+
     dat["bottom_detection"] = silver_dir
 
     dat["reports"] = {
@@ -114,7 +154,7 @@ def luf_parameters():
     return par
 
 
-def get_survey(cruise: str | None = None) -> tuple[pd.DataFrame, set]:
+def get_survey(cruise: str | None = None) -> tuple[pd.DataFrame, ExclusionIndex]:
     """
     Load the cruises table and optionally filter by cruise name.
 
@@ -126,69 +166,45 @@ def get_survey(cruise: str | None = None) -> tuple[pd.DataFrame, set]:
         ValueError: If a cruise string is given that does not appear in the CSV.
 
     Returns:
-        A pandas DataFrame containing matching rows.
+        A pandas DataFrame containing matching rows and the compiled
+        exclusion index from excludefiles.csv. The flows use the cached
+        catalog (see `macvin.catalog.load_catalog`) instead.
     """
-    df = pd.read_csv("cruises.csv")
-    exclude_files = set(pd.read_csv("excludefiles.csv")['excluded_files'])
-    
-    if cruise is not None:
-        # Check existence first
-        if cruise not in df["cruise"].values:
-            raise ValueError(f"cruise '{cruise}' not found in cruises.csv")
-
-        # Then filter
-        df = df[df["cruise"] == cruise]
-
-    return df, exclude_files
+    catalog = load_catalog()
+    return catalog.frame(cruise), catalog.exclusions
 
 
-def _make_filtered_source_dir(
-    source_dir: Path,
-    exclude_names: set[str],
-    pattern: str = "*",
-    link_mode: str = "symlink",  # "symlink" or "hardlink" or "copy"
-) -> Path:
+def stage_inputs(cruise: Cruise, stage: str) -> list[Path]:
     """
-    Create a temporary directory containing only links (or copies) to allowed files.
-    Returns the temp dir Path. Caller must keep the TemporaryDirectory alive.
+    Return the input directories a stage reads for a cruise.
+
+    Used to prefetch the inputs of upcoming cruises into the read cache.
     """
-    
-    files = list(source_dir.glob("*"))
-    remove = [
-        f for f in files
-        if any(fnmatch(f.name, pat) for pat in exclude_names)
-    ]
-    allowed = [f for f in files if f not in remove]
-    logger.info(f"Total number of files: {len(files)}, and allowed numbers of files {len(allowed)}")
-    
-    if not allowed:
-        raise RuntimeError(f"No files matched {pattern} in {source_dir} after exclusions")
-
-    tmpdir_obj = tempfile.TemporaryDirectory(prefix="ek500_filtered_")
-    tmpdir = Path(tmpdir_obj.name)
-
-    # attach object so it doesn't get GC'd while tmpdir is in use
-    #tmpdir._tmpdir_obj = tmpdir_obj  # type: ignore[attr-defined]
-
-    for src in allowed:
-        dst = tmpdir / src.name
-        if link_mode == "symlink":
-            dst.symlink_to(src)
-        elif link_mode == "hardlink":
-            # requires same filesystem; fails across mounts
-            os.link(src, dst)
-        elif link_mode == "copy":
-            dst.write_bytes(src.read_bytes())
-        else:
-            raise ValueError(f"Unknown link_mode: {link_mode}")
+    path_data = cruise.paths
 
-    return tmpdir, tmpdir_obj
+    if stage == "idxprocessing":
+        return [cruise.raw_dir]
+    if stage == "preprocessing":
+        return [cruise.raw_dir, path_data["idxdata"]]
+    if stage == "atcprocessing":
+        return [path_data["preprocessing"]["preprocessing"]]
+    if stage == "reports":
+        return [path_data["preprocessing"][_type] for _type in path_data["reports"]] + [
+            path_data["target_classification"]
+        ]
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def prefetch_jobs(cruises: list[Cruise], stage: str) -> list[tuple[str, list[Path]]]:
+    """Prefetch jobs for the cruises that will be (re)processed."""
+    return [(c.name, stage_inputs(c, stage)) for c in cruises if c.rerun]
 
 
 # ------------------
 # Main flow functions
 # ------------------
 
+@traced(cat="flow")
 def macvin_convert_ek500_flow(
     silver_dir: Path,
     cruise: str | None = None,
@@ -197,55 +213,16 @@ def macvin_convert_ek500_flow(
 
     logger.info("#### MACVIN EK500 FLOW ####")
 
-    df, exclude_files = get_survey(cruise=cruise)
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        if "BEI" in row["Original_RAW_files"]:
-
-            try:
-                logger.info(f"{cruise}: Converting ek 500 data")
-                logger.debug(f"idx tools from {row['Original_RAW_files']} to {row['RAW_files']}")
-
-                batch = Path(os.getenv("LSSS")) / "korona/KoronaCli.sh"
-
-                source_dir = Path(row["Original_RAW_files"])
-                dest_dir = Path(row["RAW_files"])
-
-                # Build a curated source dir containing only allowed *.ek5
-                filtered_source, tmpobj = _make_filtered_source_dir(
-                    source_dir=source_dir,
-                    exclude_names=exclude_files,
-                    pattern="*",
-                    link_mode="symlink",
-                )
-
-                cmd = [
-                    str(batch),
-                    "batch",
-                    "--max-parallel", "5",
-                    "--destination", str(dest_dir),
-                    "--source", str(filtered_source),
-                ]
-
-                logger.info("Running: %s", " ".join(cmd))
-
-                if not dry_run:
-                    subprocess.run(cmd, check=True)
-
-                # Important: keep filtered_source alive until run completes.
-                # The TemporaryDirectory object is attached to filtered_source.
-                # When filtered_source goes out of scope, it will clean up automatically.
-
-            except Exception:
-                logger.exception("EK500 conversion failed")
-
-            finally:
-                tmpobj.cleanup()
-
-        else:
-            logger.info(f"{cruise} does not contatin EK 500 data")
+    for c in load_catalog(silver_root=silver_dir).select(cruise):
+        ek500conversion_flow(
+            cruise=c.name,
+            original_dir=c.original_dir,
+            bronze_dir=c.raw_dir,
+            dry_run=dry_run,
+        )
 
 
+@traced(cat="flow")
 def macvin_idxprocessing_flow(
         silver_dir: Path,
         cruise: str | None = None,
@@ -254,35 +231,22 @@ def macvin_idxprocessing_flow(
 
     logger.info("#### MACVIN IDXFIX FLOW ####")
 
-    basedir = Path("/data/s3/MACWIN-scratch")
-    df, exclude_files = get_survey(cruise=cruise)
-    
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        silver_dir = basedir / Path("silver") / cruise / Path("ACOUSTIC", "EK")
-        path_data = get_paths(silver_dir)
-
-        try:
-            logger.info("# 0. idx tools")
-            logger.debug("Removing old idx files.")
-            idx_dir = Path(path_data["idxdata"])
-            for f in idx_dir.glob("*.idx"):
-                f.unlink()
-
-            logger.info(f"idx tools from {row['RAW_files']} to {path_data['idxdata']}")
-            korona_fixidx(
-                idx=row["RAW_files"],
-                preprocessing=path_data[
-                    "idxdata"
-                ],  # Generate the updated idx files into idxdata
+    cruises = load_catalog(silver_root=silver_dir).select(cruise)
+    jobs = [(c.name, stage_inputs(c, "idxprocessing")) for c in cruises]
+    with Prefetcher() as prefetcher:
+        for c in cruises:
+            prefetcher.advance(jobs, c.name)
+
+            logger.info(f"idx tools from {c.raw_dir} to {c.paths['idxdata']}")
+            idxprocessing_flow(
+                cruise=c.name,
+                bronze_dir=c.raw_dir,
+                silver_dir=c.silver_dir,
                 dry_run=dry_run,
             )
 
-        except Exception:
-            # Full traceback goes into logs
-            logger.exception("Fix idx failed for this case — continuing with next case")
-
 
+@traced(cat="flow")
 def macvin_lufreports_flow(
         silver_dir: Path,
         cruise: str | None = None,
@@ -291,45 +255,15 @@ def macvin_lufreports_flow(
 
     logger.info("#### MACVIN LUF REPORTS FLOW ####")
 
-    df, exclude_files = get_survey(cruise=cruise)
-    
-    basedir = Path("/data/s3/MACWIN-scratch")
-
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        silver_dir = basedir / Path("silver") / cruise / Path("ACOUSTIC", "EK")
-        path_data = get_paths(silver_dir)
-
-        for _type in path_data["reports"].keys():
-            zreport = Path(path_data["reports"][_type]) / "sA.zarr"
-            logger.info(f"zreport {zreport}")
-            par = luf_parameters()
-            logger.info(par)
-            par["Code"] = cruise
-            if zreport.exists():
-                try:
-                    logger.info(
-                        f"{cruise} Run the luf export for {str(path_data['reports'][_type]).split('/')[-3]}"
-                    )
-                    luf_report = zreport.parent / "ListUserFile26_.xml"
-                    logger.info(f"luf report file: {luf_report}")
-                    run_zarr2lufxml(
-                        zarr_report=zreport,
-                        luf_report=luf_report,
-                        par=par,
-                        dry_run=dry_run,
-                    )
-                except Exception as e:
-                    logger.error(
-                        "f{cruise} Preprocessing pipeline failed for {str(reports[_type]).split('/')[-3]}"
-                    )
-                    logger.error(e)
-            else:
-                logger.error(
-                    f"{cruise} Zarr report does not exist for {str(path_data['reports'][_type]).split('/')[-3]}"
-                )
+    for c in load_catalog(silver_root=silver_dir).select(cruise):
+        lufreport_flow(
+            cruise=c.name,
+            silver_dir=c.silver_dir,
+            dry_run=dry_run,
+        )
 
 
+@traced(cat="flow")
 def macvin_reports_flow(
         silver_dir: Path,
         cruise: str | None = None,
@@ -338,30 +272,28 @@ def macvin_reports_flow(
 
     logger.info("#### MACVIN REPORTS FLOW ####")
 
-    df, exclude_files = get_survey(cruise=cruise)
-    
-    basedir = Path("/data/s3/MACWIN-scratch")
-
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        silver_dir = basedir / Path("silver") / cruise / Path("ACOUSTIC", "EK")
-        rerun = row["status"] not in ("OK", "FAIL")
-        logger.info(cruise)
-
-        if rerun:
-            logger.info(f"Silver dir: {silver_dir}")
-            logger.info(f"Silver dir is available : {silver_dir.exists()}")
-            report_flow(
-                cruise=str(cruise),
-                silver_dir=silver_dir,
-                dry_run=dry_run,
-            )
-        else:
-            logger.info(
-                f"Cruise is already processed or doomed/deemed to fail. Remove {row['status']} from cruises.csv to rerun processing."
-            )
+    cruises = load_catalog(silver_root=silver_dir).select(cruise)
+    jobs = prefetch_jobs(cruises, "reports")
+    with Prefetcher() as prefetcher:
+        for c in cruises:
+            logger.info(c.name)
+
+            if c.rerun:
+                prefetcher.advance(jobs, c.name)
+                logger.info(f"Silver dir: {c.silver_dir}")
+                logger.info(f"Silver dir is available : {c.silver_dir.exists()}")
+                report_flow(
+                    cruise=c.name,
+                    silver_dir=c.silver_dir,
+                    dry_run=dry_run,
+                )
+            else:
+                logger.info(
+                    f"Cruise is already processed or doomed/deemed to fail. Remove {c.status} from cruises.csv to rerun processing."
+                )
 
 
+@traced(cat="flow")
 def macvin_preprocessing_flow(
         silver_dir: Path,
         cruise: str | None = None,
@@ -370,33 +302,29 @@ def macvin_preprocessing_flow(
 
     logger.info("#### MACVIN PREPROCESSING FLOW ####")
 
-    df, exclude_files = get_survey(cruise=cruise)
-
-    basedir = Path("/data/s3/MACWIN-scratch")
-
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        rerun = row["status"] not in ("OK", "FAIL")
-        bronze_dir = Path(row["RAW_files"])
-        silver_dir = basedir / Path("silver") / cruise / Path("ACOUSTIC", "EK")
-
-        logger.info(cruise)
-        if rerun:
-            logger.info(f"Bronze dir: {bronze_dir}")
-            logger.info(f"Bronze dir is available : {bronze_dir.exists()}")
-            logger.info(f"Silver dir: {silver_dir}")
-            preprocessing_flow(
-                cruise=str(cruise),
-                bronze_dir=bronze_dir,
-                silver_dir=silver_dir,
-                dry_run=dry_run,
-            )
-        else:
-            logger.info(
-                f"Cruise is already processed. Remove {row['status']} from cruises.csv to rerun processing."
-            )
+    cruises = load_catalog(silver_root=silver_dir).select(cruise)
+    jobs = prefetch_jobs(cruises, "preprocessing")
+    with Prefetcher() as prefetcher:
+        for c in cruises:
+            logger.info(c.name)
+            if c.rerun:
+                prefetcher.advance(jobs, c.name)
+                logger.info(f"Bronze dir: {c.raw_dir}")
+                logger.info(f"Bronze dir is available : {c.raw_dir.exists()}")
+                logger.info(f"Silver dir: {c.silver_dir}")
+                preprocessing_flow(
+                    cruise=c.name,
+                    bronze_dir=c.raw_dir,
+                    silver_dir=c.silver_dir,
+                    dry_run=dry_run,
+                )
+            else:
+                logger.info(
+                    f"Cruise is already processed. Remove {c.status} from cruises.csv to rerun processing."
+                )
 
 
+@traced(cat="flow")
 def macvin_atcprocessing_flow(
         silver_dir: Path,
         cruise: str | None = None,
@@ -405,31 +333,175 @@ def macvin_atcprocessing_flow(
 
     logger.info("#### MACVIN ATCPROCESSING FLOW ####")
 
-    df, exclude_files = get_survey(cruise=cruise)
-
-    basedir = Path("/data/s3/MACWIN-scratch")
+    cruises = load_catalog(silver_root=silver_dir).select(cruise)
+    jobs = prefetch_jobs(cruises, "atcprocessing")
+    with Prefetcher() as prefetcher:
+        for c in cruises:
+            logger.info(c.name)
+            if c.rerun:
+                prefetcher.advance(jobs, c.name)
+                logger.info(f"Silver dir: {c.silver_dir}")
+                atcprocessing_flow(
+                    cruise=c.name,
+                    silver_dir=c.silver_dir,
+                    dry_run=dry_run,
+                )
+            else:
+                logger.info(
+                    f"Cruise is already processed. Remove {c.status} from cruises.csv to rerun processing."
+                )
 
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        rerun = row["status"] not in ("OK", "FAIL")
-        silver_dir = basedir / Path("silver") / cruise / Path("ACOUSTIC", "EK")
 
-        logger.info(cruise)
-        if rerun:
-            logger.info(f"Silver dir: {silver_dir}")
-            atcprocessing_flow(
-                cruise=str(cruise),
+# Stages of the per cruise pipeline and the stages they depend on
+STAGES = {
+    "ek500": (),
+    "idx": ("ek500",),
+    "pre": ("idx",),
+    "pre2zarr": ("pre",),
+    "stats": ("pre",),
+    "atc": ("pre",),
+    "atc2zarr": ("atc",),
+    "align": ("pre", "atc"),
+    "reports": ("align",),
+    "luf": ("reports",),
+}
+
+DEFAULT_STAGES = "ek500,idx,pre,stats,atc,align,reports,luf"
+
+# Max number of cruises in each stage at the same time. Preprocessing is I/O
+# bound and the ATC is CPU bound, so a few cruises can be preprocessed while
+# one runs the ATC. Stages that are not listed are only limited by --jobs.
+DEFAULT_STAGE_JOBS = "ek500=1,pre=2,atc=1"
+
+
+def run_stage(stage: str, c: Cruise, dry_run: bool = False) -> bool:
+    """Run one stage of the pipeline for a cruise. Returns True on success."""
+    cruise = c.name
+    silver_dir = c.silver_dir
+    silver_root = c.silver_root
+
+    with span(stage, "stage", cruise=cruise):
+        if stage == "ek500":
+            return ek500conversion_flow(
+                cruise=cruise,
+                original_dir=c.original_dir,
+                bronze_dir=c.raw_dir,
+                dry_run=dry_run,
+            )
+        if stage == "idx":
+            return idxprocessing_flow(
+                cruise=cruise,
+                bronze_dir=c.raw_dir,
                 silver_dir=silver_dir,
                 dry_run=dry_run,
             )
-        else:
+        if stage == "pre":
+            return preprocessing_flow(
+                cruise=cruise,
+                bronze_dir=c.raw_dir,
+                silver_dir=silver_dir,
+                dry_run=dry_run,
+            )
+        if stage == "pre2zarr":
+            return preprocess2zarr_flow(cruise=cruise, silver_dir=silver_root, dry_run=dry_run)
+        if stage == "stats":
+            return sv_stats_flow(cruise=cruise, silver_dir=silver_dir, dry_run=dry_run)
+        if stage == "atc":
+            return atcprocessing_flow(cruise=cruise, silver_dir=silver_dir, dry_run=dry_run)
+        if stage == "atc2zarr":
+            return atc2zarr_flow(cruise=cruise, silver_dir=silver_root, dry_run=dry_run)
+        if stage == "align":
+            return align_flow(cruise=cruise, silver_dir=silver_dir, dry_run=dry_run)
+        if stage == "reports":
+            return report_flow(cruise=cruise, silver_dir=silver_dir, dry_run=dry_run)
+        if stage == "luf":
+            return lufreport_flow(cruise=cruise, silver_dir=silver_dir, dry_run=dry_run)
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+@traced(cat="flow")
+def macvin_run_flow(
+        silver_dir: Path,
+        cruise: str | None = None,
+        dry_run: bool = False,
+        stages: str = DEFAULT_STAGES,
+        jobs: int = 1,
+        stage_jobs: str = DEFAULT_STAGE_JOBS,
+        plan: bool = False,
+        queue: str | None = None,
+) -> dict[Task, str]:
+    """
+    Run the selected stages for one or more cruises in a single process.
+
+    The stages of every cruise form a dependency graph (see STAGES). Up to
+    `jobs` stages run at the same time, and `stage_jobs` (e.g. "pre=2,atc=1")
+    limits how many cruises are in each stage at once. The cruises stream
+    through the stage chain, so one cruise is preprocessed while the previous
+    one runs the ATC. When a stage fails, only the stages that depend on it
+    for the same cruise are skipped.
+
+    The duration of every stage is estimated from the raw data size of the
+    cruise and past runs in the ledger (see `macvin.costs`). The ETA is
+    logged and the stages with the longest remaining work start first. With
+    `plan` only the estimated schedule is logged.
+
+    With `queue` the stages are shared with other macvin-run workers, on
+    this or other hosts, started with the same queue name and silver
+    directory (see `macvin.workqueue`). Every stage runs on one worker, and
+    the stages of a worker that dies are taken over when its leases expire.
+
+    `cruise` and `stages` are comma separated lists. Without `cruise` all
+    cruises in cruises.csv that are not marked OK or FAIL are processed.
+    """
+    logger.info("#### MACVIN RUN ####")
+
+    selected = [s.strip() for s in stages.split(",") if s.strip()]
+
+    catalog = load_catalog(silver_root=silver_dir)
+    rows = {}
+    for c in catalog.select(cruise):
+        if not c.rerun:
             logger.info(
-                f"Cruise is already processed. Remove {row['status']} from cruises.csv to rerun processing."
+                f"{c.name} is already processed or doomed/deemed to fail. Remove {c.status} from cruises.csv to rerun processing."
             )
+            continue
+        rows[c.name] = c
+
+    graph = build_graph(list(rows), selected, STAGES)
+    limits = parse_limits(stage_jobs)
+    logger.info(
+        f"Running {', '.join(selected)} for {len(rows)} cruises with {jobs} parallel jobs, stage limits {limits}"
+    )
+
+    def size_of(name: str) -> int:
+        return catalog.info(name).raw_bytes if name in catalog else 0
+
+    run_plan = plan_run(graph, size_of, load_costs(size_of), jobs=jobs, limits=limits)
+    log_plan(run_plan, tasks=plan)
+    if plan:
+        return {task: "planned" for task in graph}
+
+    def run_task(task: Task) -> bool:
+        return run_stage(task.stage, rows[task.cruise], dry_run=dry_run)
+
+    if queue:
+        work_queue = WorkQueue(queue_dir(silver_dir, queue))
+        logger.info(f"Sharing the stages through {work_queue.root} as {work_queue.owner}")
+        status = run_queue(graph, run_task, work_queue, jobs=jobs, limits=limits, priority=run_plan.priority)
+    else:
+        status = run_graph(graph, run_task, jobs=jobs, limits=limits, priority=run_plan.priority)
+
+    for task in graph:
+        logger.info(f"{task.cruise:40s} {task.stage:10s} {status[task]}")
+    failed = [task for task, s in status.items() if s == "failed"]
+    if failed:
+        logger.error(f"{len(failed)} stages failed: {', '.join(map(str, failed))}")
+    return status
 
 # macvin_atc2zarr_flow
 
 
+@traced(cat="flow")
 def macvin_test_flow(dry_run: bool = True):
     logger.info("#### MACVIN TEST PROCESSING FLOW ####")
     if platform.node() == "HI-14667":
@@ -495,53 +567,178 @@ def macvin_test_flow(dry_run: bool = True):
 # Flows per survey
 # ------------------
 
+@traced(cat="flow")
+def ek500conversion_flow(
+    cruise: str,
+    original_dir: Path,
+    bronze_dir: Path,
+    dry_run: bool = False,
+) -> bool:
+    if "BEI" not in str(original_dir):
+        logger.info(f"{cruise} does not contatin EK 500 data")
+        return True
+
+    try:
+        logger.info(f"{cruise}: Converting ek 500 data")
+        logger.debug(f"idx tools from {original_dir} to {bronze_dir}")
+
+        batch = Path(os.getenv("LSSS")) / "korona/KoronaCli.sh"
+
+        # Build a curated source dir containing only allowed files.
+        # The view is removed when the with block exits.
+        with (
+            record_stage(
+                cruise, "ek500conversion", output_dir=bronze_dir, dry_run=dry_run
+            ) as run,
+            filtered_view(
+                original_dir,
+                cruise,
+                require_files=True,
+                dry_run=dry_run,
+            ) as filtered_source,
+        ):
+            n_files, n_bytes = dir_usage(filtered_source)
+            run.add(input_files=n_files, input_bytes=n_bytes)
+
+            t0 = time.time()
+            ek500.convert(
+                batch, list_files(filtered_source), bronze_dir, dry_run=dry_run
+            )
+            if not dry_run:
+                n_files, n_bytes = dir_usage(bronze_dir, since=t0)
+                run.add(output_files=n_files, output_bytes=n_bytes)
+
+    except Exception:
+        logger.exception("EK500 conversion failed")
+        return False
+    return True
+
+
+@traced(cat="flow")
 def idxprocessing_flow(
     cruise: str,
     bronze_dir: Path,
     silver_dir: Path,
     dry_run: bool = False,
-):
+) -> bool:
     logger.info(f"#### {cruise} ####")
     rawdata = bronze_dir
     path_data = get_paths(silver_dir)
     try:
         logger.info("# 0. idx fix")
-
-        korona_fixidx(
-            idx=rawdata,
-            preprocessing=path_data[
-                "idxdata"
-            ],  # Generate the updated idx files into idxdata
+        files = list_files(rawdata) if rawdata.is_dir() else []
+        allowed, _ = load_exclusions().for_cruise(cruise).split(files)
+        broken = set()
+        if not dry_run:
+            scans = update_raw_index([f for f in allowed if f.suffix == ".raw"], path_data["raw_index"])
+            broken = broken_keys(scans)
+            if broken:
+                logger.warning(f"Leaving out {len(broken)} broken raw files")
+                allowed = [f for f in allowed if file_key(f) not in broken]
+        plan = plan_fixidx(allowed)
+        clean_keys = {c.key for c in plan.clean} | broken
+
+        with (
+            record_stage(
+                cruise,
+                "korona_fixidx",
+                output_dir=path_data["idxdata"],
                 dry_run=dry_run,
-        )
+            ),
+            filtered_view(rawdata, cruise, skip_keys=clean_keys, dry_run=dry_run) as idx_view,
+            staged_output(
+                path_data["idxdata"], "korona_fixidx", cruise, dry_run=dry_run
+            ) as idx_out,
+        ):
+            # Clean idx files are passed through under the name fixidx would use
+            if not dry_run:
+                for c in plan.clean:
+                    link_or_copy(c.idx, idx_out / FIXED_IDX_NAME.format(key=c.key))
+            if idx_view is None:
+                logger.info("All idx files are clean, fixidx is not needed")
+            else:
+                korona_fixidx(
+                    idx=idx_view,
+                    preprocessing=idx_out,  # Generate the updated idx files into idxdata
+                    dry_run=dry_run,
+                )
+
+        if not dry_run:
+            for f in Path(path_data["idxdata"]).glob("*.idx"):
+                if file_key(f) not in plan.keys:
+                    logger.debug(f"Removing idx file {f.name} without a raw file")
+                    f.unlink()
 
     except Exception:
         # Full traceback goes into logs
         logger.exception(
             "idx fix pipeline failed for this case — continuing with next case"
         )
+        return False
+    return True
 
 
+def update_references(nc_dir: Path, dry_run: bool = False):
+    """Rebuild the reference index of `nc_dir`. Failures are logged and do not fail the stage."""
+    try:
+        build_references(nc_dir, reference_path(nc_dir), dry_run=dry_run)
+    except Exception:
+        logger.exception(f"Could not build the reference index of {nc_dir}")
+
+
+@traced(cat="flow")
 def preprocessing_flow(
     cruise: str,
     bronze_dir: Path,
     silver_dir: Path,
     dry_run: bool = False,
-):
+) -> bool:
 
     logger.info(f"#### {cruise} ####")
     rawdata = bronze_dir
     path_data = get_paths(silver_dir)
 
+    # Raw files the datagram scan found unreadable are left out
+    broken = broken_keys(load_raw_index(path_data["raw_index"]).values())
+    if broken:
+        logger.warning(f"Leaving out {len(broken)} broken raw files")
+
+    ok = True
     try:
         logger.info("# 1a. Noise filtering")
-        korona_noisefiltering(
-            idxdata=path_data["idxdata"],
-            rawdata=rawdata,
-            preprocessing=path_data["preprocessing"]["noisefiltering"],
-            dry_run=dry_run,
-        )
+        done = produced_keys(path_data["preprocessing"]["noisefiltering"]) | broken
+        with (
+            record_stage(
+                cruise,
+                "korona_noisefiltering",
+                output_dir=path_data["preprocessing"]["noisefiltering"],
+                dry_run=dry_run,
+            ),
+            filtered_view(
+                path_data["idxdata"], cruise, skip_keys=done, dry_run=dry_run
+            ) as idx_view,
+            filtered_view(rawdata, cruise, skip_keys=done, dry_run=dry_run) as raw_view,
+            staged_output(
+                path_data["preprocessing"]["noisefiltering"],
+                "korona_noisefiltering",
+                cruise,
+                dry_run=dry_run,
+            ) as sv_out,
+        ):
+            if raw_view is None:
+                logger.info("All files are already noise filtered")
+            elif idx_view is None:
+                logger.warning("No idx files left for the remaining raw files, skipping noise filtering")
+            else:
+                korona_noisefiltering(
+                    idxdata=idx_view,
+                    rawdata=raw_view,
+                    preprocessing=sv_out,
+                    dry_run=dry_run,
+                )
+        update_references(path_data["preprocessing"]["noisefiltering"], dry_run=dry_run)
     except Exception:
+        ok = False
         # Full traceback goes into logs
         logger.exception(
             "Preprocessing pipeline failed for this case — continuing with next case"
@@ -549,52 +746,212 @@ def preprocessing_flow(
 
     try:
         logger.info("# 1c. Preprocesing")
-        korona_preprocessing(
-            idxdata=path_data["idxdata"],
-            rawdata=rawdata,
-            preprocessing=path_data["preprocessing"]["preprocessing"],
-            dry_run=dry_run,
-        )
+        done = produced_keys(path_data["preprocessing"]["preprocessing"]) | broken
+        with (
+            record_stage(
+                cruise,
+                "korona_preprocessing",
+                output_dir=path_data["preprocessing"]["preprocessing"],
+                dry_run=dry_run,
+            ),
+            filtered_view(
+                path_data["idxdata"], cruise, skip_keys=done, dry_run=dry_run
+            ) as idx_view,
+            filtered_view(rawdata, cruise, skip_keys=done, dry_run=dry_run) as raw_view,
+            staged_output(
+                path_data["preprocessing"]["preprocessing"],
+                "korona_preprocessing",
+                cruise,
+                dry_run=dry_run,
+            ) as sv_out,
+        ):
+            if raw_view is None:
+                logger.info("All files are already preprocessed")
+            elif idx_view is None:
+                logger.warning("No idx files left for the remaining raw files, skipping preprocessing")
+            else:
+                korona_preprocessing(
+                    idxdata=idx_view,
+                    rawdata=raw_view,
+                    preprocessing=sv_out,
+                    dry_run=dry_run,
+                )
+        update_references(path_data["preprocessing"]["preprocessing"], dry_run=dry_run)
     except Exception:
+        ok = False
         # Full traceback goes into Prefect logs
         logger.exception(
             "Preprocessing pipeline failed for this case — continuing with next case"
         )
+    return ok
+
 
 
+@traced(cat="flow")
 def atcprocessing_flow(
     cruise: str,
     silver_dir: Path,
     dry_run: bool = False,
-):
+) -> bool:
 
     logger.info(f"#### {cruise} ####")
     path_data = get_paths(silver_dir)
 
+    ok = True
     try:
         logger.info("# 2. Target classification")
-        mackerel_korneliussen2016(
-            preprocessing=path_data["preprocessing"]["preprocessing"],
-            target_classification=path_data["target_classification"],
-            dry_run=dry_run,
-        )
+        done = produced_keys(path_data["target_classification"])
+        with (
+            record_stage(
+                cruise,
+                "mackerel_korneliussen2016",
+                output_dir=path_data["target_classification"],
+                dry_run=dry_run,
+            ),
+            filtered_view(
+                path_data["preprocessing"]["preprocessing"],
+                cruise,
+                skip_keys=done,
+                dry_run=dry_run,
+            ) as sv_view,
+            staged_output(
+                path_data["target_classification"],
+                "mackerel_korneliussen2016",
+                cruise,
+                dry_run=dry_run,
+            ) as labels_out,
+        ):
+            if sv_view is None:
+                logger.info("All files are already classified")
+            else:
+                mackerel_korneliussen2016(
+                    preprocessing=sv_view,
+                    target_classification=labels_out,
+                    dry_run=dry_run,
+                )
+        update_references(path_data["target_classification"], dry_run=dry_run)
 
     except Exception:
+        ok = False
         # Full traceback goes into Prefect logs
         logger.exception(
             "ATC processing pipeline failed for this case — continuing with next case"
         )
+    return ok
+
+
+
+@traced(cat="flow")
+def align_flow(
+    cruise: str,
+    silver_dir: Path,
+    dry_run: bool = False,
+) -> bool:
+
+    logger.info(f"#### {cruise} ####")
+    path_data = get_paths(silver_dir)
+    aligned = path_data["target_classification_aligned"]
+
+    ok = True
+    try:
+        logger.info("# 3. Align labels with the sv ping_time grid")
+        with (
+            record_stage(cruise, "align_labels", output_dir=aligned, dry_run=dry_run) as run,
+            filtered_view(
+                path_data["preprocessing"]["noisefiltering"], cruise, dry_run=dry_run
+            ) as sv_view,
+            filtered_view(
+                path_data["target_classification"], cruise, dry_run=dry_run
+            ) as labels_view,
+            staged_output(aligned, "align_labels", cruise, dry_run=dry_run) as aligned_out,
+        ):
+            stats = align_labels(
+                sv_dir=sv_view,
+                labels_dir=labels_view,
+                output_dir=aligned_out,
+                existing_dir=aligned,
+                dry_run=dry_run,
+            )
+            run.add(input_files=stats.files, input_bytes=stats.bytes)
+    except Exception:
+        ok = False
+        logger.exception(
+            "Aligning labels failed for this case — continuing with next case"
+        )
+    return ok
+
+
+@traced(cat="flow")
+def sv_stats_flow(
+    cruise: str,
+    silver_dir: Path,
+    dry_run: bool = False,
+) -> bool:
 
+    logger.info(f"#### {cruise} ####")
+    path_data = get_paths(silver_dir)
+    exclusions = load_exclusions().for_cruise(cruise)
 
+    # One ledger run for all products, so the run covers the whole stage
+    failed = []
+    try:
+        with record_stage(cruise, "sv_stats", output_dir=path_data["sv_stats"], dry_run=dry_run):
+            for _type, sv_dir in path_data["preprocessing"].items():
+                try:
+                    logger.info(f"# QC. sv statistics of {_type}")
+                    files, _ = exclusions.split(sorted(sv_dir.glob("*.nc")))
+                    if not files:
+                        logger.info(f"No sv files in {sv_dir}")
+                        continue
+                    update_sv_stats(
+                        files,
+                        path_data["sv_stats"] / f"{_type}.parquet",
+                        cruise=cruise,
+                        product=_type,
+                        dry_run=dry_run,
+                    )
+                except Exception:
+                    failed.append(_type)
+                    logger.exception(f"sv statistics of {_type} failed — continuing with next product")
+            if failed:
+                raise RuntimeError(f"sv statistics of {', '.join(failed)} failed")
+    except Exception:
+        # Failed products are logged above
+        if not failed:
+            logger.exception("sv statistics failed for this case — continuing with next case")
+        return False
+    return True
+
+
+def report_labels(path_data: dict) -> Path:
+    """
+    The aligned labels if the align stage completed after the sv and labels
+    it was aligned from, otherwise the ATC labels.
+    """
+    aligned = path_data["target_classification_aligned"]
+    aligned_time = marker_time(aligned)
+    if aligned_time is None:
+        logger.warning(f"No complete aligned labels in {aligned}, using the ATC labels")
+        return path_data["target_classification"]
+    for source in (path_data["target_classification"], path_data["preprocessing"]["noisefiltering"]):
+        source_time = marker_time(source)
+        if source_time is not None and source_time > aligned_time:
+            logger.warning(f"Aligned labels in {aligned} are older than {source}, using the ATC labels")
+            return path_data["target_classification"]
+    return aligned
+
+
+@traced(cat="flow")
 def report_flow(
     cruise: str,
     silver_dir: Path,
     dry_run: bool = False,
-):
+) -> bool:
 
     logger.info(f"#### {cruise} ####")
     path_data = get_paths(silver_dir)
 
+    ok = True
     # Loop over reports
     for _type in path_data["reports"].keys():
 
@@ -602,79 +959,203 @@ def report_flow(
             logger.info(f"Creating report : {str(path_data['reports'][_type]).split('/')[-3]}")
             
             # Pick this up from here
-            sv_echo_integrator(
-                preprocessing=path_data["preprocessing"][_type],
-                target_classification=path_data["target_classification"],
-                bottom_detection=False,
-                cruise=cruise,
-                reports=path_data["reports"][_type],
-                dry_run=dry_run,
-            )
+            with (
+                record_stage(
+                    cruise,
+                    "sv_echo_integrator",
+                    output_dir=path_data["reports"][_type],
+                    dry_run=dry_run,
+                ),
+                filtered_view(
+                    path_data["preprocessing"][_type], cruise, dry_run=dry_run
+                ) as sv_view,
+                filtered_view(
+                    report_labels(path_data), cruise, dry_run=dry_run
+                ) as labels_view,
+                staged_output(
+                    path_data["reports"][_type],
+                    "sv_echo_integrator",
+                    cruise,
+                    dry_run=dry_run,
+                ) as reports_out,
+            ):
+                sv_echo_integrator(
+                    preprocessing=sv_view,
+                    target_classification=labels_view,
+                    bottom_detection=False,
+                    cruise=cruise,
+                    reports=reports_out,
+                    dry_run=dry_run,
+                )
 
         except Exception:
+            ok = False
             logger.info(
                 f"Failed creating report : {str(path_data['reports'][_type]).split('/')[-3]}"
             )
+    return ok
+
+
+@traced(cat="flow")
+def lufreport_flow(
+    cruise: str,
+    silver_dir: Path,
+    dry_run: bool = False,
+) -> bool:
+
+    path_data = get_paths(silver_dir)
+    ok = True
+
+    for _type in path_data["reports"].keys():
+        zreport = Path(path_data["reports"][_type]) / "sA.zarr"
+        logger.info(f"zreport {zreport}")
+        par = luf_parameters()
+        logger.info(par)
+        par["Code"] = cruise
+        if zreport.exists():
+            try:
+                logger.info(
+                    f"{cruise} Run the luf export for {str(path_data['reports'][_type]).split('/')[-3]}"
+                )
+                luf_report = zreport.parent / "ListUserFile26_.xml"
+                logger.info(f"luf report file: {luf_report}")
+                with record_stage(
+                    cruise, "lufreports", output_dir=zreport.parent, dry_run=dry_run
+                ) as run:
+                    run_zarr2lufxml(
+                        zarr_report=zreport,
+                        luf_report=luf_report,
+                        par=par,
+                        dry_run=dry_run,
+                    )
+                    if not dry_run:
+                        run.add(
+                            input_files=1,
+                            input_bytes=dir_usage(zreport)[1],
+                            output_files=1,
+                            output_bytes=luf_report.stat().st_size,
+                        )
+            except Exception as e:
+                ok = False
+                logger.error(
+                    f"{cruise} LUF export failed for {str(path_data['reports'][_type]).split('/')[-3]}"
+                )
+                logger.error(e)
+        else:
+            ok = False
+            logger.error(
+                f"{cruise} Zarr report does not exist for {str(path_data['reports'][_type]).split('/')[-3]}"
+            )
+
+    return ok
 
 
 #
 # cxxxxxxxxx
 #
 
+
+
+@traced(cat="flow")
 def preprocess2zarr_flow(
     cruise: str,
     silver_dir: Path,
     dry_run: bool = False,
-):
+) -> bool:
     logger.info(f"#### preprocess2zarr for {cruise} ####")
 
-    _silver_dir = silver_dir / cruise / Path("ACOUSTIC", "EK")
-    path_data = get_paths(_silver_dir)
-    df, exclude_files = get_survey(cruise=cruise)
+    path_data = get_paths(silver_path(silver_dir, cruise))
+    exclude_files = load_exclusions()
 
+    ok = True
     # Loop over preprocessed data sets
     for _type in path_data["preprocessing"].keys():
 
         try:
             logger.info(f"Creating zarr store : {str(path_data['preprocessing'][_type]).split('/')[-3]}")
 
-            preprocess2zarr(
-                nc_mount=path_data["preprocessing"][_type],
-                zarr_mount=path_data["preprocessing_zarr"][_type],
-                cruise=cruise,
-                dry_run=dry_run,
-            )
+            with (
+                record_stage(
+                    cruise,
+                    "preprocess2zarr",
+                    output_dir=path_data["preprocessing_zarr"][_type],
+                    dry_run=dry_run,
+                ),
+                filtered_view(
+                    path_data["preprocessing"][_type],
+                    exclusions=exclude_files.for_cruise(cruise),
+                    dry_run=dry_run,
+                ) as nc_view,
+                staged_output(
+                    path_data["preprocessing_zarr"][_type],
+                    "preprocess2zarr",
+                    cruise,
+                    dry_run=dry_run,
+                ) as zarr_out,
+            ):
+                preprocess2zarr(
+                    nc_mount=nc_view,
+                    zarr_mount=zarr_out,
+                    cruise=cruise,
+                    dry_run=dry_run,
+                )
 
         except Exception:
+            ok = False
             logger.info(
                 f"Failed creating zarr store : {str(path_data['reports'][_type]).split('/')[-3]}"
             )
+    return ok
+
 
 
+@traced(cat="flow")
 def atc2zarr_flow(
     cruise: str,
     silver_dir: Path,
     dry_run: bool = False,
-):
+) -> bool:
 
     logger.info(f"#### atc2_zarr for {cruise} ####")
 
-    _silver_dir = silver_dir / cruise / Path("ACOUSTIC", "EK")
-    path_data = get_paths(_silver_dir)
-    df, exclude_files = get_survey(cruise=cruise)
+    path_data = get_paths(silver_path(silver_dir, cruise))
+    exclude_files = load_exclusions()
 
+    ok = True
     try:
         logger.info(f"Creating zarr store : {str(path_data['reports']).split('/')[-2]}")
 
         # Pick this up from here
-        atc2zarr(
-            nc_mount=path_data["target_classification"],
-            zarr_mount=path_data["target_classification_zarr"],
-            cruise=cruise,
-            dry_run=dry_run,
-        )
+        with (
+            record_stage(
+                cruise,
+                "atc2zarr",
+                output_dir=path_data["target_classification_zarr"],
+                dry_run=dry_run,
+            ),
+            filtered_view(
+                path_data["target_classification"],
+                exclusions=exclude_files.for_cruise(cruise),
+                dry_run=dry_run,
+            ) as nc_view,
+            staged_output(
+                path_data["target_classification_zarr"],
+                "atc2zarr",
+                cruise,
+                dry_run=dry_run,
+            ) as zarr_out,
+        ):
+            atc2zarr(
+                nc_mount=nc_view,
+                zarr_mount=zarr_out,
+                cruise=cruise,
+                dry_run=dry_run,
+            )
 
     except Exception:
+        ok = False
         logger.info(
             f"Failed creating report : {str(path_data['reports']).split('/')[-2]}"
         )
+    return ok
+
@@ -0,0 +1,179 @@
+from pathlib import Path
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from macvin.resume import file_key
+
+logger = logging.getLogger(__name__)
+
+MAX_GAP_ENV = "MACVIN_IDX_MAX_GAP_S"
+DEFAULT_MAX_GAP_S = 600.0
+
+# Name of the idx file korona fixidx writes for a raw file
+FIXED_IDX_NAME = "{key}-korona.idx"
+
+# An EK60 IDX0 datagram with its leading and trailing length fields
+IDX_DTYPE = np.dtype(
+    [
+        ("length", "<i4"),
+        ("type", "S4"),
+        ("time_low", "<u4"),
+        ("time_high", "<u4"),
+        ("ping", "<u4"),
+        ("distance", "<f8"),
+        ("latitude", "<f8"),
+        ("longitude", "<f8"),
+        ("offset", "<u4"),
+        ("length_end", "<i4"),
+    ]
+)
+
+# NT time is in 100 ns units since 1601-01-01
+NT_EPOCH_OFFSET = 116444736000000000
+
+
+def nt_to_datetime(low: np.ndarray, high: np.ndarray) -> np.ndarray:
+    nt = (high.astype(np.int64) << 32) | low.astype(np.int64)
+    return ((nt - NT_EPOCH_OFFSET) * 100).astype("datetime64[ns]")
+
+
+def read_idx(path: Path) -> np.ndarray:
+    """
+    Memory map an .idx file as an array of IDX_DTYPE records. Raises
+    ValueError if the file is not a sequence of IDX0 datagrams.
+    """
+    size = Path(path).stat().st_size
+    if size == 0:
+        return np.zeros(0, dtype=IDX_DTYPE)
+    if size % IDX_DTYPE.itemsize:
+        raise ValueError(f"{path}: size {size} is not a multiple of {IDX_DTYPE.itemsize} bytes")
+    records = np.memmap(path, dtype=IDX_DTYPE, mode="r")
+    if not (records["type"] == b"IDX0").all():
+        raise ValueError(f"{path}: not all datagrams are IDX0")
+    if not ((records["length"] == records["length_end"]) & (records["length"] == IDX_DTYPE.itemsize - 8)).all():
+        raise ValueError(f"{path}: datagram lengths do not match")
+    return records
+
+
+def idx_times(records: np.ndarray) -> np.ndarray:
+    return nt_to_datetime(records["time_low"], records["time_high"])
+
+
+@dataclass
+class IdxCheck:
+    """Result of checking the idx file of one raw file."""
+
+    raw: Path
+    idx: Path | None
+    pings: int = 0
+    start: np.datetime64 | None = None
+    end: np.datetime64 | None = None
+    reversals: int = 0
+    gaps: int = 0
+    max_gap_s: float = 0.0
+    problems: list[str] = field(default_factory=list)
+
+    @property
+    def key(self) -> str:
+        return file_key(self.raw)
+
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+
+def check_idx(raw: Path, idx: Path | None, max_gap_s: float | None = None) -> IdxCheck:
+    """
+    Check the idx file of a raw file: it must exist and parse, its times
+    must not decrease and its offsets must lie inside the raw file. Gaps
+    longer than `max_gap_s` are counted but are not a problem by themselves.
+    """
+    if max_gap_s is None:
+        max_gap_s = float(os.getenv(MAX_GAP_ENV, DEFAULT_MAX_GAP_S))
+    check = IdxCheck(raw=raw, idx=idx)
+    if idx is None or not idx.exists():
+        check.problems.append("no idx file")
+        return check
+    try:
+        records = read_idx(idx)
+    except (OSError, ValueError) as e:
+        check.problems.append(str(e))
+        return check
+    check.pings = len(records)
+    if not len(records):
+        check.problems.append("empty idx file")
+        return check
+
+    times = idx_times(records)
+    check.start, check.end = times[0], times[-1]
+    dt = np.diff(times).astype("timedelta64[ns]").astype(np.int64) / 1e9
+    check.reversals = int((dt < 0).sum())
+    check.gaps = int((dt > max_gap_s).sum())
+    check.max_gap_s = float(dt.max()) if len(dt) else 0.0
+    if check.reversals:
+        first = int(np.flatnonzero(dt < 0)[0])
+        check.problems.append(
+            f"time decreases {check.reversals} times, first from {times[first]} to {times[first + 1]}"
+        )
+    if raw.exists() and int(records["offset"].max()) >= raw.stat().st_size:
+        check.problems.append("offsets beyond the end of the raw file")
+    return check
+
+
+@dataclass
+class FixidxPlan:
+    checks: list[IdxCheck]
+
+    @property
+    def affected(self) -> list[IdxCheck]:
+        return [c for c in self.checks if not c.ok]
+
+    @property
+    def clean(self) -> list[IdxCheck]:
+        return [c for c in self.checks if c.ok]
+
+    @property
+    def keys(self) -> set[str]:
+        return {c.key for c in self.checks}
+
+
+def plan_fixidx(files: Sequence[Path], max_gap_s: float | None = None) -> FixidxPlan:
+    """
+    Check the idx files next to the raw files in `files` and decide which
+    need fixidx. A raw file needs it when its own idx file has a problem, or
+    when its first ping is not after the last ping of the previous file, in
+    which case both files are fixed.
+    """
+    files = [Path(f) for f in files]
+    idx_by_key = {file_key(f): f for f in files if f.suffix == ".idx"}
+    raws = sorted(f for f in files if f.suffix == ".raw")
+    checks = [check_idx(raw, idx_by_key.get(file_key(raw)), max_gap_s) for raw in raws]
+
+    for prev, cur in zip(checks, checks[1:]):
+        if prev.end is not None and cur.start is not None and cur.start <= prev.end:
+            msg = f"starts at {cur.start} before {prev.raw.name} ends at {prev.end}"
+            cur.problems.append(msg)
+            prev.problems.append(f"ends after {cur.raw.name} starts")
+
+    plan = FixidxPlan(checks)
+    for c in plan.affected:
+        logger.warning(f"{c.raw.name}: {'; '.join(c.problems)}")
+    gaps = sum(c.gaps for c in checks)
+    if gaps:
+        logger.info(f"{gaps} gaps longer than the limit in {sum(c.gaps > 0 for c in checks)} idx files")
+    logger.info(f"{len(plan.affected)} of {len(checks)} raw files need fixidx")
+    return plan
+
+
+def link_or_copy(src: Path, dst: Path):
+    """Hard link `src` to `dst`, or copy it when they are on different file systems."""
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(Path(src).resolve(), dst)
+    except OSError:
+        shutil.copy2(src, dst)
@@ -0,0 +1,514 @@
+from pathlib import Path
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections.abc import Iterator, Mapping, Sequence
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import argparse
+import json
+import logging
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+
+LEDGER_ENV = "MACVIN_LEDGER"
+DEFAULT_LEDGER = Path("macvin_runs.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    parent_id INTEGER REFERENCES runs(id),
+    kind TEXT NOT NULL,               -- 'stage' or 'container'
+    cruise TEXT,
+    stage TEXT,
+    image TEXT,
+    image_digest TEXT,
+    env TEXT,                         -- json
+    mounts TEXT,                      -- json
+    output_dir TEXT,
+    input_files INTEGER DEFAULT 0,
+    input_bytes INTEGER DEFAULT 0,
+    output_files INTEGER DEFAULT 0,
+    output_bytes INTEGER DEFAULT 0,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    status TEXT NOT NULL,             -- 'running', 'ok', 'failed'
+    exit_code INTEGER,
+    error TEXT,
+    dry_run INTEGER DEFAULT 0,
+    host TEXT,
+    peak_cpus REAL,
+    peak_memory_bytes INTEGER,
+    log_file TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_stage ON runs (stage, start_time);
+CREATE INDEX IF NOT EXISTS runs_cruise ON runs (cruise, stage);
+CREATE INDEX IF NOT EXISTS runs_output_dir ON runs (output_dir);
+"""
+
+# Columns added after the first version of the schema
+COLUMNS = {
+    "peak_cpus": "REAL",
+    "peak_memory_bytes": "INTEGER",
+    "log_file": "TEXT",
+}
+
+_current: ContextVar["Run | None"] = ContextVar("macvin_run", default=None)
+_digests: dict[str, str | None] = {}
+
+
+def ledger_path() -> Path:
+    return Path(os.getenv(LEDGER_ENV, DEFAULT_LEDGER))
+
+
+def connect(path: Path | None = None) -> sqlite3.Connection:
+    con = sqlite3.connect(path or ledger_path(), timeout=30)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.executescript(SCHEMA)
+    existing = {row["name"] for row in con.execute("PRAGMA table_info(runs)")}
+    for name, kind in COLUMNS.items():
+        if name not in existing:
+            con.execute(f"ALTER TABLE runs ADD COLUMN {name} {kind}")
+    return con
+
+
+@dataclass
+class Run:
+    id: int | None
+    cruise: str | None
+    stage: str | None
+    start_time: float = field(default_factory=time.time)
+    counts: dict[str, int] = field(
+        default_factory=lambda: {
+            "input_files": 0,
+            "input_bytes": 0,
+            "output_files": 0,
+            "output_bytes": 0,
+        }
+    )
+
+    peak_cpus: float | None = None
+    peak_memory_bytes: int | None = None
+    log_file: str | None = None
+
+    def add(self, **counts: int):
+        for key, value in counts.items():
+            self.counts[key] += value
+
+
+def current_run() -> Run | None:
+    return _current.get()
+
+
+def dir_usage(path: Path, since: float | None = None) -> tuple[int, int]:
+    """Return (files, bytes) in a directory tree, optionally only files modified after `since`."""
+    files = nbytes = 0
+    for dirpath, _, filenames in os.walk(path, followlinks=True):
+        for name in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if since is None or st.st_mtime >= since:
+                files += 1
+                nbytes += st.st_size
+    return files, nbytes
+
+
+def image_digest(image: str) -> str | None:
+    """Return the id of a local docker image (cached per process)."""
+    if image not in _digests:
+        try:
+            out = subprocess.run(
+                ["docker", "image", "inspect", "--format", "{{.Id}}", image],
+                capture_output=True,
+                text=True,
+                check=True,
+                timeout=30,
+            )
+            _digests[image] = out.stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            _digests[image] = None
+    return _digests[image]
+
+
+def _insert(**values) -> int | None:
+    values.setdefault("host", platform.node())
+    cols = ", ".join(values)
+    marks = ", ".join("?" for _ in values)
+    try:
+        with connect() as con:
+            cur = con.execute(
+                f"INSERT INTO runs ({cols}) VALUES ({marks})", list(values.values())
+            )
+            return cur.lastrowid
+    except sqlite3.Error:
+        logger.exception("Could not write to the run ledger")
+        return None
+
+
+def _update(run_id: int | None, **values):
+    if run_id is None:
+        return
+    assignments = ", ".join(f"{k} = ?" for k in values)
+    try:
+        with connect() as con:
+            con.execute(
+                f"UPDATE runs SET {assignments} WHERE id = ?", [*values.values(), run_id]
+            )
+    except sqlite3.Error:
+        logger.exception("Could not write to the run ledger")
+
+
+@contextmanager
+def record_stage(
+    cruise: str,
+    stage: str,
+    output_dir: Path | None = None,
+    dry_run: bool = False,
+) -> Iterator[Run]:
+    """
+    Record a processing stage for one cruise in the run ledger.
+
+    Container runs started inside the block are recorded as children of the
+    stage and their file counts are added to the stage.
+    """
+    run = Run(id=None, cruise=cruise, stage=stage)
+    run.id = _insert(
+        kind="stage",
+        cruise=cruise,
+        stage=stage,
+        output_dir=str(output_dir) if output_dir else None,
+        start_time=run.start_time,
+        status="running",
+        dry_run=int(dry_run),
+    )
+    token = _current.set(run)
+    try:
+        yield run
+    except BaseException as e:
+        _update(run.id, end_time=time.time(), status="failed", error=repr(e), **run.counts)
+        raise
+    else:
+        _update(run.id, end_time=time.time(), status="ok", **run.counts)
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def record_container(
+    image: str,
+    volumes: Mapping[str, str],
+    outputs: Sequence[str] = (),
+    env: Mapping[str, str] | None = None,
+    dry_run: bool = False,
+) -> Iterator[Run]:
+    """
+    Record a container run in the run ledger.
+
+    `outputs` are the container paths of the output volumes, all other
+    volumes are counted as inputs.
+    """
+    parent = current_run()
+    run = Run(
+        id=None,
+        cruise=parent.cruise if parent else None,
+        stage=parent.stage if parent else None,
+    )
+
+    input_files = input_bytes = 0
+    if not dry_run:
+        for container_path, host_path in volumes.items():
+            if container_path not in outputs:
+                n, b = dir_usage(Path(host_path))
+                input_files += n
+                input_bytes += b
+    run.add(input_files=input_files, input_bytes=input_bytes)
+
+    run.id = _insert(
+        kind="container",
+        parent_id=parent.id if parent else None,
+        cruise=run.cruise,
+        stage=run.stage,
+        image=image,
+        image_digest=None if dry_run else image_digest(image),
+        env=json.dumps(dict(env or {}), default=str),
+        mounts=json.dumps(dict(volumes)),
+        start_time=run.start_time,
+        status="running",
+        dry_run=int(dry_run),
+        input_files=input_files,
+        input_bytes=input_bytes,
+    )
+
+    def _finish(**values):
+        if not dry_run:
+            for container_path in outputs:
+                n, b = dir_usage(Path(volumes[container_path]), since=run.start_time)
+                run.add(output_files=n, output_bytes=b)
+        _update(
+            run.id,
+            end_time=time.time(),
+            peak_cpus=run.peak_cpus,
+            peak_memory_bytes=run.peak_memory_bytes,
+            log_file=run.log_file,
+            **run.counts,
+            **values,
+        )
+        if parent is not None:
+            parent.add(**run.counts)
+
+    try:
+        yield run
+    except subprocess.CalledProcessError as e:
+        _finish(status="failed", exit_code=e.returncode, error=repr(e))
+        raise
+    except BaseException as e:
+        _finish(status="failed", error=repr(e))
+        raise
+    else:
+        _finish(status="ok", exit_code=None if dry_run else 0)
+
+
+# ------------------
+# Queries
+# ------------------
+
+def stage_throughput(con: sqlite3.Connection, since: float = 0.0) -> list[dict]:
+    """Throughput per stage for successful, non dry-run stage runs since `since`."""
+    rows = con.execute(
+        """
+        SELECT stage, end_time - start_time AS duration, input_bytes, input_files
+        FROM runs
+        WHERE kind = 'stage' AND status = 'ok' AND dry_run = 0
+              AND end_time IS NOT NULL AND start_time >= ?
+        ORDER BY stage, start_time
+        """,
+        (since,),
+    ).fetchall()
+
+    stages: dict[str, list[sqlite3.Row]] = {}
+    for row in rows:
+        stages.setdefault(row["stage"], []).append(row)
+
+    result = []
+    for stage, runs in stages.items():
+        durations = [r["duration"] for r in runs]
+        gb = sum(r["input_bytes"] for r in runs) / 1e9
+        result.append(
+            {
+                "stage": stage,
+                "runs": len(runs),
+                "median_s": statistics.median(durations),
+                "total_h": sum(durations) / 3600,
+                "input_gb": gb,
+                "s_per_gb": sum(durations) / gb if gb else None,
+                "files_per_s": sum(r["input_files"] for r in runs) / sum(durations)
+                if sum(durations)
+                else None,
+            }
+        )
+    return result
+
+
+def regressions(con: sqlite3.Connection, window: int = 5, factor: float = 1.5) -> list[dict]:
+    """
+    Stage runs that were more than `factor` times slower per GB of input than
+    the median of the previous `window` runs of the same stage.
+    """
+    rows = con.execute(
+        """
+        SELECT id, cruise, stage, start_time, end_time - start_time AS duration, input_bytes
+        FROM runs
+        WHERE kind = 'stage' AND status = 'ok' AND dry_run = 0
+              AND end_time IS NOT NULL AND input_bytes > 0
+        ORDER BY stage, start_time
+        """
+    ).fetchall()
+
+    found = []
+    history: dict[str, list[float]] = {}
+    for row in rows:
+        s_per_gb = row["duration"] / (row["input_bytes"] / 1e9)
+        previous = history.setdefault(row["stage"], [])[-window:]
+        if len(previous) >= 2:
+            baseline = statistics.median(previous)
+            if s_per_gb > factor * baseline:
+                found.append(
+                    {
+                        "id": row["id"],
+                        "cruise": row["cruise"],
+                        "stage": row["stage"],
+                        "start": _fmt_time(row["start_time"]),
+                        "s_per_gb": s_per_gb,
+                        "baseline_s_per_gb": baseline,
+                    }
+                )
+        history[row["stage"]].append(s_per_gb)
+    return found
+
+
+def peak_usage(con: sqlite3.Connection) -> dict[str, tuple[float, int]]:
+    """
+    Highest measured (cpus, memory bytes) per image over finished container
+    runs, including failed runs, since a run killed at its memory limit
+    needed at least that much.
+    """
+    rows = con.execute(
+        """
+        SELECT image, MAX(peak_cpus) AS cpus, MAX(peak_memory_bytes) AS memory
+        FROM runs
+        WHERE kind = 'container' AND status IN ('ok', 'failed') AND dry_run = 0
+              AND peak_cpus IS NOT NULL AND peak_memory_bytes IS NOT NULL
+        GROUP BY image
+        """
+    ).fetchall()
+    return {row["image"]: (row["cpus"], row["memory"]) for row in rows}
+
+
+def lineage(con: sqlite3.Connection, path: Path) -> list[sqlite3.Row]:
+    """Successful stage runs (with their container images) that wrote to the directory of `path`."""
+    path = Path(path).absolute()
+    output_dir = path if path.is_dir() else path.parent
+    return con.execute(
+        """
+        SELECT s.id, s.cruise, s.stage, s.start_time, s.end_time,
+               c.image, c.image_digest, c.env
+        FROM runs s LEFT JOIN runs c ON c.parent_id = s.id AND c.kind = 'container'
+        WHERE s.kind = 'stage' AND s.status = 'ok' AND s.dry_run = 0 AND s.output_dir = ?
+        ORDER BY s.start_time DESC
+        """,
+        (str(output_dir),),
+    ).fetchall()
+
+
+def last_stages(con: sqlite3.Connection) -> dict[str, tuple[str, float]]:
+    """The last successful stage run and its end time per cruise."""
+    rows = con.execute(
+        """
+        SELECT cruise, stage, MAX(end_time) AS end_time
+        FROM runs
+        WHERE kind = 'stage' AND status = 'ok' AND dry_run = 0 AND end_time IS NOT NULL
+        GROUP BY cruise
+        """
+    ).fetchall()
+    return {row["cruise"]: (row["stage"], row["end_time"]) for row in rows}
+
+
+def _fmt_time(t: float | None) -> str:
+    return "-" if t is None else datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _print_table(rows: list[dict]):
+    if not rows:
+        print("No runs found")
+        return
+    cols = list(rows[0])
+
+    def fmt(v):
+        if isinstance(v, float):
+            return f"{v:.2f}"
+        return "-" if v is None else str(v)
+
+    widths = {c: max(len(c), *(len(fmt(r[c])) for r in rows)) for c in cols}
+    print("  ".join(c.ljust(widths[c]) for c in cols))
+    for r in rows:
+        print("  ".join(fmt(r[c]).ljust(widths[c]) for c in cols))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the MACVIN run ledger")
+    parser.add_argument(
+        "--ledger", type=Path, default=None, help=f"Ledger file (default: {DEFAULT_LEDGER})"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", help="List recent stage runs")
+    p.add_argument("--cruise", type=str)
+    p.add_argument("--stage", type=str)
+    p.add_argument("--limit", type=int, default=20)
+
+    p = sub.add_parser("throughput", help="Throughput per stage")
+    p.add_argument("--days", type=float, default=30, help="Only runs from the last N days")
+
+    p = sub.add_parser("regressions", help="Runs that were slower per GB than usual")
+    p.add_argument("--window", type=int, default=5)
+    p.add_argument("--factor", type=float, default=1.5)
+
+    sub.add_parser("profiles", help="Resource profiles per image used for the docker limits")
+
+    p = sub.add_parser("lineage", help="Runs and images that produced a file or directory")
+    p.add_argument("path", type=Path)
+
+    args = parser.parse_args()
+    con = connect(args.ledger)
+
+    if args.command == "list":
+        query = "SELECT * FROM runs WHERE kind = 'stage'"
+        params: list = []
+        if args.cruise:
+            query += " AND cruise = ?"
+            params.append(args.cruise)
+        if args.stage:
+            query += " AND stage = ?"
+            params.append(args.stage)
+        query += " ORDER BY start_time DESC LIMIT ?"
+        params.append(args.limit)
+        _print_table(
+            [
+                {
+                    "id": r["id"],
+                    "cruise": r["cruise"],
+                    "stage": r["stage"],
+                    "start": _fmt_time(r["start_time"]),
+                    "duration_s": (r["end_time"] - r["start_time"]) if r["end_time"] else None,
+                    "in_files": r["input_files"],
+                    "in_gb": r["input_bytes"] / 1e9,
+                    "out_files": r["output_files"],
+                    "status": r["status"] + (" (dry run)" if r["dry_run"] else ""),
+                }
+                for r in con.execute(query, params)
+            ]
+        )
+    elif args.command == "throughput":
+        since = (datetime.now() - timedelta(days=args.days)).timestamp()
+        _print_table(stage_throughput(con, since))
+    elif args.command == "regressions":
+        _print_table(regressions(con, args.window, args.factor))
+    elif args.command == "profiles":
+        from macvin.resources import DEFAULT_PROFILES, load_profiles
+
+        measured = peak_usage(con)
+        _print_table(
+            [
+                {
+                    "image": image,
+                    "cpus": profile.cpus,
+                    "memory_gb": profile.memory_gb,
+                    "peak_cpus": measured.get(image, (None, None))[0],
+                    "peak_memory_gb": measured[image][1] / 1024**3 if image in measured else None,
+                    "default": profile == DEFAULT_PROFILES.get(image),
+                }
+                for image, profile in load_profiles(ledger=args.ledger).items()
+            ]
+        )
+    elif args.command == "lineage":
+        _print_table(
+            [
+                {
+                    "id": r["id"],
+                    "cruise": r["cruise"],
+                    "stage": r["stage"],
+                    "start": _fmt_time(r["start_time"]),
+                    "image": r["image"],
+                    "digest": r["image_digest"],
+                }
+                for r in lineage(con, args.path)
+            ]
+        )
@@ -1,8 +1,24 @@
+import atexit
+import collections
+import gzip
+import itertools
 import logging
 import logging.handlers
+import os
+import queue
+import re
 import sys
+import threading
+import time
 from pathlib import Path
 
+CONTAINER_LOG_DIR_ENV = "MACVIN_CONTAINER_LOG_DIR"
+DEFAULT_CONTAINER_LOG_DIR = Path("logs", "containers")
+LOG_HEAD_ENV = "MACVIN_LOG_HEAD"
+LOG_INTERVAL_ENV = "MACVIN_LOG_INTERVAL"
+
+_log_numbers = itertools.count(1)
+
 
 class ColorFormatter(logging.Formatter):
     COLORS = {
@@ -32,6 +48,10 @@ def setup_logging(
       - rotating file handler (DEBUG+, no color)
 
     DEBUG < INFO < WARNING < ERROR < CRITICAL
+
+    The logger only puts records on a queue, the handlers run in a
+    QueueListener thread so logging never blocks the caller on terminal or
+    file I/O.
     """
 
     logger = logging.getLogger(name)
@@ -44,7 +64,7 @@ def setup_logging(
     log_file = Path(log_file)
 
     # ---- Base format ----
-    fmt = "%(asctime)s | %(levelname)-8s | %(name)s | %(message)s"
+    fmt = "%(asctime)s | %(levelname)-8s | %(threadName)s | %(name)s | %(message)s"
     datefmt = "%Y-%m-%d %H:%M:%S"
 
     plain_formatter = logging.Formatter(fmt=fmt, datefmt=datefmt)
@@ -70,9 +90,108 @@ def setup_logging(
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(plain_formatter)
 
-    # ---- attach handlers ----
-    logger.addHandler(stdout_handler)
-    logger.addHandler(stderr_handler)
-    logger.addHandler(file_handler)
+    # ---- attach handlers through a queue ----
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue,
+        stdout_handler,
+        stderr_handler,
+        file_handler,
+        respect_handler_level=True,
+    )
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
 
     return logger
+
+
+class ContainerLog:
+    """
+    Output of one container run.
+
+    Every line is written raw to a gzip compressed log file. Only a sample is
+    forwarded to `logger`: the first `head` lines, lines that look like
+    errors or warnings (at most `max_important`), and a progress line every
+    `interval` seconds. `close` logs a summary, and the last `tail` lines if
+    the run failed.
+    """
+
+    IMPORTANT = re.compile(r"error|exception|fatal|warn|traceback", re.IGNORECASE)
+
+    def __init__(
+        self,
+        path: Path,
+        logger: logging.Logger,
+        label: str,
+        head: int | None = None,
+        interval: float | None = None,
+        tail: int = 50,
+        max_important: int = 200,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.logger = logger
+        self.label = label
+        self.head = head if head is not None else int(os.getenv(LOG_HEAD_ENV, 20))
+        self.interval = interval if interval is not None else float(os.getenv(LOG_INTERVAL_ENV, 30))
+        self.max_important = max_important
+        self.lines = 0
+        self.stderr_lines = 0
+        self.important = 0
+        self._tail: collections.deque[str] = collections.deque(maxlen=tail)
+        self._last_summary = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, "wt", compresslevel=1)
+
+    def write(self, line: str, stderr: bool = False):
+        line = line.rstrip()
+        with self._lock:
+            self.lines += 1
+            if stderr:
+                self.stderr_lines += 1
+                line = f"[stderr] {line}"
+            self._file.write(line + "\n")
+            self._tail.append(line)
+            n = self.lines
+
+            if n <= self.head:
+                forward = "head"
+            elif self.IMPORTANT.search(line) and self.important < self.max_important:
+                self.important += 1
+                forward = "important"
+            elif time.monotonic() - self._last_summary >= self.interval:
+                self._last_summary = time.monotonic()
+                forward = "summary"
+            else:
+                forward = None
+
+        if forward == "head":
+            (self.logger.warning if stderr else self.logger.info)(line)
+        elif forward == "important":
+            self.logger.warning(line)
+            if self.important == self.max_important:
+                self.logger.warning(
+                    f"{self.label}: further error/warning lines only in {self.path}"
+                )
+        elif forward == "summary":
+            self.logger.info(f"{self.label}: {n} lines so far, last: {line}")
+
+    def close(self, failed: bool = False):
+        with self._lock:
+            self._file.close()
+        self.logger.info(
+            f"{self.label}: {self.lines} lines ({self.stderr_lines} on stderr) written to {self.path}"
+        )
+        if failed and self._tail:
+            self.logger.error(
+                f"{self.label}: last {len(self._tail)} lines:\n" + "\n".join(self._tail)
+            )
+
+
+def container_log_path(label: str) -> Path:
+    """Path of the compressed log of a container run, unique per run."""
+    root = Path(os.getenv(CONTAINER_LOG_DIR_ENV, DEFAULT_CONTAINER_LOG_DIR))
+    safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", label)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return root / f"{stamp}-{safe}-{os.getpid()}-{next(_log_numbers)}.log.gz"
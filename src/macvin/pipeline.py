@@ -1,5 +1,6 @@
 import argparse
 import logging
+import sys
 from pathlib import Path
 
 from macvin.flows import (
@@ -9,13 +10,18 @@ from macvin.flows import (
     macvin_idxprocessing_flow,
     macvin_convert_ek500_flow,
     macvin_atcprocessing_flow,
+    macvin_run_flow,
+    DEFAULT_STAGES,
+    DEFAULT_STAGE_JOBS,
+    STAGES,
     atc2zarr_flow,
     preprocess2zarr_flow,
 )
-from macvin.analyzedata import macvin_consistency_flow
 from macvin.logging import setup_logging
+from macvin.profiling import LOG_FILE, add_profile_argument, profiling
+from macvin.trace import tracing
 
-setup_logging(log_file="macvin.log")
+setup_logging(log_file=LOG_FILE)
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +30,14 @@ SILVERDIR = Path("/data/s3/MACWIN-scratch/silver")
 DEFAULT_CRUISE_HELP = "Cruise name to process, e.g. S1513S_PSCOTIA_MXHR6"
 
 
-def run_flow(flow, *, cruise_required=False, extra_args=None):
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+
+def run_flow(flow, *, cruise_required=False, extra_args=None, dask=False):
     parser = argparse.ArgumentParser()
     parser.add_argument("--dry-run", action="store_true")
     parser.add_argument(
@@ -40,13 +53,18 @@ def run_flow(flow, *, cruise_required=False, extra_args=None):
         help=DEFAULT_CRUISE_HELP,
     )
 
+    add_profile_argument(parser)
+
     if extra_args:
         extra_args(parser)
 
     args = parser.parse_args()
     kwargs = vars(args)
+    profile = kwargs.pop("profile")
 
-    flow(**kwargs)
+    name = flow.__name__ + (f"-{args.cruise}" if args.cruise else "")
+    with tracing(name), profiling(flow.__name__, args.cruise, enabled=profile, dask=dask):
+        return flow(**kwargs)
 
 
 def ek500conversion():
@@ -82,4 +100,43 @@ def lufreports():
 
 
 def checkconsistency():
-    run_flow(macvin_consistency_flow)
+    # Imports dask, xarray and matplotlib, so only loaded for this command
+    from macvin.analyzedata import macvin_consistency_flow
+
+    run_flow(macvin_consistency_flow, dask=True)
+
+
+def run():
+    def extra_args(parser):
+        parser.add_argument(
+            "--stages",
+            type=str,
+            default=DEFAULT_STAGES,
+            help=f"Comma separated stages to run, any of {', '.join(STAGES)} (default: {DEFAULT_STAGES})",
+        )
+        parser.add_argument(
+            "--jobs",
+            type=positive_int,
+            default=1,
+            help="Number of stages to run in parallel (default: 1)",
+        )
+        parser.add_argument(
+            "--stage-jobs",
+            type=str,
+            default=DEFAULT_STAGE_JOBS,
+            help=f"Max cruises per stage at the same time (default: {DEFAULT_STAGE_JOBS})",
+        )
+        parser.add_argument(
+            "--plan",
+            action="store_true",
+            help="Only log the estimated schedule and ETA of the run",
+        )
+        parser.add_argument(
+            "--queue",
+            type=str,
+            help="Share the stages with other macvin-run workers using the same queue name and silver dir",
+        )
+
+    status = run_flow(macvin_run_flow, extra_args=extra_args)
+    if "failed" in status.values():
+        sys.exit(1)
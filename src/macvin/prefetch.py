@@ -0,0 +1,110 @@
+from pathlib import Path
+from collections.abc import Sequence
+import logging
+import os
+import queue
+import threading
+
+from macvin.cache import ReadCache, get_cache
+from macvin.exclusions import load_exclusions
+from macvin.views import list_files
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_DEPTH_ENV = "MACVIN_PREFETCH_DEPTH"
+PREFETCH_BANDWIDTH_ENV = "MACVIN_PREFETCH_MBPS"
+DEFAULT_PREFETCH_DEPTH = 1
+DEFAULT_PREFETCH_MBPS = 50.0
+
+# (cruise, input directories)
+PrefetchJob = tuple[str, list[Path]]
+
+
+class Prefetcher:
+    """
+    Stage the inputs of upcoming cruises into the read cache in the background.
+
+    The flow calls `advance(jobs, cruise)` before processing a cruise, and the
+    inputs of the next `depth` cruises in `jobs` are queued for prefetching. Copies
+    are limited to `bytes_per_second` so the prefetch does not starve the
+    running containers. Without a read cache the prefetcher does nothing.
+
+    Use as a context manager to stop the background thread when the flow ends.
+    """
+
+    def __init__(
+        self,
+        cache: ReadCache | None = None,
+        depth: int | None = None,
+        bytes_per_second: float | None = None,
+    ):
+        self.cache = cache if cache is not None else get_cache()
+        if depth is None:
+            depth = int(os.getenv(PREFETCH_DEPTH_ENV, DEFAULT_PREFETCH_DEPTH))
+        if bytes_per_second is None:
+            mbps = float(os.getenv(PREFETCH_BANDWIDTH_ENV, DEFAULT_PREFETCH_MBPS))
+            bytes_per_second = mbps * 1e6 if mbps > 0 else None
+        self.depth = depth
+        self.bytes_per_second = bytes_per_second
+        self._queue: queue.Queue[PrefetchJob | None] = queue.Queue()
+        self._submitted: set[str] = set()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache is not None and self.depth > 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def advance(self, jobs: Sequence[PrefetchJob], current: str):
+        """Queue the jobs after the `current` cruise that are within the prefetch depth."""
+        if not self.enabled:
+            return
+        position = [cruise for cruise, _ in jobs].index(current) if jobs else -1
+        for cruise, dirs in jobs[position + 1 : position + 1 + self.depth]:
+            if cruise in self._submitted:
+                continue
+            self._submitted.add(cruise)
+            self._queue.put((cruise, dirs))
+            logger.info(f"Prefetching inputs for {cruise}")
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="macvin-prefetch", daemon=True
+            )
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        exclusions = load_exclusions()
+        while not self._stop.is_set():
+            job = self._queue.get()
+            if job is None:
+                break
+            cruise, dirs = job
+            matcher = exclusions.for_cruise(cruise)
+            for source_dir in dirs:
+                if self._stop.is_set():
+                    break
+                if not source_dir.is_dir():
+                    logger.debug(f"Nothing to prefetch in {source_dir}")
+                    continue
+                try:
+                    allowed, _ = matcher.split(list_files(source_dir))
+                    self.cache.stage(
+                        allowed,
+                        bytes_per_second=self.bytes_per_second,
+                        stop=self._stop,
+                    )
+                except Exception:
+                    logger.exception(f"Prefetch of {source_dir} failed for {cruise}")
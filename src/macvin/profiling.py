@@ -0,0 +1,115 @@
+from pathlib import Path
+from contextlib import ExitStack, contextmanager
+from collections.abc import Iterator
+from datetime import datetime
+import argparse
+import cProfile
+import io
+import json
+import logging
+import pstats
+import re
+
+logger = logging.getLogger(__name__)
+
+# The console scripts log to this file, profiles are written next to it
+LOG_FILE = Path("macvin.log")
+
+
+def add_profile_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=f"Write a cProfile (and a dask report for dask flows) next to {LOG_FILE}",
+    )
+
+
+def profile_path(command: str, cruise: str | None = None, suffix: str = ".prof", log_file: Path = LOG_FILE) -> Path:
+    """`<log dir>/<command>-<cruise>-<stamp><suffix>`, with unsafe characters replaced."""
+    parts = [command, cruise] if cruise else [command]
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", "-".join(parts))
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    return Path(log_file).parent / f"{name}-{stamp}{suffix}"
+
+
+@contextmanager
+def _dask_report(command: str, cruise: str | None, log_file: Path) -> Iterator[None]:
+    """
+    A dask performance report of the block. With dask.distributed the
+    report of the active client (or an in-process one) is written as
+    HTML, otherwise the task timings of the local scheduler are written as
+    JSON, summed per task prefix.
+    """
+    try:
+        from distributed import Client, get_client, performance_report
+    except ImportError:
+        performance_report = None
+
+    if performance_report is not None:
+        with ExitStack() as stack:
+            try:
+                get_client()
+            except ValueError:
+                stack.enter_context(Client(processes=False))
+            html = profile_path(command, cruise, "-dask-report.html", log_file)
+            stack.enter_context(performance_report(filename=str(html)))
+            yield
+        logger.info(f"Dask performance report written to {html}")
+        return
+
+    from dask.diagnostics import Profiler
+
+    with Profiler() as tasks:
+        yield
+
+    prefixes: dict[str, dict] = {}
+    for t in tasks.results:
+        key = t.key[0] if isinstance(t.key, tuple) else t.key
+        prefix = str(key).rsplit("-", 1)[0]
+        entry = prefixes.setdefault(prefix, {"tasks": 0, "seconds": 0.0})
+        entry["tasks"] += 1
+        entry["seconds"] += t.end_time - t.start_time
+    report = {
+        "tasks": len(tasks.results),
+        "task_prefixes": dict(sorted(prefixes.items(), key=lambda kv: -kv[1]["seconds"])),
+    }
+    path = profile_path(command, cruise, "-dask-tasks.json", log_file)
+    path.write_text(json.dumps(report, indent=2))
+    logger.info(f"Dask task timings written to {path}")
+
+
+@contextmanager
+def profiling(
+    command: str,
+    cruise: str | None = None,
+    enabled: bool = True,
+    dask: bool = False,
+    log_file: Path = LOG_FILE,
+) -> Iterator[None]:
+    """
+    Profile the block with cProfile and write the stats next to the log
+    file, with the command and cruise in the file name. The .prof file can
+    be read with pstats or snakeviz; the 30 most expensive functions are
+    also logged. Since Python 3.12 the profile includes the worker threads.
+    With `dask=True` a dask performance report is written as well.
+    """
+    if not enabled:
+        yield
+        return
+
+    prof_file = profile_path(command, cruise, ".prof", log_file)
+    with ExitStack() as stack:
+        if dask:
+            stack.enter_context(_dask_report(command, cruise, log_file))
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            prof_file.parent.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(prof_file)
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+            logger.debug(out.getvalue())
+            logger.info(f"Profile written to {prof_file}")
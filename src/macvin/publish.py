@@ -0,0 +1,246 @@
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import platform
+import shutil
+
+from macvin.trace import span
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR_ENV = "MACVIN_STAGING_DIR"
+PUBLISH_WORKERS_ENV = "MACVIN_PUBLISH_WORKERS"
+DEFAULT_PUBLISH_WORKERS = 16
+
+# Written into an output directory when a stage has completely published it
+MARKER = ".macvin_complete.json"
+
+
+def read_marker(output_dir: Path) -> dict | None:
+    """Return the completion marker of an output directory, or None if incomplete."""
+    try:
+        return json.loads((Path(output_dir) / MARKER).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def is_complete(output_dir: Path) -> bool:
+    return read_marker(output_dir) is not None
+
+
+def marker_time(output_dir: Path) -> float | None:
+    """When the completion marker was written (file system time), or None if incomplete."""
+    try:
+        return (Path(output_dir) / MARKER).stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+_HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+
+def hdf5_complete(path: Path) -> bool | None:
+    """
+    Whether an HDF5 (NetCDF4) file was closed by its writer: the library
+    truncates the file to the end of file address in the superblock on close,
+    so a file that is shorter or longer was cut off while being written.
+    Returns None for files that are not HDF5.
+    """
+    size = os.stat(path).st_size
+    with open(path, "rb") as fid:
+        # The superblock is at 0, 512, 1024, 2048, ... after an optional user block
+        offset = 0
+        while offset + len(_HDF5_SIGNATURE) <= size:
+            fid.seek(offset)
+            head = fid.read(64)
+            if head.startswith(_HDF5_SIGNATURE):
+                break
+            offset = 512 if offset == 0 else offset * 2
+        else:
+            return None
+
+    version = head[8]
+    if version in (0, 1):
+        n, pos = head[13], 24 + 4 * version
+    elif version in (2, 3):
+        # Version 3 also flags a file that is open for writing
+        if version == 3 and head[11] & 0x1:
+            return False
+        n, pos = head[9], 12
+    else:
+        return None
+    if len(head) < pos + 3 * n:
+        return False
+    base = int.from_bytes(head[pos : pos + n], "little")
+    eof = int.from_bytes(head[pos + 2 * n : pos + 3 * n], "little")
+    return base + eof == size
+
+
+def finished_files(files: Iterable[Path]) -> list[Path]:
+    """
+    The files among the output of an interrupted stage that were written
+    completely. Empty files and HDF5 files that were not closed are left
+    out. Other files cannot be checked, so the most recently written of
+    them is left out as well, in case it was cut off.
+    """
+    finished, unchecked = [], []
+    for p in files:
+        st = os.stat(p)
+        if st.st_size == 0:
+            continue
+        complete = hdf5_complete(p)
+        if complete is None:
+            unchecked.append((st.st_mtime, p))
+        elif complete:
+            finished.append(p)
+        else:
+            logger.debug(f"{p} was not closed by its writer")
+    if unchecked:
+        newest = max(unchecked)[1]
+        finished += [p for _, p in unchecked if p != newest]
+    return finished
+
+
+def clear_marker(output_dir: Path):
+    (Path(output_dir) / MARKER).unlink(missing_ok=True)
+
+
+def write_marker(output_dir: Path, **info):
+    """Atomically write the completion marker."""
+    output_dir = Path(output_dir)
+    if "files" not in info:
+        files = [p for p in output_dir.rglob("*") if p.is_file() and p.name != MARKER]
+        info["files"] = len(files)
+        info["bytes"] = sum(p.stat().st_size for p in files)
+    marker = {
+        **info,
+        "host": platform.node(),
+        "completed": datetime.now(timezone.utc).isoformat(),
+    }
+    tmp = output_dir / f".{MARKER}.partial"
+    tmp.write_text(json.dumps(marker, indent=2))
+    os.replace(tmp, output_dir / MARKER)
+    return marker
+
+
+def _publish_file(src: Path, dst: Path) -> int:
+    tmp = dst.parent / f".partial-{dst.name}"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+    return src.stat().st_size
+
+
+def publish(
+    staging_dir: Path,
+    output_dir: Path,
+    workers: int | None = None,
+    files: list[Path] | None = None,
+) -> tuple[int, int]:
+    """
+    Copy the content of `staging_dir` into `output_dir` with a parallel bulk copy.
+
+    Every file is written to a temporary name and renamed into place. Files
+    left in a published sub directory (e.g. a zarr store) from an earlier run
+    that are not part of the new output are removed. With `files` only those
+    files of `staging_dir` are published and nothing is removed.
+    Returns (files, bytes).
+    """
+    if workers is None:
+        workers = int(os.getenv(PUBLISH_WORKERS_ENV, DEFAULT_PUBLISH_WORKERS))
+
+    if files is None:
+        files = [p for p in staging_dir.rglob("*") if p.is_file()]
+        subdirs = {p.relative_to(staging_dir) for p in staging_dir.iterdir() if p.is_dir()}
+    else:
+        subdirs = set()
+
+    for d in {p.parent for p in files}:
+        (output_dir / d.relative_to(staging_dir)).mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        sizes = list(
+            pool.map(
+                lambda p: _publish_file(p, output_dir / p.relative_to(staging_dir)),
+                files,
+            )
+        )
+
+    published = {p.relative_to(staging_dir) for p in files}
+    for d in subdirs:
+        for p in (output_dir / d).rglob("*"):
+            if p.is_file() and p.relative_to(output_dir) not in published:
+                p.unlink()
+
+    return len(files), sum(sizes)
+
+
+def _publish_finished(staging_dir: Path, output_dir: Path, stage: str):
+    """Publish the finished files of a failed stage, without a completion marker."""
+    try:
+        finished = finished_files(p for p in staging_dir.iterdir() if p.is_file())
+        if finished:
+            n_files, n_bytes = publish(staging_dir, output_dir, files=finished)
+            logger.info(f"Published {n_files} finished files ({n_bytes / 1e9:.2f} GB) of the failed {stage} to {output_dir}")
+    except Exception:
+        logger.exception(f"Could not publish the finished files of the failed {stage} from {staging_dir}")
+
+
+@contextmanager
+def staged_output(
+    output_dir: Path,
+    stage: str,
+    cruise: str,
+    dry_run: bool = False,
+) -> Iterator[Path]:
+    """
+    Yield the directory a stage should write its output to.
+
+    If MACVIN_STAGING_DIR is set, a local staging directory is yielded and
+    its content is published to `output_dir` when the block exits without an
+    error. Without staging the output is written directly to `output_dir`.
+    In both cases the completion marker of `output_dir` is removed before the
+    stage runs and written only after the stage (and the publish) succeeded,
+    so a partial output is never mistaken for a finished one.
+
+    When a staged stage fails, the files at the top of the staging directory
+    that `finished_files` accepts are still published, so the next run can
+    resume from them. The staging directory stays until the stage runs again.
+    """
+    output_dir = Path(output_dir)
+    root = os.getenv(STAGING_DIR_ENV)
+
+    if dry_run:
+        yield output_dir
+        return
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    clear_marker(output_dir)
+
+    if not root:
+        yield output_dir
+        write_marker(output_dir, stage=stage, cruise=cruise)
+        return
+
+    staging_dir = Path(root) / output_dir.absolute().relative_to("/")
+    if staging_dir.exists():
+        logger.info(f"Removing leftovers from an earlier run in {staging_dir}")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        yield staging_dir
+    except Exception:
+        _publish_finished(staging_dir, output_dir, stage)
+        raise
+
+    logger.info(f"Publishing {stage} output from {staging_dir} to {output_dir}")
+    with span("publish", "io", stage=stage, cruise=cruise):
+        n_files, n_bytes = publish(staging_dir, output_dir)
+    write_marker(output_dir, stage=stage, cruise=cruise, files=n_files, bytes=n_bytes)
+    logger.info(f"Published {n_files} files ({n_bytes / 1e9:.2f} GB) to {output_dir}")
+    shutil.rmtree(staging_dir, ignore_errors=True)
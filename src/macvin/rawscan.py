@@ -0,0 +1,251 @@
+from pathlib import Path
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import xml.etree.ElementTree as ET
+
+from macvin.resume import file_key
+
+logger = logging.getLogger(__name__)
+
+SCAN_WORKERS_ENV = "MACVIN_SCAN_WORKERS"
+DEFAULT_SCAN_WORKERS = 4
+PROGRESS_INTERVAL_S = 10.0
+
+# Datagram header: type (4 bytes) and NT time (2 x uint32), after the length
+_HEADER = struct.Struct("<4sII")
+_LENGTH = struct.Struct("<i")
+# CON0: transducer count at payload offset 512, then 320 bytes per transducer
+# with the frequency at offset 132
+CON0_COUNT_OFFSET = 512
+CON0_TRANSDUCER_SIZE = 320
+CON0_FREQUENCY_OFFSET = 132
+
+NT_EPOCH = datetime(1601, 1, 1, tzinfo=timezone.utc)
+
+
+def nt_time(low: int, high: int) -> datetime:
+    """NT time (100 ns units since 1601) as a UTC datetime."""
+    return NT_EPOCH + timedelta(microseconds=((high << 32) | low) // 10)
+
+
+@dataclass
+class RawScan:
+    """What the datagram headers of a raw file tell without converting it."""
+
+    name: str
+    size: int
+    mtime_ns: int
+    format: str | None = None  # "EK60" (CON0) or "EK80" (XML0)
+    start: str | None = None
+    end: str | None = None
+    frequencies: list[float] = field(default_factory=list)
+    ping_count: int = 0
+    datagrams: int = 0
+    truncated: bool = False
+    error: str | None = None
+
+    @property
+    def key(self) -> str:
+        return file_key(Path(self.name))
+
+    @property
+    def broken(self) -> bool:
+        """Korona cannot process the file: unreadable, no configuration or no pings."""
+        return self.error is not None
+
+    @property
+    def duration_s(self) -> float:
+        if self.start is None or self.end is None:
+            return 0.0
+        return (datetime.fromisoformat(self.end) - datetime.fromisoformat(self.start)).total_seconds()
+
+
+def _xml_frequencies(payload: bytes) -> list[float] | None:
+    """Transducer frequencies of an EK80 Configuration XML0 datagram, None for other XML0."""
+    try:
+        root = ET.fromstring(payload.rstrip(b"\0").decode("utf-8", errors="replace"))
+    except ET.ParseError:
+        return None
+    if root.tag != "Configuration":
+        return None
+    freqs = []
+    for tag in ("Transducer", "Channel"):
+        for el in root.iter(tag):
+            if "Frequency" in el.attrib:
+                freqs.append(float(el.attrib["Frequency"]))
+        if freqs:
+            break
+    return freqs
+
+
+def scan_raw(path: Path) -> RawScan:
+    """
+    Scan the datagram headers of an EK60 or EK80 .raw file in one pass over
+    a memory map. Pings are counted per channel from the RAW0/RAW3
+    datagrams; the start and end are the first and last ping times.
+    """
+    path = Path(path)
+    st = path.stat()
+    scan = RawScan(name=path.name, size=st.st_size, mtime_ns=st.st_mtime_ns)
+    if st.st_size == 0:
+        scan.error = "empty file"
+        return scan
+
+    pings: dict = {}
+    raw_freqs: set[float] = set()
+    first = last = None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        pos = 0
+        while pos + 4 <= size:
+            (length,) = _LENGTH.unpack_from(mm, pos)
+            if length < _HEADER.size:
+                scan.error = f"invalid datagram length {length} at offset {pos}"
+                break
+            if pos + 8 + length > size:
+                scan.truncated = True
+                break
+            kind, low, high = _HEADER.unpack_from(mm, pos + 4)
+            (end_length,) = _LENGTH.unpack_from(mm, pos + 4 + length)
+            if end_length != length:
+                scan.error = f"datagram length mismatch at offset {pos}"
+                break
+            payload = pos + 4 + _HEADER.size
+            scan.datagrams += 1
+
+            if kind == b"RAW0":
+                channel, _, _, freq = struct.unpack_from("<hhff", mm, payload)
+                pings[channel] = pings.get(channel, 0) + 1
+                raw_freqs.add(float(freq))
+            elif kind == b"RAW3":
+                channel = bytes(mm[payload : payload + 128]).rstrip(b"\0")
+                pings[channel] = pings.get(channel, 0) + 1
+            elif kind == b"CON0":
+                scan.format = "EK60"
+                (count,) = _LENGTH.unpack_from(mm, payload + CON0_COUNT_OFFSET)
+                base = payload + CON0_COUNT_OFFSET + 4
+                scan.frequencies = [
+                    float(struct.unpack_from("<f", mm, base + i * CON0_TRANSDUCER_SIZE + CON0_FREQUENCY_OFFSET)[0])
+                    for i in range(max(count, 0))
+                ]
+            elif kind == b"XML0" and scan.format is None:
+                freqs = _xml_frequencies(bytes(mm[payload : pos + 4 + length]))
+                if freqs is not None:
+                    scan.format = "EK80"
+                    scan.frequencies = freqs
+
+            if kind in (b"RAW0", b"RAW3"):
+                if first is None:
+                    first = (low, high)
+                last = (low, high)
+            pos += length + 8
+
+    if not scan.frequencies and raw_freqs:
+        scan.frequencies = sorted(raw_freqs)
+    scan.ping_count = max(pings.values(), default=0)
+    if first is not None:
+        scan.start = nt_time(*first).isoformat()
+        scan.end = nt_time(*last).isoformat()
+    if scan.error is None and scan.format is None:
+        scan.error = "no CON0 or XML0 configuration datagram"
+    if scan.error is None and scan.ping_count == 0:
+        scan.error = "no pings"
+    return scan
+
+
+def load_raw_index(path: Path) -> dict[str, RawScan]:
+    """The raw index of a cruise (file name -> scan), empty if there is none."""
+    try:
+        data = json.loads(Path(path).read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {d["name"]: RawScan(**d) for d in data.get("files", [])}
+
+
+def save_raw_index(path: Path, scans: Sequence[RawScan]):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(json.dumps({"files": [asdict(s) for s in scans]}, indent=1))
+    os.replace(tmp, path)
+
+
+def update_raw_index(files: Sequence[Path], path: Path, workers: int | None = None) -> list[RawScan]:
+    """
+    Scan the raw files that are new or changed since the index at `path` was
+    written, save the index and return the scans in file order. Progress is
+    logged by bytes scanned, which is what the scan time depends on.
+    """
+    if workers is None:
+        workers = int(os.getenv(SCAN_WORKERS_ENV, DEFAULT_SCAN_WORKERS))
+    files = sorted(Path(f) for f in files)
+    index = load_raw_index(path)
+
+    todo = []
+    for f in files:
+        st = f.stat()
+        known = index.get(f.name)
+        if known is None or known.size != st.st_size or known.mtime_ns != st.st_mtime_ns:
+            todo.append(f)
+
+    if todo:
+        total = sum(f.stat().st_size for f in todo)
+        logger.info(f"Scanning {len(todo)} of {len(files)} raw files ({total / 1e9:.2f} GB)")
+        done_bytes = 0
+        t0 = last_report = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for i, scan in enumerate(pool.map(scan_raw, todo), start=1):
+                index[scan.name] = scan
+                done_bytes += scan.size
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL_S or i == len(todo):
+                    last_report = now
+                    rate = done_bytes / max(now - t0, 1e-9)
+                    eta = (total - done_bytes) / rate if rate else 0.0
+                    logger.info(
+                        f"Scanned {i}/{len(todo)} raw files, {done_bytes / 1e9:.2f}/{total / 1e9:.2f} GB, "
+                        f"{rate / 1e6:.0f} MB/s, ETA {eta:.0f} s"
+                    )
+        scans = [index[f.name] for f in files]
+        save_raw_index(path, scans)
+    else:
+        scans = [index[f.name] for f in files]
+
+    for s in scans:
+        if s.broken:
+            logger.warning(f"{s.name}: {s.error}")
+        elif s.truncated:
+            logger.warning(f"{s.name}: truncated after {s.ping_count} pings")
+    return scans
+
+
+def broken_keys(scans: Sequence[RawScan]) -> set[str]:
+    return {s.key for s in scans if s.broken}
+
+
+def time_shards(scans: Sequence[RawScan], n_shards: int) -> list[list[RawScan]]:
+    """
+    Split the readable files, in time order, into at most `n_shards`
+    contiguous shards with about the same number of pings each.
+    """
+    scans = sorted((s for s in scans if not s.broken), key=lambda s: s.start or "")
+    if not scans or n_shards < 1:
+        return []
+    total = sum(s.ping_count for s in scans)
+    target = total / min(n_shards, len(scans))
+    shards: list[list[RawScan]] = [[]]
+    acc = 0
+    for s in scans:
+        if shards[-1] and acc + s.ping_count / 2 > target * len(shards) and len(shards) < n_shards:
+            shards.append([])
+        shards[-1].append(s)
+        acc += s.ping_count
+    return shards
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+from pathlib import Path
+from itertools import groupby
+from typing import TYPE_CHECKING
+import json
+import logging
+import os
+
+from macvin.trace import traced
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+CONCAT_DIM = "ping_time"
+VERSION = 1
+
+
+def reference_path(nc_dir: Path) -> Path:
+    """The reference index of a directory of NetCDF files, e.g. sv_nc -> sv_nc.refs.json."""
+    nc_dir = Path(nc_dir)
+    return nc_dir.parent / f"{nc_dir.name}.refs.json"
+
+
+def _file_state(files: list[Path]) -> dict[str, list]:
+    state = {}
+    for f in files:
+        st = f.stat()
+        state[f.name] = [st.st_size, st.st_mtime_ns]
+    return state
+
+
+def _open_refs(refs: dict, chunks=None) -> xr.Dataset:
+    import fsspec
+    import xarray as xr
+
+    fs = fsspec.filesystem("reference", fo=refs)
+    return xr.open_dataset(
+        fs.get_mapper(""), engine="zarr", consolidated=False, zarr_format=2, chunks=chunks
+    )
+
+
+def _segment_key(refs: dict) -> tuple:
+    """Array shapes of a file; kerchunk only combines files with equal chunks."""
+    return tuple(
+        sorted(
+            (k, tuple(json.loads(v)["chunks"]))
+            for k, v in refs["refs"].items()
+            if k.endswith("/.zarray")
+        )
+    )
+
+
+def is_current(nc_dir: Path, path: Path | None = None) -> bool:
+    """Whether the index exists and was built from the files now in `nc_dir`."""
+    path = path or reference_path(nc_dir)
+    if not path.exists():
+        return False
+    try:
+        index = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return False
+    files = sorted(Path(nc_dir).glob("*.nc"))
+    return index.get("version") == VERSION and index.get("files") == _file_state(files)
+
+
+@traced(cat="io")
+def build_references(nc_dir: Path, path: Path | None = None, dry_run: bool = False) -> Path | None:
+    """
+    Build a kerchunk reference index of the NetCDF files in `nc_dir`, so the
+    whole collection can be opened lazily with `open_references` without
+    opening every file.
+
+    Consecutive files with the same array shapes are combined into one
+    virtual zarr store along ping_time. A new segment starts where the
+    shapes change or ping_time goes back in time, since kerchunk needs
+    regular chunks and sorts by coordinate value. Files that cannot be read
+    as NetCDF4 with a ping_time are left out with a warning. The index is
+    skipped when it is up to date, and when kerchunk is not installed.
+    """
+    nc_dir = Path(nc_dir)
+    path = path or reference_path(nc_dir)
+    files = sorted(nc_dir.glob("*.nc"))
+    if not files:
+        logger.info(f"No NetCDF files in {nc_dir}, no reference index")
+        return None
+    if dry_run:
+        logger.info(f"Dry run: would build a reference index of {len(files)} files to {path}")
+        return None
+    if is_current(nc_dir, path):
+        logger.info(f"Reference index {path} is up to date")
+        return path
+
+    try:
+        from kerchunk.combine import MultiZarrToZarr
+        from kerchunk.hdf import SingleHdf5ToZarr
+    except ImportError:
+        logger.warning("kerchunk is not installed, no reference index is built")
+        return None
+
+    state = _file_state(files)
+    singles = []
+    skipped = []
+    for f in files:
+        try:
+            with open(f, "rb") as fh:
+                refs = SingleHdf5ToZarr(fh, str(f.absolute())).translate()
+            with _open_refs(refs) as ds:
+                t = ds[CONCAT_DIM].values
+                dims = [d for d in ds.dims if d != CONCAT_DIM and d in ds.coords]
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            logger.warning(f"Leaving {f.name} out of the reference index: {e}")
+            skipped.append(f.name)
+            continue
+        singles.append((f, refs, t[0], t[-1], dims))
+    if not singles:
+        logger.warning(f"None of the {len(files)} files in {nc_dir} could be read, no reference index")
+        return None
+
+    # Split where the shapes change or the ping times are not increasing
+    segment_id = 0
+    ids = []
+    for i, (f, refs, start, end, dims) in enumerate(singles):
+        if i > 0:
+            prev = singles[i - 1]
+            if _segment_key(refs) != _segment_key(prev[1]) or start <= prev[3]:
+                segment_id += 1
+            if start <= prev[3]:
+                logger.warning(f"{f.name} starts before {prev[0].name} ends, ping_time is not monotonic")
+        ids.append(segment_id)
+
+    segments = []
+    for _, group in groupby(zip(ids, singles), key=lambda x: x[0]):
+        members = [s for _, s in group]
+        if len(members) == 1:
+            combined = members[0][1]
+        else:
+            combined = MultiZarrToZarr(
+                [m[1] for m in members],
+                concat_dims=[CONCAT_DIM],
+                identical_dims=members[0][4],
+                coo_map={CONCAT_DIM: f"cf:{CONCAT_DIM}"},
+            ).translate()
+        segments.append(
+            {
+                "files": [m[0].name for m in members],
+                "start": str(members[0][2]),
+                "end": str(members[-1][3]),
+                "refs": combined,
+            }
+        )
+
+    index = {
+        "version": VERSION,
+        "concat_dim": CONCAT_DIM,
+        "source": str(nc_dir.absolute()),
+        "files": state,
+        "skipped": skipped,
+        "segments": segments,
+    }
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(json.dumps(index))
+    os.replace(tmp, path)
+    logger.info(f"Wrote reference index of {len(singles)} files in {len(segments)} segments to {path}")
+    return path
+
+
+def open_references(path: Path, chunks="auto", start=None, end=None) -> xr.Dataset:
+    """
+    Open a reference index as one lazy dataset along ping_time. With
+    `start` and/or `end` only the segments overlapping that time window are
+    opened.
+    """
+    import numpy as np
+    import xarray as xr
+
+    index = json.loads(Path(path).read_text())
+    datasets = []
+    for segment in index["segments"]:
+        if start is not None and np.datetime64(segment["end"]) < np.datetime64(start):
+            continue
+        if end is not None and np.datetime64(segment["start"]) > np.datetime64(end):
+            continue
+        datasets.append(_open_refs(segment["refs"], chunks=chunks))
+    if not datasets:
+        raise ValueError(f"No data in {path} between {start} and {end}")
+    if len(datasets) == 1:
+        return datasets[0]
+    return xr.concat(
+        datasets,
+        dim=index["concat_dim"],
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        join="outer",
+    )
+
+
+def open_collection(nc_dir: Path, chunks="auto") -> xr.Dataset:
+    """
+    Open all NetCDF files in `nc_dir` as one dataset, through the reference
+    index when it is up to date, otherwise with open_mfdataset.
+    """
+    import xarray as xr
+
+    path = reference_path(nc_dir)
+    if is_current(nc_dir, path):
+        try:
+            return open_references(path, chunks=chunks)
+        except ImportError:
+            logger.debug("fsspec is not installed, opening the files instead")
+    return xr.open_mfdataset(str(nc_dir) + "/*.nc", chunks=chunks, combine="by_coords")
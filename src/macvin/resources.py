@@ -0,0 +1,287 @@
+from pathlib import Path
+from contextlib import contextmanager
+from collections.abc import Iterator
+from dataclasses import dataclass
+import json
+import logging
+import math
+import os
+import re
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+RESOURCES_ENV = "MACVIN_RESOURCES"
+ADMISSION_ENV = "MACVIN_ADMISSION"
+RESERVE_ENV = "MACVIN_RESERVE_GB"
+DEFAULT_RESERVE_GB = 4.0
+
+# Measured peaks are scaled by this factor when used as limits
+HEADROOM = 1.25
+
+
+@dataclass(frozen=True)
+class ResourceProfile:
+    cpus: float
+    memory_gb: float
+
+    @property
+    def memory_bytes(self) -> int:
+        return int(self.memory_gb * 1024**3)
+
+    def docker_args(self) -> list[str]:
+        # docker refuses more cpus than the host has
+        cpus = min(self.cpus, os.cpu_count() or self.cpus)
+        return ["--cpus", f"{cpus:g}", "--memory", f"{math.ceil(self.memory_gb * 1024)}m"]
+
+
+# Starting points for the images used by the pipeline. Measured peaks from the
+# run ledger raise these once the images have been run with monitoring, and
+# the file in MACVIN_RESOURCES overrides both.
+DEFAULT_PROFILES = {
+    "acoustic-ek_processing_korona-fixidx:local": ResourceProfile(cpus=1, memory_gb=2),
+    "acoustic-ek_processing_korona-noisefiltering:local": ResourceProfile(cpus=4, memory_gb=8),
+    "acoustic-ek_processing_korona-preprocessing:local": ResourceProfile(cpus=4, memory_gb=8),
+    "acoustic-ek_target-classification_mackerel-korneliussen2016:local": ResourceProfile(
+        cpus=8, memory_gb=16
+    ),
+    "acoustic-ek_processing_nc-zarr:local": ResourceProfile(cpus=4, memory_gb=16),
+    "acoustic-ek_reports_sv-echo-integrator:local": ResourceProfile(cpus=4, memory_gb=16),
+}
+FALLBACK_PROFILE = ResourceProfile(cpus=2, memory_gb=8)
+
+
+def measured_profile(peak_cpus: float | None, peak_memory_bytes: int | None) -> ResourceProfile | None:
+    """Profile from measured peak usage, with headroom and rounded up."""
+    if not peak_cpus or not peak_memory_bytes:
+        return None
+    return ResourceProfile(
+        cpus=max(math.ceil(peak_cpus * HEADROOM * 2) / 2, 0.5),
+        memory_gb=max(math.ceil(peak_memory_bytes * HEADROOM / 1024**3 * 2) / 2, 0.5),
+    )
+
+
+def load_profiles(
+    path: Path | None = None, ledger: Path | None = None
+) -> dict[str, ResourceProfile]:
+    """
+    Resource profiles per image: the defaults, raised to the measured peaks
+    in the run ledger, overridden by the JSON file in MACVIN_RESOURCES, e.g.
+    ``{"acoustic-ek_processing_nc-zarr:local": {"cpus": 2, "memory_gb": 12}}``.
+    """
+    from macvin.ledger import connect, peak_usage
+
+    profiles = dict(DEFAULT_PROFILES)
+
+    try:
+        with connect(ledger) as con:
+            for image, (cpus, memory) in peak_usage(con).items():
+                measured = measured_profile(cpus, memory)
+                if measured is not None:
+                    # Peaks are measured under the limits in use, so they can
+                    # only raise the limits, never lower them
+                    base = profiles.get(image, FALLBACK_PROFILE)
+                    profiles[image] = ResourceProfile(
+                        cpus=max(base.cpus, measured.cpus),
+                        memory_gb=max(base.memory_gb, measured.memory_gb),
+                    )
+    except Exception:
+        logger.exception("Could not read measured peaks from the run ledger")
+
+    path = path or os.getenv(RESOURCES_ENV)
+    if path:
+        for image, values in json.loads(Path(path).read_text()).items():
+            profiles[image] = ResourceProfile(
+                cpus=float(values["cpus"]), memory_gb=float(values["memory_gb"])
+            )
+    return profiles
+
+
+_profiles: dict[str, ResourceProfile] | None = None
+
+
+def profile_for(image: str) -> ResourceProfile:
+    global _profiles
+    if _profiles is None:
+        _profiles = load_profiles()
+    return _profiles.get(image, FALLBACK_PROFILE)
+
+
+def available_memory() -> int | None:
+    """MemAvailable from /proc/meminfo in bytes, None where not available."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def total_memory() -> int | None:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class Admission:
+    """
+    Admit containers only when the host has room for their resource profile.
+
+    The profiles of the admitted containers are reserved against the host
+    cores and memory (minus `reserve_gb` for the system). In addition a new
+    container must fit in the currently available memory and the load
+    average must leave room for its cores, so processes outside the pipeline
+    are taken into account. A container that is larger than the host is
+    admitted when nothing else is running.
+    """
+
+    def __init__(
+        self,
+        cpus: float | None = None,
+        memory_bytes: int | None = None,
+        reserve_gb: float | None = None,
+        poll_interval: float = 10.0,
+    ):
+        if reserve_gb is None:
+            reserve_gb = float(os.getenv(RESERVE_ENV, DEFAULT_RESERVE_GB))
+        self.cpus = cpus or os.cpu_count() or 1
+        total = memory_bytes or total_memory()
+        self.memory_bytes = max(total - int(reserve_gb * 1024**3), 0) if total else None
+        self.reserve_bytes = int(reserve_gb * 1024**3)
+        self.poll_interval = poll_interval
+        self._used_cpus = 0.0
+        self._used_memory = 0
+        self._running = 0
+        self._cond = threading.Condition()
+
+    def _fits(self, profile: ResourceProfile) -> tuple[bool, str]:
+        if self._running == 0:
+            return True, ""
+        if self._used_cpus + profile.cpus > self.cpus:
+            return False, f"{self._used_cpus:g} of {self.cpus:g} cores reserved"
+        if self.memory_bytes is not None and self._used_memory + profile.memory_bytes > self.memory_bytes:
+            return False, f"{self._used_memory / 1024**3:.1f} GB of memory reserved"
+        free = available_memory()
+        if free is not None and free - self.reserve_bytes < profile.memory_bytes:
+            return False, f"{free / 1024**3:.1f} GB memory available"
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            load = 0.0
+        if load + profile.cpus > self.cpus * 1.1:
+            return False, f"load average {load:.1f}"
+        return True, ""
+
+    @contextmanager
+    def admit(self, image: str, profile: ResourceProfile) -> Iterator[None]:
+        """Wait until the container fits on the host and reserve its profile while it runs."""
+        with self._cond:
+            waited = False
+            while True:
+                ok, reason = self._fits(profile)
+                if ok:
+                    break
+                if not waited:
+                    logger.info(
+                        f"Waiting to start {image} ({profile.cpus:g} cores, {profile.memory_gb:g} GB): {reason}"
+                    )
+                    waited = True
+                self._cond.wait(self.poll_interval)
+            self._used_cpus += profile.cpus
+            self._used_memory += profile.memory_bytes
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._used_cpus -= profile.cpus
+                self._used_memory -= profile.memory_bytes
+                self._running -= 1
+                self._cond.notify_all()
+
+
+_admission: Admission | None = None
+_admission_lock = threading.Lock()
+
+
+def admission_enabled() -> bool:
+    return os.getenv(ADMISSION_ENV, "1").lower() not in ("0", "false", "no")
+
+
+def get_admission() -> Admission:
+    global _admission
+    with _admission_lock:
+        if _admission is None:
+            _admission = Admission()
+        return _admission
+
+
+# ------------------
+# Peak usage of a running container
+# ------------------
+
+_UNITS = {
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "tb": 1000**4,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+    "tib": 1024**4,
+}
+
+
+def parse_size(text: str) -> int:
+    """Parse a docker size like '1.5GiB' or '512MB' into bytes."""
+    m = re.fullmatch(r"\s*([\d.]+)\s*([a-zA-Z]+)\s*", text)
+    if not m or m.group(2).lower() not in _UNITS:
+        raise ValueError(f"Cannot parse size '{text}'")
+    return int(float(m.group(1)) * _UNITS[m.group(2).lower()])
+
+
+class ContainerMonitor:
+    """Poll `docker stats` for a named container and keep the peak CPU and memory usage."""
+
+    def __init__(self, name: str, interval: float = 5.0):
+        self.name = name
+        self.interval = interval
+        self.peak_cpus: float | None = None
+        self.peak_memory_bytes: int | None = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"{name}-stats", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        out = subprocess.run(
+            ["docker", "stats", "--no-stream", "--format", "{{.CPUPerc}};{{.MemUsage}}", self.name],
+            capture_output=True,
+            text=True,
+            timeout=30,
+        )
+        if out.returncode != 0 or not out.stdout.strip():
+            return
+        cpu, mem = out.stdout.strip().split(";")
+        cpus = float(cpu.strip().rstrip("%")) / 100
+        memory = parse_size(mem.split("/")[0])
+        self.peak_cpus = max(self.peak_cpus or 0.0, cpus)
+        self.peak_memory_bytes = max(self.peak_memory_bytes or 0, memory)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except (OSError, subprocess.SubprocessError, ValueError):
+                logger.debug(f"docker stats failed for {self.name}", exc_info=True)
@@ -0,0 +1,54 @@
+from pathlib import Path
+import logging
+import os
+
+from macvin.publish import MARKER, finished_files, is_complete
+
+logger = logging.getLogger(__name__)
+
+RESUME_ENV = "MACVIN_RESUME"
+
+# Suffixes added to the file stem by the korona tools
+_STEM_SUFFIXES = ("-korona",)
+
+
+def resume_enabled() -> bool:
+    """Per-file resume is on unless MACVIN_RESUME is set to 0/false/no."""
+    return os.getenv(RESUME_ENV, "1").lower() not in ("0", "false", "no")
+
+
+def file_key(path: Path) -> str:
+    """
+    Key used to match input and output files of a stage, e.g.
+    ``X-D20051109-T021146.raw``, ``X-D20051109-T021146-korona.idx`` and
+    ``X-D20051109-T021146.nc`` all have the key ``X-D20051109-T021146``.
+    """
+    stem = Path(path).name.split(".")[0]
+    for suffix in _STEM_SUFFIXES:
+        if stem.endswith(suffix):
+            stem = stem[: -len(suffix)]
+    return stem
+
+
+def produced_keys(output_dir: Path, pattern: str = "*.nc") -> set[str]:
+    """
+    Return the keys of the files a stage has already produced in `output_dir`.
+
+    Empty files are ignored. If the output directory has no completion marker
+    the stage was interrupted, possibly while several files were being
+    written, so only the files `finished_files` accepts are counted and the
+    others will be produced again.
+    """
+    output_dir = Path(output_dir)
+    if not resume_enabled() or not output_dir.is_dir():
+        return set()
+
+    files = [p for p in output_dir.glob(pattern) if p.name != MARKER and p.is_file()]
+    if is_complete(output_dir):
+        found = [p for p in files if p.stat().st_size > 0]
+    else:
+        found = finished_files(files)
+        if len(found) < len(files):
+            logger.debug(f"{output_dir} is incomplete, {len(files) - len(found)} files will be reprocessed")
+
+    return {file_key(p) for p in found}
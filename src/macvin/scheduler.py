@@ -0,0 +1,255 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections.abc import Callable, Mapping, Sequence
+from collections import Counter
+from dataclasses import dataclass
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, order=True)
+class Task:
+    cruise: str
+    stage: str
+
+    def __str__(self):
+        return f"{self.cruise}:{self.stage}"
+
+
+def parse_limits(spec: str | None) -> dict[str, int]:
+    """Parse per-stage concurrency limits, e.g. "pre=2,atc=1"."""
+    limits = {}
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        stage, sep, n = item.partition("=")
+        if not sep or not n.strip().isdigit() or int(n) < 1:
+            raise ValueError(f"Invalid stage limit '{item}', expected <stage>=<jobs>")
+        limits[stage.strip()] = int(n)
+    return limits
+
+
+def selected_dependencies(
+    stage: str,
+    selected: Sequence[str],
+    dependencies: Mapping[str, Sequence[str]],
+) -> set[str]:
+    """
+    Return the nearest selected upstream stages of `stage`.
+
+    Unselected stages are treated as already done, but the order between the
+    selected stages around them is kept, e.g. with idx -> pre -> atc and only
+    idx and atc selected, atc depends on idx.
+    """
+    found = set()
+    todo = list(dependencies.get(stage, ()))
+    seen = set()
+    while todo:
+        dep = todo.pop()
+        if dep in seen:
+            continue
+        seen.add(dep)
+        if dep in selected:
+            found.add(dep)
+        else:
+            todo.extend(dependencies.get(dep, ()))
+    return found
+
+
+def build_graph(
+    cruises: Sequence[str],
+    stages: Sequence[str],
+    dependencies: Mapping[str, Sequence[str]],
+) -> dict[Task, set[Task]]:
+    """Build the task graph (task -> tasks it depends on) for the selected stages of every cruise."""
+    unknown = set(stages) - set(dependencies)
+    if unknown:
+        raise ValueError(f"Unknown stages: {sorted(unknown)}")
+
+    graph = {}
+    for cruise in cruises:
+        for stage in stages:
+            graph[Task(cruise, stage)] = {
+                Task(cruise, dep)
+                for dep in selected_dependencies(stage, stages, dependencies)
+            }
+    return graph
+
+
+def _dependents(graph: Mapping[Task, set[Task]]) -> dict[Task, set[Task]]:
+    dependents: dict[Task, set[Task]] = {}
+    for t, deps in graph.items():
+        for d in deps:
+            dependents.setdefault(d, set()).add(t)
+    return dependents
+
+
+def descendants(graph: Mapping[Task, set[Task]], task: Task) -> set[Task]:
+    dependents = _dependents(graph)
+    found = set()
+    todo = [task]
+    while todo:
+        for d in dependents.get(todo.pop(), ()):
+            if d not in found:
+                found.add(d)
+                todo.append(d)
+    return found
+
+
+def bottom_levels(graph: Mapping[Task, set[Task]], durations: Mapping[Task, float]) -> dict[Task, float]:
+    """
+    The length of the longest path from every task to the end of the graph,
+    including the task itself. Starting the tasks with the longest remaining
+    path first keeps a long cruise from being left for the end of a run.
+    """
+    dependents = _dependents(graph)
+    levels: dict[Task, float] = {}
+
+    def level(task: Task) -> float:
+        if task not in levels:
+            levels[task] = durations.get(task, 0.0) + max(
+                (level(d) for d in dependents.get(task, ())), default=0.0
+            )
+        return levels[task]
+
+    for task in graph:
+        level(task)
+    return levels
+
+
+def ready_order(graph: Mapping[Task, set[Task]], priority: Mapping[Task, float] | None):
+    """Sort key of ready tasks: highest priority first, then graph order."""
+    order = {task: i for i, task in enumerate(graph)}
+    if priority is None:
+        return order.__getitem__
+    return lambda task: (-priority.get(task, 0.0), order[task])
+
+
+def simulate_graph(
+    graph: Mapping[Task, set[Task]],
+    durations: Mapping[Task, float],
+    jobs: int = 1,
+    limits: Mapping[str, int] | None = None,
+    priority: Mapping[Task, float] | None = None,
+) -> dict[Task, tuple[float, float]]:
+    """
+    Simulate `run_graph` with the given task durations, assuming every task
+    succeeds. Returns the (start, end) time in seconds of every task.
+    """
+    key = ready_order(graph, priority)
+    jobs = max(jobs, 1)
+    remaining = {task: set(deps) for task, deps in graph.items()}
+    ready = [task for task, deps in remaining.items() if not deps]
+    running: list[tuple[float, int, Task]] = []
+    per_stage: Counter[str] = Counter()
+    limits = limits or {}
+    schedule: dict[Task, tuple[float, float]] = {}
+    now = 0.0
+    seq = 0
+
+    while ready or running:
+        ready.sort(key=key)
+        while len(running) < jobs:
+            task = next((t for t in ready if per_stage[t.stage] < limits.get(t.stage, jobs)), None)
+            if task is None:
+                break
+            ready.remove(task)
+            per_stage[task.stage] += 1
+            end = now + durations.get(task, 0.0)
+            schedule[task] = (now, end)
+            heapq.heappush(running, (end, seq, task))
+            seq += 1
+
+        now, _, task = heapq.heappop(running)
+        per_stage[task.stage] -= 1
+        for t, deps in remaining.items():
+            if task in deps:
+                deps.discard(task)
+                if not deps and t not in schedule:
+                    ready.append(t)
+    return schedule
+
+
+def run_graph(
+    graph: Mapping[Task, set[Task]],
+    run_task: Callable[[Task], bool],
+    jobs: int = 1,
+    limits: Mapping[str, int] | None = None,
+    priority: Mapping[Task, float] | None = None,
+) -> dict[Task, str]:
+    """
+    Run the tasks of a graph with up to `jobs` tasks in parallel.
+
+    A task is started as soon as all its dependencies succeeded and its stage
+    is below its limit in `limits` (stage -> max running tasks). Ready tasks
+    with the highest `priority` start first (see `bottom_levels`), and
+    without priorities in the order of the graph, so with a graph built
+    cruise by cruise the later stages of earlier cruises go first and the
+    cruises stream through the stage chain: cruise B is preprocessed while
+    cruise A runs the ATC. `run_task` returns True on success. If a task
+    fails (returns False or raises), only the tasks that depend on it are
+    skipped, independent tasks and other cruises continue.
+
+    Returns the status of every task: 'ok', 'failed' or 'skipped'.
+    """
+    key = ready_order(graph, priority)
+    jobs = max(jobs, 1)
+    remaining = {task: set(deps) for task, deps in graph.items()}
+    status: dict[Task, str] = {}
+    ready = [task for task, deps in remaining.items() if not deps]
+    running: dict[Future, Task] = {}
+    per_stage: Counter[str] = Counter()
+    limits = limits or {}
+
+    def _startable(task: Task) -> bool:
+        return per_stage[task.stage] < limits.get(task.stage, jobs)
+
+    def _call(task: Task) -> bool:
+        # Show the task in the log records of this worker
+        threading.current_thread().name = str(task)
+        try:
+            return bool(run_task(task))
+        except Exception:
+            logger.exception(f"{task} failed")
+            return False
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while ready or running:
+            ready.sort(key=key)
+            while len(running) < jobs:
+                task = next((t for t in ready if _startable(t)), None)
+                if task is None:
+                    break
+                ready.remove(task)
+                per_stage[task.stage] += 1
+                logger.info(f"Starting {task}")
+                running[pool.submit(_call, task)] = task
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                per_stage[task.stage] -= 1
+                if future.result():
+                    status[task] = "ok"
+                    logger.info(f"Finished {task}")
+                    for t, deps in remaining.items():
+                        if task in deps:
+                            deps.discard(task)
+                            if not deps and t not in status:
+                                ready.append(t)
+                else:
+                    status[task] = "failed"
+                    skipped = descendants(graph, task)
+                    for t in skipped:
+                        status.setdefault(t, "skipped")
+                    ready = [t for t in ready if t not in skipped]
+                    if skipped:
+                        logger.error(
+                            f"{task} failed, skipping {', '.join(map(str, sorted(skipped)))}"
+                        )
+                    else:
+                        logger.error(f"{task} failed")
+
+    return status
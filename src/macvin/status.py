@@ -1,11 +1,14 @@
 from pathlib import Path
+from datetime import datetime
 import logging
 from macvin.logging import setup_logging
-from macvin.flows import get_paths, get_survey
-import xarray as xr
+from macvin.catalog import CruiseInfo, load_catalog
+from macvin.flows import get_paths
+from macvin.publish import read_marker
+from macvin.profiling import LOG_FILE, add_profile_argument, profiling
 import argparse
 
-setup_logging(log_file="macvin.log")
+setup_logging(log_file=LOG_FILE)
 logger = logging.getLogger(__name__)
 
 strN = 25
@@ -13,16 +16,20 @@ strN = 25
 
 def macvin_get_status(quick_run: bool = False, cruise: str | None = None):
 
-    df, exclude_files = get_survey(cruise=cruise)
+    catalog = load_catalog()
 
-    basedir = Path("/data/s3/MACWIN-scratch")
+    for c in catalog.select(cruise):
+        survey_status(c.silver_dir, c.raw_dir, c.original_dir, logger, c.name, quick_run)
+        log_cruise_info(c.name, catalog.info(c.name))
 
-    for idx, row in df.iterrows():
-        cruise = row["cruise"]
-        silver_dir = basedir / Path("silver") / cruise / Path("ACOUSTIC", "EK")
-        bronze_dir = Path(row["RAW_files"])
-        bronze_ek500_dir = Path(row["Original_RAW_files"])
-        survey_status(silver_dir, bronze_dir, bronze_ek500_dir, logger, cruise, quick_run)
+
+def log_cruise_info(cruise: str, info: CruiseInfo):
+    prefix = f"{cruise.ljust(strN)} | catalog              "
+    logger.info(f"{prefix} | {'Raw files':<18}: {info.raw_files} ({info.raw_bytes / 1e9:.1f} GB)")
+    if info.start is not None:
+        logger.info(f"{prefix} | {'Time span':<18}: {info.start} .. {info.end}")
+    last = "-" if info.last_stage is None else f"{info.last_stage} at {datetime.fromtimestamp(info.last_stage_time):%Y-%m-%d %H:%M}"
+    logger.info(f"{prefix} | {'Last stage':<18}: {last}")
 
 
 def log_exists(logger, prefix, label, exists):
@@ -30,7 +37,17 @@ def log_exists(logger, prefix, label, exists):
     log(f"{prefix} | {label:<18}: {exists}")
 
 
+def log_complete(logger, prefix, output_dir):
+    marker = read_marker(output_dir)
+    if marker is None:
+        logger.warning(f"{prefix} | {'Completion marker':<18}: missing, output may be partial")
+    else:
+        logger.info(f"{prefix} | {'Completion marker':<18}: {marker['completed']}")
+
+
 def get_freq_and_time_bounds(nc_file, time_name="ping_time"):
+    import xarray as xr
+
     with xr.open_dataset(nc_file, decode_times=True, chunks={}) as ds:
         t = ds[time_name].values
         f = set([int(_f) for _f in ds["frequency"].values])
@@ -43,6 +60,8 @@ def check_sv(preprocessed: Path, quick_run: bool = False):
     sv_nc_files = sorted(list(preprocessed.glob("*.nc")))
     sv_nc = len(sv_nc_files)
     log_exists(logger, prefix, f"{sv_nc} nc files", sv_nc > 0)
+    if sv_nc > 0:
+        log_complete(logger, prefix, preprocessed)
     if sv_nc > 0 and not quick_run:
         check_monotonic(sv_nc_files, prefix)
     return sv_nc
@@ -54,6 +73,8 @@ def check_sv_zarr(preprocessed: Path, quick_run: bool = False):
     sv_nc_files = sorted(list(preprocessed.glob("*.zarr")))
     sv_nc = len(sv_nc_files)
     log_exists(logger, prefix, f"{sv_nc} zarr store", sv_nc > 0)
+    if sv_nc > 0:
+        log_complete(logger, prefix, preprocessed)
     return sv_nc
 
 
@@ -115,6 +136,8 @@ def check_labels(target_classification: Path):
     labels_nc = len(labels_nc_files)
     prefix = f"{str(target_classification).split('/')[-7].ljust(strN)} | target_classification | Preprocessing used: korona_noisefiltering    "
     log_exists(logger, prefix, f"{labels_nc} nc files", labels_nc > 0)
+    if labels_nc > 0:
+        log_complete(logger, prefix, target_classification)
     return {"atc": labels_nc}
 
 
@@ -125,9 +148,42 @@ def check_labels_zarr(target_classification: Path):
     labels_nc = len(labels_nc_files)
     prefix = f"{str(target_classification).split('/')[-7].ljust(strN)} | labels2zarr           | Preprocessing used: korona_noisefiltering    "
     log_exists(logger, prefix, f"{labels_nc} zarr store", labels_nc > 0)
+    if labels_nc > 0:
+        log_complete(logger, prefix, target_classification)
     return {"atc": labels_nc}
 
 
+def check_coverage(sv_dir: Path, labels_dir: Path, max_ranges: int = 20):
+    """Compare the ping_time coverage of the sv and labels files that go into a report."""
+    from macvin.coverage import coverage_diff
+
+    logger.info(f"Ping coverage of {labels_dir} against {sv_dir}")
+    prefix = f"{str(labels_dir).split('/')[-7].ljust(strN)} | ping coverage         | Preprocessing used: {str(sv_dir).split('/')[-2].ljust(strN)}"
+    sv_files = sorted(sv_dir.glob("*.nc"))
+    labels_files = sorted(labels_dir.glob("*.nc"))
+    if not sv_files or not labels_files:
+        return None
+
+    diff = coverage_diff(sv_files, labels_files)
+    log_exists(
+        logger,
+        prefix,
+        f"{diff.sv_pings} sv, {diff.labels_pings} labels pings, "
+        f"{diff.n_missing} missing, {diff.n_extra} extra",
+        diff.ok,
+    )
+    for label, ranges in (("Pings without labels", diff.missing), ("Labels without sv", diff.extra)):
+        for r in ranges[:max_ranges]:
+            logger.error(f"{prefix} | {label:<18}: {r}")
+        if len(ranges) > max_ranges:
+            logger.error(f"{prefix} | {label:<18}: ... and {len(ranges) - max_ranges} more ranges")
+    if diff.sv_duplicates or diff.labels_duplicates:
+        logger.error(
+            f"{prefix} | {'Duplicate pings':<18}: {diff.sv_duplicates} in sv, {diff.labels_duplicates} in labels"
+        )
+    return diff
+
+
 def check_report(report: Path):
     # report
     logger.info(f"Report path {report}")
@@ -141,6 +197,8 @@ def check_report(report: Path):
         report_zarr = False
     prefix = f"{str(report).split('/')[-7].ljust(strN)} | sv-echo-integrator    | Preprocessing used: {str(report).split('/')[-3].ljust(strN)}"
     log_exists(logger, prefix, "Zarr store exist", report_zarr)
+    if report_zarr:
+        log_complete(logger, prefix, report)
     log_exists(logger, prefix, "Luf file exist", luf.exists())
 
 
@@ -153,10 +211,12 @@ def check_idx(idxdata: Path):
     prefix = f"{str(idxdata).split('/')[-5].ljust(strN)} |{_str2}| {_str1}"
     idx = len(idxfiles)
     log_exists(logger, prefix, f"{idx} idx files", idx > 0)
+    if idx > 0:
+        log_complete(logger, prefix, idxdata)
     return {"idx": idx}
 
 
-def check_raw(rawdata: Path, original_rawdata: Path):
+def check_raw(rawdata: Path, original_rawdata: Path, raw_index: Path | None = None, quick_run: bool = True):
     # labels_nc
     logger.info(f"Raw data path: {rawdata}")
     rawfiles = sorted(list(rawdata.glob("*.raw")))
@@ -173,7 +233,29 @@ def check_raw(rawdata: Path, original_rawdata: Path):
     log_exists(
         logger, prefix, f"{raw} raw, {idx} idx, {ek500} ek500 ", raw + ek500 + idx > 0
     )
-    return {"raw": raw, "idx_orig": idx, "ek500": ek500}
+    result = {"raw": raw, "idx_orig": idx, "ek500": ek500}
+    if raw > 0 and raw_index is not None and not quick_run:
+        result.update(check_raw_scan(rawfiles, raw_index, prefix))
+    return result
+
+
+def check_raw_scan(rawfiles: list[Path], raw_index: Path, prefix: str) -> dict:
+    """Scan the raw datagram headers (cached in the raw index) and log what they contain."""
+    from macvin.rawscan import update_raw_index
+
+    scans = update_raw_index(rawfiles, raw_index)
+    readable = [s for s in scans if not s.broken]
+    broken = len(scans) - len(readable)
+    pings = sum(s.ping_count for s in readable)
+    frequencies = sorted({f for s in readable for f in s.frequencies})
+    starts = [s.start for s in readable if s.start]
+    ends = [s.end for s in readable if s.end]
+    log_exists(logger, prefix, f"{broken} broken raw files", broken == 0)
+    logger.info(f"{prefix} | {'Pings':<18}: {pings}")
+    logger.info(f"{prefix} | {'Frequencies':<18}: {[int(f) for f in frequencies]}")
+    if starts:
+        logger.info(f"{prefix} | {'Time span':<18}: {min(starts)} .. {max(ends)}")
+    return {"pings": pings, "broken": broken}
 
 
 def survey_status(silver_dir: Path, bronze_dir: Path, bronze_ek500_dir: Path, logger, cruise, quick_run):
@@ -187,8 +269,8 @@ def survey_status(silver_dir: Path, bronze_dir: Path, bronze_ek500_dir: Path, lo
     # Get the standard paths
     path_data = get_paths(silver_dir)
 
-    # Check idx files
-    raw = check_raw(bronze_dir, bronze_ek500_dir)
+    # Check raw files
+    raw = check_raw(bronze_dir, bronze_ek500_dir, path_data["raw_index"], quick_run)
 
     # Check idx files
     idx = check_idx(path_data["idxdata"])
@@ -225,6 +307,11 @@ def survey_status(silver_dir: Path, bronze_dir: Path, bronze_ek500_dir: Path, lo
     if raw["raw"] > atc["atc"]:
         logger.error(f"There are more raw files ({raw['raw']}) than atc files ({atc['atc']}). Something failed in the atc.")
 
+    # Check that the labels cover the same pings as the sv the reports integrate
+    if not quick_run:
+        for _type in path_data["reports"].keys():
+            check_coverage(path_data["preprocessing"][_type], path_data["target_classification"])
+
     # Check reports
     for _type in path_data["reports"].keys():
         report = path_data["reports"][_type]
@@ -237,6 +324,8 @@ def main():
     parser.add_argument(
         "--cruise", type=str, help="Cruise name to process, e.g. S1513S_PSCOTIA_MXHR6"
     )
+    add_profile_argument(parser)
     args = parser.parse_args()
 
-    macvin_get_status(quick_run=args.quick_run, cruise=args.cruise)
+    with profiling("macvin_get_status", args.cruise, enabled=args.profile):
+        macvin_get_status(quick_run=args.quick_run, cruise=args.cruise)
@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+from pathlib import Path
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+import logging
+import os
+
+import numpy as np
+
+from macvin.ledger import current_run
+from macvin.trace import traced
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Pings read at a time, which bounds the memory use per file
+DEFAULT_CHUNK_PINGS = 2000
+
+# Sv below the floor is clipped, as in the sv histograms
+SV_FLOOR = 1e-10
+# Fixed bins of the quantile sketch in dB. Values outside are counted in the
+# first and last bin, the exact min and max are kept separately.
+SKETCH_MIN_DB = -100.0
+SKETCH_MAX_DB = 50.0
+SKETCH_STEP_DB = 0.1
+SKETCH_BINS = int(round((SKETCH_MAX_DB - SKETCH_MIN_DB) / SKETCH_STEP_DB))
+
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+# Table of every cruise, relative to the silver root
+STATS_GLOB = "*/ACOUSTIC/EK/QUALITY_CONTROL/sv_stats/*.parquet"
+
+
+@dataclass
+class SvSketch:
+    """
+    Counts of Sv in fixed 0.1 dB bins. Two sketches merge exactly by adding
+    the counts, so quantiles over many files or cruises are as accurate as
+    the quantiles of one file (half a bin).
+    """
+
+    counts: np.ndarray = field(default_factory=lambda: np.zeros(SKETCH_BINS, dtype=np.int64))
+
+    def add(self, sv_db: np.ndarray):
+        i = np.floor((sv_db - SKETCH_MIN_DB) / SKETCH_STEP_DB).astype(np.int64)
+        self.counts += np.bincount(np.clip(i, 0, SKETCH_BINS - 1), minlength=SKETCH_BINS)
+
+    def merge(self, other: SvSketch) -> SvSketch:
+        return SvSketch(self.counts + other.counts)
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def quantile(self, q: float) -> float:
+        """The centre of the bin holding quantile `q`, NaN for an empty sketch."""
+        total = self.count
+        if total == 0:
+            return float("nan")
+        i = int(np.searchsorted(np.cumsum(self.counts), q * total, side="left"))
+        return round(SKETCH_MIN_DB + (min(i, SKETCH_BINS - 1) + 0.5) * SKETCH_STEP_DB, 2)
+
+    def to_sparse(self) -> tuple[int, list[int]]:
+        """The counts without the empty bins at both ends, and the index of the first bin."""
+        nonzero = np.flatnonzero(self.counts)
+        if len(nonzero) == 0:
+            return 0, []
+        return int(nonzero[0]), self.counts[nonzero[0] : nonzero[-1] + 1].tolist()
+
+    @classmethod
+    def from_sparse(cls, offset: int, counts: Sequence[int]) -> SvSketch:
+        sketch = cls()
+        sketch.counts[offset : offset + len(counts)] = counts
+        return sketch
+
+
+@dataclass
+class _Accumulator:
+    """Running statistics of one frequency of one file."""
+
+    samples: int = 0
+    count: int = 0
+    sum_db: float = 0.0
+    sum_db2: float = 0.0
+    sum_linear: float = 0.0
+    min_db: float = np.inf
+    max_db: float = -np.inf
+    sketch: SvSketch = field(default_factory=SvSketch)
+    bottom_pings: int = 0
+    bottom_count: int = 0
+    bottom_sum: float = 0.0
+    bottom_min: float = np.inf
+    bottom_max: float = -np.inf
+
+    def add_sv(self, sv: np.ndarray):
+        self.samples += sv.size
+        sv = sv[np.isfinite(sv)]
+        if not len(sv):
+            return
+        sv_db = 10 * np.log10(np.clip(sv, SV_FLOOR, None))
+        self.count += len(sv_db)
+        self.sum_db += float(sv_db.sum())
+        self.sum_db2 += float(np.square(sv_db).sum())
+        self.sum_linear += float(sv.sum(dtype=np.float64))
+        self.min_db = min(self.min_db, float(sv_db.min()))
+        self.max_db = max(self.max_db, float(sv_db.max()))
+        self.sketch.add(sv_db)
+
+    def add_bottom(self, depth: np.ndarray):
+        self.bottom_pings += depth.size
+        depth = depth[np.isfinite(depth)]
+        if not len(depth):
+            return
+        self.bottom_count += len(depth)
+        self.bottom_sum += float(depth.sum(dtype=np.float64))
+        self.bottom_min = min(self.bottom_min, float(depth.min()))
+        self.bottom_max = max(self.bottom_max, float(depth.max()))
+
+    def row(self) -> dict:
+        n = self.count
+        mean = self.sum_db / n if n else np.nan
+        offset, counts = self.sketch.to_sparse()
+        row = {
+            "n_samples": self.samples,
+            "count": n,
+            "nan_fraction": 1 - n / self.samples if self.samples else np.nan,
+            "mean_db": mean,
+            "std_db": np.sqrt(max(self.sum_db2 / n - mean**2, 0.0)) if n else np.nan,
+            "mean_sv_db": 10 * np.log10(max(self.sum_linear / n, SV_FLOOR)) if n else np.nan,
+            "min_db": self.min_db if n else np.nan,
+            "max_db": self.max_db if n else np.nan,
+        }
+        for q in QUANTILES:
+            row[f"q{round(q * 100):02d}_db"] = self.sketch.quantile(q)
+        b = self.bottom_count
+        row.update(
+            {
+                "bottom_nan_fraction": 1 - b / self.bottom_pings if self.bottom_pings else np.nan,
+                "bottom_mean": self.bottom_sum / b if b else np.nan,
+                "bottom_min": self.bottom_min if b else np.nan,
+                "bottom_max": self.bottom_max if b else np.nan,
+                "sketch_offset": offset,
+                "sketch_counts": counts,
+            }
+        )
+        return row
+
+
+def file_stats(sv_file: Path, chunk_pings: int = DEFAULT_CHUNK_PINGS) -> list[dict]:
+    """
+    Per frequency statistics of the Sv and bottom depth of one sv file, read
+    `chunk_pings` pings at a time. Returns one row per frequency.
+    """
+    import xarray as xr
+
+    sv_file = Path(sv_file)
+    st = sv_file.stat()
+    rows = []
+    with xr.open_dataset(sv_file, decode_times=True) as ds:
+        times = ds["ping_time"].values
+        frequencies = ds["frequency"].values
+        sv = ds["sv"].transpose("frequency", "ping_time", ...)
+        bottom = ds["bottom_depth"] if "bottom_depth" in ds else None
+        acc = [_Accumulator() for _ in frequencies]
+
+        for start in range(0, len(times), chunk_pings):
+            sl = slice(start, start + chunk_pings)
+            block = sv.isel(ping_time=sl).values
+            for i in range(len(frequencies)):
+                acc[i].add_sv(block[i])
+            if bottom is not None:
+                depth = bottom.isel(ping_time=sl)
+                for i in range(len(frequencies)):
+                    values = depth.isel(frequency=i) if "frequency" in depth.dims else depth
+                    acc[i].add_bottom(values.values)
+
+    for freq, a in zip(frequencies, acc):
+        row = {
+            "file": sv_file.name,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "frequency": float(freq),
+            "start": times[0] if len(times) else np.datetime64("NaT"),
+            "end": times[-1] if len(times) else np.datetime64("NaT"),
+            "n_pings": len(times),
+        }
+        row.update(a.row())
+        rows.append(row)
+    return rows
+
+
+def _is_unchanged(table: pd.DataFrame, files: Sequence[Path]) -> set[str]:
+    """Names of the files whose rows in `table` are from the current file."""
+    if table is None or table.empty:
+        return set()
+    state = {f.name: (f.stat().st_size, f.stat().st_mtime_ns) for f in files}
+    known = table.groupby("file")[["size", "mtime_ns"]].first()
+    return {name for name, r in known.iterrows() if state.get(name) == (r["size"], r["mtime_ns"])}
+
+
+@traced(cat="analysis")
+def update_sv_stats(
+    files: Sequence[Path],
+    path: Path,
+    cruise: str,
+    product: str,
+    chunk_pings: int = DEFAULT_CHUNK_PINGS,
+    dry_run: bool = False,
+) -> pd.DataFrame | None:
+    """
+    Update the Parquet table at `path` with the statistics of the sv files.
+    Rows of unchanged files are kept, new and changed files are read and
+    rows of files that are gone are dropped.
+    """
+    import pandas as pd
+
+    files = sorted(Path(f) for f in files)
+    path = Path(path)
+    table = pd.read_parquet(path) if path.exists() else None
+    keep = _is_unchanged(table, files)
+    todo = [f for f in files if f.name not in keep]
+    if dry_run:
+        logger.info(f"Dry run: would compute sv statistics of {len(todo)} of {len(files)} files")
+        return table
+    if not todo and table is not None and set(table["file"]) == keep:
+        logger.info(f"sv statistics in {path} are up to date")
+        return table
+
+    run = current_run()
+    if run is not None:
+        run.add(input_files=len(todo), input_bytes=sum(f.stat().st_size for f in todo))
+
+    rows = []
+    for i, f in enumerate(todo, start=1):
+        rows.extend(file_stats(f, chunk_pings))
+        logger.info(f"sv statistics {i}/{len(todo)}: {f.name}")
+    new = pd.DataFrame(rows)
+    if len(new):
+        new.insert(0, "product", product)
+        new.insert(0, "cruise", cruise)
+    kept = table[table["file"].isin(keep)] if table is not None else None
+    parts = [t for t in (kept, new) if t is not None and len(t)]
+    table = pd.concat(parts, ignore_index=True) if parts else new
+    if len(table):
+        table = table.sort_values(["file", "frequency"], ignore_index=True)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    table.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    logger.info(f"Wrote sv statistics of {len(files)} files ({len(todo)} new) to {path}")
+    return table
+
+
+def load_sv_stats(silver_root: Path) -> pd.DataFrame:
+    """The sv statistics of all cruises under the silver root in one table."""
+    import pandas as pd
+
+    paths = sorted(Path(silver_root).glob(STATS_GLOB))
+    if not paths:
+        return pd.DataFrame()
+    return pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+
+
+def merged_sketch(table: pd.DataFrame) -> SvSketch:
+    """The sketch of all rows of `table`, e.g. one frequency of a cruise."""
+    sketch = SvSketch()
+    for offset, counts in zip(table["sketch_offset"], table["sketch_counts"]):
+        sketch = sketch.merge(SvSketch.from_sparse(int(offset), counts))
+    return sketch
+
+
+def outliers(table: pd.DataFrame, column: str = "mean_db", threshold: float = 5.0) -> pd.DataFrame:
+    """
+    Rows whose `column` is more than `threshold` robust standard deviations
+    (scaled median absolute deviation) from the median of their cruise,
+    product and frequency.
+    """
+    group = table.groupby(["cruise", "product", "frequency"])[column]
+    median = group.transform("median")
+    mad = (table[column] - median).abs().groupby([table["cruise"], table["product"], table["frequency"]]).transform(
+        "median"
+    )
+    score = (table[column] - median) / (1.4826 * mad)
+    return table.assign(score=score)[score.abs() > threshold].sort_values("score", key=abs, ascending=False)
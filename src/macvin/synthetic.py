@@ -0,0 +1,232 @@
+from pathlib import Path
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import struct
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+logger = logging.getLogger(__name__)
+
+MACKEREL = 1000004
+
+
+@dataclass
+class SyntheticSpec:
+    """
+    Shape and pathologies of a synthetic cruise.
+
+    `overlap_files` files start before the previous file ends (by
+    `overlap_fraction` of a file), which gives a non-monotonic ping_time
+    across files. `missing_frequency_files` files lack the highest frequency.
+    """
+
+    n_files: int = 4
+    pings_per_file: int = 1000
+    n_range: int = 500
+    range_step: float = 0.2
+    frequencies: tuple[float, ...] = (18000.0, 38000.0, 70000.0, 120000.0, 200000.0, 333000.0)
+    categories: tuple[int, ...] = (1, 27, MACKEREL)
+    ping_interval_s: float = 1.0
+    start: str = "2020-06-01T00:00:00"
+    overlap_files: int = 0
+    overlap_fraction: float = 0.1
+    missing_frequency_files: int = 0
+    seed: int = 0
+    name: str = "synthetic"
+
+    @property
+    def n_pings(self) -> int:
+        return self.n_files * self.pings_per_file
+
+
+# Sizes used by the benchmark suite
+SIZES = {
+    "small": SyntheticSpec(n_files=2, pings_per_file=500, n_range=200),
+    "medium": SyntheticSpec(n_files=8, pings_per_file=2000, n_range=500),
+    "large": SyntheticSpec(n_files=24, pings_per_file=5000, n_range=1000),
+}
+
+
+@dataclass
+class SyntheticCruise:
+    root: Path
+    spec: SyntheticSpec
+    sv_nc: Path
+    labels_nc: Path
+    bottom_nc: Path
+    overlapping: list[str] = field(default_factory=list)
+    missing_frequency: list[str] = field(default_factory=list)
+
+    def manifest(self) -> dict:
+        return {
+            "spec": asdict(self.spec),
+            "sv_nc": str(self.sv_nc),
+            "labels_nc": str(self.labels_nc),
+            "bottom_nc": str(self.bottom_nc),
+            "overlapping": self.overlapping,
+            "missing_frequency": self.missing_frequency,
+        }
+
+
+def _file_name(spec: SyntheticSpec, t0: np.datetime64) -> str:
+    ts = pd.Timestamp(t0)
+    return f"{spec.name}-D{ts:%Y%m%d}-T{ts:%H%M%S}.nc"
+
+
+def _ping_times(spec: SyntheticSpec, rng: np.random.Generator) -> list[np.ndarray]:
+    """Ping times per file, with the overlaps of the spec applied."""
+    step = np.timedelta64(int(spec.ping_interval_s * 1e9), "ns")
+    start = np.datetime64(spec.start, "ns")
+    overlapping = set(
+        rng.choice(np.arange(1, spec.n_files), size=min(spec.overlap_files, spec.n_files - 1), replace=False)
+    ) if spec.n_files > 1 else set()
+
+    times = []
+    t = start
+    for i in range(spec.n_files):
+        if i in overlapping:
+            t = t - int(spec.pings_per_file * spec.overlap_fraction) * step
+        times.append(t + np.arange(spec.pings_per_file) * step)
+        t = times[-1][-1] + step
+    return times
+
+
+def _bottom(spec: SyntheticSpec, pings: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Bottom depth per ping: a slow undulation plus noise, inside the range axis."""
+    max_range = spec.n_range * spec.range_step
+    x = np.arange(len(pings))
+    depth = max_range * (0.65 + 0.15 * np.sin(2 * np.pi * x / max(len(pings), 1) * 3))
+    return (depth + rng.normal(0, 0.5, len(pings))).astype(np.float32)
+
+
+def make_cruise(root: Path, spec: SyntheticSpec | None = None) -> SyntheticCruise:
+    """
+    Write a synthetic cruise with sv_nc, labels_nc and bottom_nc directories
+    to `root`, shaped like the korona preprocessing and ATC output:
+
+    * sv_nc: ``sv`` (linear) with dims (frequency, ping_time, range), and
+      ``bottom_depth``, ``transducer_draft`` and ``heave``
+    * labels_nc: ``annotation`` with dims (category, ping_time, range)
+    * bottom_nc: ``bottom_depth`` with dims (ping_time,)
+
+    The data has a seabed echo below the bottom depth and mackerel schools
+    that are annotated in the labels. A manifest.json with the spec and the
+    files with pathologies is written to `root`.
+    """
+    spec = spec or SyntheticSpec()
+    root = Path(root)
+    rng = np.random.default_rng(spec.seed)
+
+    cruise = SyntheticCruise(
+        root=root,
+        spec=spec,
+        sv_nc=root / "sv_nc",
+        labels_nc=root / "labels_nc",
+        bottom_nc=root / "bottom_nc",
+    )
+    for d in (cruise.sv_nc, cruise.labels_nc, cruise.bottom_nc):
+        d.mkdir(parents=True, exist_ok=True)
+
+    times = _ping_times(spec, rng)
+    missing = set(
+        rng.choice(spec.n_files, size=min(spec.missing_frequency_files, spec.n_files), replace=False)
+    )
+    range_ = (np.arange(spec.n_range) * spec.range_step).astype(np.float64)
+    frequencies = np.array(spec.frequencies, dtype=np.float64)
+    categories = np.array(spec.categories, dtype=np.int64)
+
+    for i, pings in enumerate(times):
+        name = _file_name(spec, pings[0])
+        freqs = frequencies[:-1] if i in missing else frequencies
+        if i in missing:
+            cruise.missing_frequency.append(name)
+        if i > 0 and pings[0] <= times[i - 1][-1]:
+            cruise.overlapping.append(name)
+
+        bottom = _bottom(spec, pings, rng)
+        below = range_[None, :] >= bottom[:, None]
+
+        # Mackerel schools as ellipses in the water column
+        school = np.zeros((len(pings), spec.n_range), dtype=bool)
+        for _ in range(max(len(pings) // 500, 1)):
+            p0 = rng.integers(0, len(pings))
+            r0 = rng.uniform(0.1, 0.5) * spec.n_range
+            pp, rr = np.ogrid[: len(pings), : spec.n_range]
+            school |= ((pp - p0) / 40.0) ** 2 + ((rr - r0) / 15.0) ** 2 <= 1.0
+
+        sv = 10 ** (rng.normal(-85, 3, (len(freqs), len(pings), spec.n_range)) / 10)
+        sv[:, school] = 10 ** (rng.normal(-55, 3, (len(freqs), int(school.sum()))) / 10)
+        sv[:, below] = 10 ** (rng.normal(-20, 2, (len(freqs), int(below.sum()))) / 10)
+
+        draft = np.full((len(freqs), len(pings)), 5.0, dtype=np.float32)
+        heave = rng.normal(0, 0.2, len(pings)).astype(np.float32)
+
+        ds_sv = xr.Dataset(
+            {
+                "sv": (("frequency", "ping_time", "range"), sv.astype(np.float32)),
+                "bottom_depth": (
+                    ("frequency", "ping_time"),
+                    np.broadcast_to(bottom + draft[0] + heave, (len(freqs), len(pings))).copy(),
+                ),
+                "transducer_draft": (("frequency", "ping_time"), draft),
+                "heave": (("ping_time",), heave),
+            },
+            coords={"frequency": freqs, "ping_time": pings, "range": range_},
+        )
+        ds_sv.to_netcdf(cruise.sv_nc / name)
+
+        annotation = np.zeros((len(categories), len(pings), spec.n_range), dtype=np.float32)
+        if MACKEREL in categories:
+            annotation[list(categories).index(MACKEREL), school] = 1.0
+        ds_labels = xr.Dataset(
+            {"annotation": (("category", "ping_time", "range"), annotation)},
+            coords={"category": categories, "ping_time": pings, "range": range_},
+        )
+        ds_labels.to_netcdf(cruise.labels_nc / name)
+
+        ds_bottom = xr.Dataset(
+            {"bottom_depth": (("ping_time",), bottom)},
+            coords={"ping_time": pings},
+        )
+        ds_bottom.to_netcdf(cruise.bottom_nc / name)
+
+    (root / "manifest.json").write_text(json.dumps(cruise.manifest(), indent=2))
+    logger.info(
+        f"Wrote synthetic cruise to {root}: {spec.n_files} files, {spec.n_pings} pings, "
+        f"{len(cruise.overlapping)} overlapping, {len(cruise.missing_frequency)} missing a frequency"
+    )
+    return cruise
+
+
+def _datagram(kind: bytes, nt: int, payload: bytes) -> bytes:
+    body = struct.pack("<4sII", kind, nt & 0xFFFFFFFF, nt >> 32) + payload
+    return struct.pack("<i", len(body)) + body + struct.pack("<i", len(body))
+
+
+def write_raw(
+    path: Path,
+    start: str = "2020-01-01T00:00:00",
+    n_pings: int = 10,
+    frequencies: tuple[float, ...] = (38000.0,),
+    ping_interval_s: float = 1.0,
+):
+    """
+    Write a minimal EK60 .raw file: a CON0 configuration and one RAW0
+    datagram without samples per ping and frequency. Enough for the raw
+    index scan, not for korona.
+    """
+    # NT time: 100 ns units since 1601-01-01, 11644473600 s before the Unix epoch
+    t0 = int(np.datetime64(start, "ns").astype(np.int64) // 100) + 116444736000000000
+    config = bytearray(516 + 320 * len(frequencies))
+    struct.pack_into("<i", config, 512, len(frequencies))
+    for i, freq in enumerate(frequencies):
+        struct.pack_into("<f", config, 516 + i * 320 + 132, freq)
+    with open(path, "wb") as f:
+        f.write(_datagram(b"CON0", t0, bytes(config)))
+        for n in range(n_pings):
+            nt = t0 + int(n * ping_interval_s * 1e7)
+            for channel, freq in enumerate(frequencies, start=1):
+                f.write(_datagram(b"RAW0", nt, struct.pack("<hhff", channel, 0, 0.0, freq)))
@@ -1,15 +1,25 @@
 from typing import Mapping
 from pathlib import Path
+from contextlib import nullcontext
 import subprocess
 import logging
-from zarr2lufxml import write_acoustic_xml
-import xarray as xr
 import threading
-from collections.abc import Mapping
+import uuid
+from collections.abc import Mapping, Sequence
+from macvin.backends import get_backend
+from macvin.ledger import Run, record_container
+from macvin.logging import ContainerLog, container_log_path
+from macvin.resources import admission_enabled, get_admission, profile_for
+from macvin.trace import traced
+from macvin.views import view_mounts
+from macvin.workqueue import lease_lost
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds between checks of a running container for a lost queue lease
+LEASE_CHECK_S = 5.0
+
 
 def run_zarr2lufxml(
     zarr_report: Path,
@@ -18,6 +28,9 @@ def run_zarr2lufxml(
     dry_run: bool = False,
 ):
     if not dry_run:
+        import xarray as xr
+        from zarr2lufxml import write_acoustic_xml
+
         _luf_report = str(luf_report)
         zr = xr.open_zarr(str(zarr_report))
         logger.info(f"The content of the reports.zarr store:\n {zr}")
@@ -33,19 +46,39 @@ def run_zarr2lufxml(
         write_acoustic_xml(zr, par, _luf_report)
 
 
+@traced(cat="container")
 def run_docker_image(
     image: str,
     volumes: dict[str, str],
     artifact_key: str | None = None,
     env: Mapping[str, str] | None = None,
     dry_run: bool = False,
+    outputs: Sequence[str] = (),
 ):
-    command = ["docker", "run", "--rm"]
+    """
+    Run a docker image with the given volumes (container path -> host path).
+
+    `outputs` lists the container paths of the output volumes, it is used to
+    record input and output file counts in the run ledger.
+
+    The container gets the cpu and memory limits of the resource profile of
+    the image, and is only started when the host has room for it (set
+    MACVIN_ADMISSION=0 to start containers right away). The container is run
+    by the backend selected with MACVIN_BACKEND, see `macvin.backends`.
+    """
+    profile = profile_for(image)
+    name = f"macvin-{uuid.uuid4().hex[:12]}"
+    command = ["docker", "run", "--rm", "--name", name, *profile.docker_args()]
 
     for container_path, host_path in volumes.items():
         command.extend(["-v", f"{host_path}:{container_path}"])
         logger.debug("Mount: %s:%s", host_path, container_path)
 
+    # Symlinked views need their link targets visible inside the container
+    for container_path, host_path in view_mounts(volumes).items():
+        command.extend(["-v", f"{host_path}:{container_path}:ro"])
+        logger.debug("View source mount: %s:%s:ro", host_path, container_path)
+
     if env:
         for key, value in env.items():
             command.extend(["-e", f"{key}={value}"])
@@ -62,11 +95,32 @@ def run_docker_image(
     logger.debug("Docker command: %s", command)
 
     if dry_run:
-        logger.info("Dry run enabled – Docker command not executed")
-        return
+        with record_container(image, volumes, outputs=outputs, env=env, dry_run=dry_run):
+            logger.info("Dry run enabled – Docker command not executed")
+            return
+
+    if lease_lost():
+        raise RuntimeError(f"Not running {image}, the lease of its unit was lost")
 
+    backend = get_backend()
+    if admission_enabled() and backend.uses_resources:
+        admission = get_admission().admit(image, profile)
+    else:
+        admission = nullcontext()
+
+    with admission, record_container(image, volumes, outputs=outputs, env=env) as run:
+        backend.run(command, image, name, volumes, env, outputs, run)
+
+
+def _run_command(command: list[str], image: str, run: Run | None = None):
     logger.info("Running Docker image: %s", image)
 
+    short = image.split(":")[0].rsplit("_", 1)[-1]
+    label = f"{run.cruise}-{run.stage}-{short}" if run and run.cruise else short
+    container_log = ContainerLog(container_log_path(label), logger, label=short)
+    if run is not None:
+        run.log_file = str(container_log.path)
+
     process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
@@ -77,22 +131,30 @@ def run_docker_image(
 
     stdout_thread = threading.Thread(
         target=_stream_pipe,
-        args=(process.stdout, logger.info),
+        args=(process.stdout, container_log, False),
         daemon=True,
     )
     stderr_thread = threading.Thread(
         target=_stream_pipe,
-        args=(process.stderr, logger.warning),
+        args=(process.stderr, container_log, True),
         daemon=True,
     )
 
     stdout_thread.start()
     stderr_thread.start()
 
-    return_code = process.wait()
+    while True:
+        try:
+            return_code = process.wait(timeout=LEASE_CHECK_S)
+            break
+        except subprocess.TimeoutExpired:
+            if lease_lost():
+                logger.error("Stopping %s, the lease of its unit was lost", image)
+                process.terminate()
 
     stdout_thread.join()
     stderr_thread.join()
+    container_log.close(failed=return_code != 0)
 
     if return_code != 0:
         logger.error("Docker failed with exit code %s", return_code)
@@ -115,6 +177,7 @@ def korona_fixidx(
         artifact_key="korona-fixidx",
         env=None,
         dry_run=dry_run,
+        outputs=["/PREPROCESSING"],
     )
 
 
@@ -134,6 +197,7 @@ def korona_noisefiltering(
         artifact_key="korona-noisefiltering",
         env=None,
         dry_run=dry_run,
+        outputs=["/PREPROCESSING"],
     )
 
 
@@ -153,6 +217,7 @@ def korona_preprocessing(
         artifact_key="korona-preprocessing",
         env=None,
         dry_run=dry_run,
+        outputs=["/PREPROCESSING"],
     )
 
 
@@ -170,6 +235,7 @@ def mackerel_korneliussen2016(
         artifact_key="mackerel_korneliussen2016",
         env=None,
         dry_run=dry_run,
+        outputs=["/TARGET_CLASSIFICATION"],
     )
 
 
@@ -196,6 +262,7 @@ def atc2zarr(
         artifact_key="nc_zarr",
         env=env,
         dry_run=dry_run,
+        outputs=["/ZARR_MOUNT"],
     )
 
 
@@ -218,6 +285,7 @@ def preprocess2zarr(
         artifact_key="nc_zarr",
         env=env,
         dry_run=dry_run,
+        outputs=["/ZARR_MOUNT"],
     )
 
 
@@ -250,16 +318,15 @@ def sv_echo_integrator(
         artifact_key="reportgeneration_zarr",
         env=env,
         dry_run=dry_run,
+        outputs=["/REPORTS"],
     )
 
 
-def _stream_pipe(pipe, log_func):
-    """Stream a subprocess pipe line-by-line into logger."""
+def _stream_pipe(pipe, container_log: ContainerLog, stderr: bool):
+    """Stream a subprocess pipe line-by-line into the container log."""
     try:
         for line in iter(pipe.readline, ""):
             if line:
-                log_func(line.rstrip())
+                container_log.write(line, stderr=stderr)
     finally:
         pipe.close()
-
-
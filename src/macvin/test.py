@@ -1,17 +1,21 @@
 from macvin.flows import macvin_test_flow
 import argparse
 from macvin.logging import setup_logging
+from macvin.profiling import LOG_FILE, add_profile_argument, profiling
+from macvin.trace import tracing
 import logging
 
-setup_logging(log_file="macvin.log")
+setup_logging(log_file=LOG_FILE)
 logger = logging.getLogger(__name__)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--dry-run", action="store_true")
+    add_profile_argument(parser)
 
     args = parser.parse_args()
     print(f"dry_run = {args.dry_run}")
 
-    macvin_test_flow(dry_run=args.dry_run)
+    with tracing("macvin_test_flow"), profiling("macvin_test_flow", enabled=args.profile):
+        macvin_test_flow(dry_run=args.dry_run)
@@ -0,0 +1,171 @@
+from pathlib import Path
+from contextlib import contextmanager
+from collections.abc import Callable, Iterator
+from datetime import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENV = "MACVIN_TRACE"
+TRACE_DIR_ENV = "MACVIN_TRACE_DIR"
+DEFAULT_TRACE_DIR = Path("traces")
+
+# Arguments of traced functions that are added to their spans
+SPAN_ARGS = ("cruise", "stage", "image", "frequency", "category")
+
+
+class Tracer:
+    """
+    Collect spans as Chrome trace events ("X" complete events).
+
+    The JSON written by `save` can be opened in https://ui.perfetto.dev or
+    chrome://tracing, with one track per thread.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.pid = os.getpid()
+        self.t0 = time.perf_counter()
+        self.started = datetime.now()
+        self.events: list[dict] = []
+        self._threads: dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def _tid(self) -> int:
+        ident = threading.get_ident()
+        tid = self._threads.get(ident)
+        if tid is None:
+            with self._lock:
+                tid = self._threads.setdefault(ident, len(self._threads) + 1)
+                # Worker threads are renamed per task, so tracks get a stable name
+                thread = threading.current_thread()
+                name = thread.name if thread is threading.main_thread() else f"worker-{tid}"
+                self.events.append(
+                    {"ph": "M", "name": "thread_name", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                )
+        return tid
+
+    def _us(self, t: float) -> float:
+        return (t - self.t0) * 1e6
+
+    def add(self, name: str, cat: str, start: float, end: float, args: dict | None = None):
+        event = {
+            "ph": "X",
+            "name": name,
+            "cat": cat,
+            "ts": self._us(start),
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": self._tid(),
+        }
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+
+    def save(self, path: Path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            events = [
+                {"ph": "M", "name": "process_name", "pid": self.pid, "args": {"name": self.name}},
+                *self.events,
+            ]
+        path.write_text(
+            json.dumps(
+                {
+                    "traceEvents": events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"name": self.name, "started": self.started.isoformat()},
+                }
+            )
+        )
+        return path
+
+
+_tracer: Tracer | None = None
+
+
+def current_tracer() -> Tracer | None:
+    return _tracer
+
+
+def tracing_enabled() -> bool:
+    return os.getenv(TRACE_ENV, "1").lower() not in ("0", "false", "no")
+
+
+@contextmanager
+def tracing(name: str, path: Path | None = None) -> Iterator[Tracer | None]:
+    """
+    Trace the block and write the trace JSON when it exits, by default to
+    MACVIN_TRACE_DIR (default traces/) with the name and start time in the
+    file name. Set MACVIN_TRACE=0 to disable tracing.
+    """
+    global _tracer
+    if not tracing_enabled() or _tracer is not None:
+        yield _tracer
+        return
+
+    _tracer = tracer = Tracer(name)
+    start = time.perf_counter()
+    try:
+        yield tracer
+    finally:
+        tracer.add(name, "run", start, time.perf_counter())
+        _tracer = None
+        if path is None:
+            safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+            stamp = tracer.started.strftime("%Y%m%d-%H%M%S")
+            path = Path(os.getenv(TRACE_DIR_ENV, DEFAULT_TRACE_DIR)) / f"{stamp}-{safe}.trace.json"
+        try:
+            logger.info(f"Trace written to {tracer.save(path)}")
+        except OSError:
+            logger.exception("Could not write the trace")
+
+
+@contextmanager
+def span(name: str, cat: str = "", **args) -> Iterator[None]:
+    """Record the block as a span if tracing is active."""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        tracer.add(name, cat, start, time.perf_counter(), {k: str(v) for k, v in args.items()})
+
+
+def traced(cat: str = "", name: str | None = None) -> Callable:
+    """Decorator that records every call as a span, with the arguments in SPAN_ARGS."""
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            try:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+            except TypeError:
+                bound = kwargs
+            span_args = {k: bound[k] for k in SPAN_ARGS if k in bound}
+            with span(span_name, cat, **span_args):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
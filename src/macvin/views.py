@@ -0,0 +1,159 @@
+from pathlib import Path
+from contextlib import contextmanager
+from collections.abc import Iterable, Iterator, Mapping
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from macvin.cache import get_cache
+from macvin.exclusions import ExclusionMatcher, load_exclusions
+from macvin.publish import MARKER
+from macvin.resume import file_key
+
+logger = logging.getLogger(__name__)
+
+# View directory -> host directories its symlinks point into
+_view_sources: dict[str, set[str]] = {}
+_lock = threading.Lock()
+
+
+def make_view(
+    files: Iterable[Path],
+    prefix: str = "macvin_view_",
+    link_mode: str = "symlink",  # "symlink" or "hardlink" or "copy"
+) -> tempfile.TemporaryDirectory:
+    """
+    Create a temporary directory containing only links (or copies) to the given files.
+
+    Returns the TemporaryDirectory object, the caller must keep it alive while
+    the view is in use and clean it up afterwards (see `release_view`).
+    """
+    tmpdir_obj = tempfile.TemporaryDirectory(prefix=prefix)
+    tmpdir = Path(tmpdir_obj.name)
+
+    sources = set()
+    for src in files:
+        dst = tmpdir / src.name
+        if link_mode == "symlink":
+            src = src.absolute()
+            dst.symlink_to(src)
+            sources.add(str(src.parent))
+        elif link_mode == "hardlink":
+            # requires same filesystem; fails across mounts
+            os.link(src, dst)
+        elif link_mode == "copy":
+            shutil.copy2(src, dst)
+        else:
+            raise ValueError(f"Unknown link_mode: {link_mode}")
+
+    with _lock:
+        _view_sources[tmpdir_obj.name] = sources
+    return tmpdir_obj
+
+
+def release_view(tmpdir_obj: tempfile.TemporaryDirectory):
+    with _lock:
+        _view_sources.pop(tmpdir_obj.name, None)
+    tmpdir_obj.cleanup()
+
+
+def view_mounts(volumes: Mapping[str, str]) -> dict[str, str]:
+    """
+    Return the extra read-only mounts needed for views used as docker volumes.
+
+    The symlinks in a view point to absolute host paths, so these paths are
+    mounted at the same location inside the container for the links to resolve.
+    """
+    mounts = {}
+    with _lock:
+        for host_path in volumes.values():
+            for src in _view_sources.get(str(host_path), ()):
+                mounts[src] = src
+    return mounts
+
+
+def list_files(source_dir: Path, pattern: str = "*") -> list[Path]:
+    return sorted(p for p in source_dir.glob(pattern) if p.name != MARKER)
+
+
+@contextmanager
+def filtered_view(
+    source_dir: Path,
+    cruise: str | None = None,
+    exclusions: ExclusionMatcher | None = None,
+    pattern: str = "*",
+    link_mode: str = "symlink",
+    require_files: bool = False,
+    use_cache: bool = True,
+    skip_keys: set[str] | None = None,
+    dry_run: bool = False,
+) -> Iterator[Path | None]:
+    """
+    Yield a directory with the content of `source_dir` minus excluded files.
+
+    Files whose key (see `macvin.resume.file_key`) is in `skip_keys` are left
+    out as well, this is used to resume a stage that was interrupted. If all
+    files are skipped, None is yielded and the stage has nothing to do.
+
+    If the local read cache is enabled (see `macvin.cache.get_cache`) the
+    allowed files are staged into the cache and the view links to the cached
+    copies, which stay pinned in the cache until the view is removed. If no file is excluded and the cache is disabled, the source
+    directory itself is yielded, so stages without exclusions pay no extra
+    cost. Otherwise a temporary view with links to the allowed files is
+    yielded and removed on exit.
+    """
+    source_dir = Path(source_dir)
+    if exclusions is None:
+        exclusions = load_exclusions().for_cruise(cruise)
+    cache = get_cache() if use_cache else None
+
+    if not source_dir.is_dir():
+        logger.warning(f"{source_dir} does not exist, no filtered view created")
+        yield source_dir
+        return
+
+    if not exclusions and not require_files and cache is None and not skip_keys:
+        yield source_dir
+        return
+
+    files = list_files(source_dir, pattern)
+    allowed, excluded = exclusions.split(files)
+    logger.info(
+        f"{source_dir}: total number of files: {len(files)}, "
+        f"allowed number of files: {len(allowed)}"
+    )
+
+    if require_files and not allowed:
+        raise RuntimeError(f"No files matched {pattern} in {source_dir} after exclusions")
+
+    skipped = []
+    if skip_keys:
+        remaining = []
+        for f in allowed:
+            (skipped if file_key(f) in skip_keys else remaining).append(f)
+        allowed = remaining
+        logger.info(
+            f"{source_dir}: skipping {len(skipped)} already processed files, "
+            f"{len(allowed)} files remaining"
+        )
+        if skipped and not allowed:
+            yield None
+            return
+
+    if cache is not None:
+        allowed = cache.stage(allowed, dry_run=dry_run, pin=True)
+    elif not excluded and not skipped and pattern == "*":
+        yield source_dir
+        return
+
+    try:
+        tmpdir_obj = make_view(allowed, link_mode=link_mode)
+        try:
+            yield Path(tmpdir_obj.name)
+        finally:
+            release_view(tmpdir_obj)
+    finally:
+        if cache is not None:
+            cache.unpin(allowed)
@@ -0,0 +1,329 @@
+from pathlib import Path
+from collections.abc import Callable, Mapping
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import ContextVar
+import json
+import logging
+import os
+import platform
+import threading
+import time
+import uuid
+
+from macvin.scheduler import Task, descendants, ready_order
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DIR_ENV = "MACVIN_QUEUE_DIR"
+LEASE_TTL_ENV = "MACVIN_LEASE_TTL_S"
+DEFAULT_LEASE_TTL_S = 300.0
+# Seconds between checks for stages released by other workers
+POLL_ENV = "MACVIN_QUEUE_POLL_S"
+DEFAULT_POLL_S = 30.0
+
+# Set when the lease of the unit running in this context is lost
+_lost: ContextVar[threading.Event | None] = ContextVar("macvin_lease_lost", default=None)
+
+
+def lease_lost() -> bool:
+    """Whether the lease of the queue unit running in this context was lost, so it should stop."""
+    lost = _lost.get()
+    return lost is not None and lost.is_set()
+
+
+def queue_dir(silver_root: Path, name: str) -> Path:
+    """The directory of queue `name`, under MACVIN_QUEUE_DIR or <silver_root>/.macvin_queue."""
+    return Path(os.getenv(QUEUE_DIR_ENV) or Path(silver_root) / ".macvin_queue") / name
+
+
+class WorkQueue:
+    """
+    (cruise, stage) units shared by workers on several hosts through a
+    directory on the shared file system. For every unit there is
+
+        <root>/<cruise>/<stage>.lease   while a worker runs it
+        <root>/<cruise>/<stage>.done    when it succeeded
+        <root>/<cruise>/<stage>.failed  when it failed
+
+    A lease is taken by creating the file exclusively and kept by touching it
+    every `ttl_s / 4` seconds. A lease that was not touched for `ttl_s` is
+    expired and the unit is taken over by another worker. The age of a lease
+    is measured against the clock of the file system, not of the host, so
+    the clocks of the hosts do not need to agree.
+    """
+
+    def __init__(self, root: Path, ttl_s: float | None = None):
+        if ttl_s is None:
+            ttl_s = float(os.getenv(LEASE_TTL_ENV, DEFAULT_LEASE_TTL_S))
+        self.root = Path(root)
+        self.ttl_s = ttl_s
+        self.heartbeat_s = ttl_s / 4
+        self.host = platform.node()
+        self.owner = f"{self.host}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._clock = self.root / ".clock" / self.owner.replace(":", "-")
+
+    def path(self, task: Task, kind: str) -> Path:
+        return self.root / task.cruise / f"{task.stage}.{kind}"
+
+    def is_done(self, task: Task) -> bool:
+        return self.path(task, "done").exists()
+
+    def is_failed(self, task: Task) -> bool:
+        return self.path(task, "failed").exists()
+
+    def now(self) -> float:
+        """The current time of the file system, from the mtime of a file we touch."""
+        try:
+            os.utime(self._clock)
+        except FileNotFoundError:
+            self._clock.parent.mkdir(parents=True, exist_ok=True)
+            self._clock.touch()
+        return self._clock.stat().st_mtime
+
+    def claim(self, task: Task) -> "Lease | None":
+        """Take the lease of a unit, or None if it is finished or leased by a live worker."""
+        if self.is_done(task) or self.is_failed(task):
+            return None
+        path = self.path(task, "lease")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if attempt == 0 and self._break_expired(task):
+                    continue
+                return None
+            except OSError as e:
+                logger.warning(f"Could not take the lease of {task}: {e}")
+                return None
+            with os.fdopen(fd, "w") as fid:
+                json.dump({"owner": self.owner, "host": self.host, "pid": os.getpid(), "acquired": time.time()}, fid)
+            lease = Lease(self, task, path)
+            # The unit may have been finished between the check above and taking the lease
+            if self.is_done(task) or self.is_failed(task):
+                lease.release()
+                return None
+            return lease
+        return None
+
+    def _break_expired(self, task: Task) -> bool:
+        """
+        Remove the lease of a unit if it expired. Returns True if the lease is
+        gone and can be taken again, False if it is live or the file system
+        refused one of the operations.
+        """
+        path = self.path(task, "lease")
+        try:
+            age = self.now() - path.stat().st_mtime
+            holder = _read_owner(path)
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.warning(f"Could not check the lease of {task}: {e}")
+            return False
+        if age <= self.ttl_s:
+            return False
+
+        # Move the lease aside first, so only one worker takes over the unit
+        stale = path.with_name(f"{path.name}.{self.owner.replace(':', '-')}")
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.warning(f"Could not move the expired lease of {task} aside: {e}")
+            return False
+        try:
+            renewed = self.now() - stale.stat().st_mtime <= self.ttl_s
+        except OSError as e:
+            logger.warning(f"Could not check the lease of {task} moved aside to {stale}: {e}")
+            renewed = True
+        if renewed:
+            # The lease was renewed or taken by another worker after we checked, put it back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            except OSError as e:
+                logger.error(f"Could not put back the lease of {task}, its holder will stop it: {e}")
+        try:
+            stale.unlink()
+        except OSError as e:
+            logger.warning(f"Could not remove {stale}: {e}")
+        if renewed:
+            return False
+        logger.warning(f"Lease of {task} held by {holder} expired {age:.0f} s after its last heartbeat, taking over")
+        return True
+
+
+class Lease:
+    """
+    A unit of a WorkQueue held by this worker, kept alive by a heartbeat
+    thread. `lost` is set when the heartbeat finds the lease taken over.
+    """
+
+    def __init__(self, queue: WorkQueue, task: Task, path: Path):
+        self.queue = queue
+        self.task = task
+        self.path = path
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name=f"lease-{task}", daemon=True)
+        self._thread.start()
+
+    def held(self) -> bool:
+        try:
+            return _read_owner(self.path) == self.queue.owner
+        except FileNotFoundError:
+            return False
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.queue.heartbeat_s):
+            if not self.held():
+                logger.error(f"Lost the lease of {self.task} to another worker, stopping it")
+                self.lost.set()
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                pass
+
+    def release(self):
+        self._stop.set()
+        self._thread.join()
+        if self.held():
+            self.path.unlink(missing_ok=True)
+
+    def finish(self, ok: bool) -> bool:
+        """
+        Mark the unit done or failed and release the lease. Returns False
+        without a marker if the lease was lost, since the unit then belongs to
+        the worker that took it over.
+        """
+        self._stop.set()
+        self._thread.join()
+        if not self.held():
+            logger.error(f"Finished {self.task} after losing its lease, not marking it {'done' if ok else 'failed'}")
+            return False
+        marker = self.queue.path(self.task, "done" if ok else "failed")
+        tmp = marker.with_name(f".{marker.name}.{self.queue.owner.replace(':', '-')}")
+        tmp.write_text(json.dumps({"owner": self.queue.owner, "host": self.queue.host, "finished": time.time()}))
+        os.replace(tmp, marker)
+        self.path.unlink(missing_ok=True)
+        return True
+
+
+def _read_owner(path: Path) -> str | None:
+    try:
+        return json.loads(path.read_text()).get("owner")
+    except ValueError:
+        # Created but not written yet
+        return None
+
+
+def run_queue(
+    graph: Mapping[Task, set[Task]],
+    run_task: Callable[[Task], bool],
+    queue: WorkQueue,
+    jobs: int = 1,
+    limits: Mapping[str, int] | None = None,
+    priority: Mapping[Task, float] | None = None,
+    poll_s: float | None = None,
+) -> dict[Task, str]:
+    """
+    Run the tasks of a graph like `run_graph`, together with other workers
+    running the same graph on the same queue. A task is started when its
+    dependencies are done, by this or another worker, and its lease can be
+    taken. While the remaining tasks are leased by other workers, the queue
+    is checked again every `poll_s` seconds, and leases of workers that died
+    are taken over once they expire.
+
+    A task whose lease is lost while it runs is stopped at its next
+    container (see `lease_lost`), and is then left to the worker that took
+    it over, like a task leased by another worker.
+
+    Returns the status of every task: 'ok', 'failed' or 'skipped', and
+    'done' for tasks that another worker finished.
+    """
+    if poll_s is None:
+        poll_s = float(os.getenv(POLL_ENV, DEFAULT_POLL_S))
+    key = ready_order(graph, priority)
+    jobs = max(jobs, 1)
+    status: dict[Task, str] = {}
+    running: dict[Future, tuple[Task, Lease]] = {}
+    per_stage: Counter[str] = Counter()
+    limits = limits or {}
+    waiting = 0
+
+    def _call(task: Task, lost: threading.Event) -> bool:
+        threading.current_thread().name = str(task)
+        token = _lost.set(lost)
+        try:
+            return bool(run_task(task))
+        except Exception:
+            logger.exception(f"{task} failed")
+            return False
+        finally:
+            _lost.reset(token)
+
+    def _skip_after(task: Task):
+        skipped = {t for t in descendants(graph, task) if t not in status}
+        for t in skipped:
+            status[t] = "skipped"
+        if skipped:
+            logger.error(f"{task} failed, skipping {', '.join(map(str, sorted(skipped)))}")
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            active = {task for task, _ in running.values()}
+            pending = [t for t in graph if t not in status and t not in active]
+            for task in pending:
+                if task in status:
+                    continue
+                if queue.is_done(task):
+                    status[task] = "done"
+                elif queue.is_failed(task):
+                    status[task] = "failed"
+                    _skip_after(task)
+            pending = sorted((t for t in pending if t not in status), key=key)
+            if not pending and not running:
+                break
+
+            for task in pending:
+                if len(running) >= jobs:
+                    break
+                if per_stage[task.stage] >= limits.get(task.stage, jobs):
+                    continue
+                if not all(status.get(d) in ("ok", "done") for d in graph[task]):
+                    continue
+                lease = queue.claim(task)
+                if lease is None:
+                    continue
+                per_stage[task.stage] += 1
+                logger.info(f"Starting {task}")
+                running[pool.submit(_call, task, lease.lost)] = (task, lease)
+
+            if not running:
+                if len(pending) != waiting:
+                    waiting = len(pending)
+                    logger.info(f"Waiting for other workers, {waiting} stages left")
+                time.sleep(poll_s)
+                continue
+
+            done, _ = wait(running, timeout=poll_s, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, lease = running.pop(future)
+                per_stage[task.stage] -= 1
+                ok = future.result()
+                if not lease.finish(ok):
+                    # Its status comes from the queue once the new holder finishes it
+                    logger.warning(f"{task} was taken over by another worker, not starting its dependents")
+                elif ok:
+                    status[task] = "ok"
+                    logger.info(f"Finished {task}")
+                else:
+                    status[task] = "failed"
+                    _skip_after(task)
+
+    return status